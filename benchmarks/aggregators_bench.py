@@ -0,0 +1,253 @@
+#! /usr/bin/env python
+
+# This file is a part of IoT-LAB aggregation-tools
+# Copyright (C) 2015 INRIA (Contact: admin@iot-lab.info)
+# Contributor(s) : see AUTHORS file
+#
+# This software is governed by the CeCILL license under French law
+# and abiding by the rules of distribution of free software.  You can  use,
+# modify and/ or redistribute the software under the terms of the CeCILL
+# license as circulated by CEA, CNRS and INRIA at the following URL
+# http://www.cecill.info.
+#
+# As a counterpart to the access to the source code and  rights to copy,
+# modify and redistribute granted by the license, users are provided only
+# with a limited warranty  and the software's author,  the holder of the
+# economic rights,  and the successive licensors  have only  limited
+# liability.
+#
+# The fact that you are presently reading this means that you have had
+# knowledge of the CeCILL license and that you accept its terms.
+
+"""End-to-end aggregators throughput benchmark
+
+Start synthetic nodes servers on local addresses, in another process, that
+send lines of ``--size`` bytes or ZEP frames at ``--rate`` messages/s per node
+(0 for max rate) during ``--duration`` seconds. Run the real serial or sniffer
+aggregator on them, with its output written to a counting sink.
+
+Print one json result per scenario, with throughput, CPU time per message,
+max memory, drops and output latency percentiles:
+
+    $ PYTHONPATH=. python benchmarks/aggregators_bench.py \\
+        --kind serial sniffer --nodes 10 100 --rate 0 -o results.json
+"""
+
+import argparse
+import io
+import ipaddress
+import json
+import multiprocessing
+import platform
+import resource
+import signal
+import socket
+import struct
+import time
+
+import iotlabaggregator
+from iotlabaggregator import LOGGER, serial, sniffer, zeptopcap
+
+NTP_TIME = zeptopcap.ZepPcap.NTP_TIME
+ZEP_HDR_LEN = zeptopcap.ZepPcap.ZEP_HDR_LEN
+TICK = 0.005
+
+
+def zep_frame(payload_len):
+    """Return a ZEP frame template with ``payload_len`` data."""
+    frame = bytearray(ZEP_HDR_LEN + payload_len)
+    frame[0:4] = b"EX\x02\x01"
+    frame[ZEP_HDR_LEN - 1] = payload_len
+    return frame
+
+
+def messages(kind, size, count):
+    """Return ``count`` messages of ``size`` bytes, timestamped now."""
+    now = time.time()
+    if kind == "serial":
+        line = b"%d " % time.time_ns()
+        return (line + b"x" * max(0, size - len(line) - 1) + b"\n") * count
+    frame = zep_frame(size)
+    ntp_s = int(now) + zeptopcap.ZepPcap.NTP_JAN_1970
+    ntp_frac = int((now % 1) * zeptopcap.ZepPcap.NTP_SECONDS_FRAC)
+    NTP_TIME.pack_into(frame, zeptopcap.ZepPcap.ZEP_TIME_IDX, ntp_s, ntp_frac)
+    return bytes(frame) * count
+
+
+def generate(conn, hosts, port, kind, size, rate, duration):
+    """Serve nodes ``hosts``, send messages, then send the sent count."""
+    servers = [socket.create_server((host, port)) for host in hosts]
+    conn.send("ready")
+    clients = []
+    for server in servers:
+        server.settimeout(30)
+        clients.append(server.accept()[0])
+        server.close()
+    sent = 0
+    start = time.monotonic()
+    while (elapsed := time.monotonic() - start) < duration:
+        if rate:
+            # messages due for each node since start
+            count = int(elapsed * rate) - sent // len(clients)
+        else:
+            count = max(1, 65536 // max(size, 1))
+        if count > 0:
+            data = messages(kind, size, count)
+            for client in clients:
+                client.sendall(data)
+            sent += count * len(clients)
+        if rate:
+            time.sleep(TICK)
+    for client in clients:
+        client.close()
+    conn.send(sent)
+
+
+class Sink(io.RawIOBase):
+    """Binary output counting messages and sampling their latency."""
+
+    def __init__(self, kind):
+        super().__init__()
+        self.kind = kind
+        self.lines = 0
+        self.first = self.last = None
+        self.latencies = []
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        """Count messages, sample latency of one message per write."""
+        now = time.time()
+        self.first = self.first or time.monotonic()
+        self.last = time.monotonic()
+        with memoryview(data) as view:
+            sent = self._sent_time(bytes(view[:256]))
+        if sent is not None:
+            self.latencies.append(now - sent)
+        if self.kind == "serial":
+            self.lines += data.count(b"\n")
+        return len(data)
+
+    def _sent_time(self, data):
+        """Return first message sending time."""
+        if self.kind == "serial":
+            try:
+                return int(data.split(b";", 2)[2].split(b" ", 1)[0]) / 1e9
+            except (IndexError, ValueError):
+                return None
+        if data[:4] == struct.pack("=L", 0xA1B2C3D4):
+            return None  # pcap file header
+        t_s, t_us = struct.unpack_from("=LL", data)
+        return t_s + t_us / 1e6
+
+
+def percentile(values, ratio):
+    """Return ``ratio`` percentile of ``values``."""
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * ratio))]
+
+
+def run_scenario(kind, nodes, size, rate, duration, port):
+    """Run the aggregator on synthetic nodes, return the result dict."""
+    first = ipaddress.ip_address("127.0.0.2")
+    hosts = {f"node-{i}": str(first + i) for i in range(nodes)}
+    ctx = multiprocessing.get_context("spawn")
+    conn, child_conn = ctx.Pipe()
+    args = (child_conn, list(hosts.values()), port, kind, size, rate, duration)
+    generator = ctx.Process(target=generate, args=args, daemon=True)
+    generator.start()
+    conn.recv()  # servers ready
+
+    sink = Sink(kind)
+    if kind == "serial":
+        connection = type("Connection", (serial.SerialConnection,), {"port": port})
+        agg_class = type("Aggregator", (serial.SerialAggregator,), {})
+        agg_class.connection_class = connection
+        agg = agg_class(list(hosts), outfd=sink, print_lines=True, hosts=hosts)
+    else:
+        connection = type("Connection", (sniffer.SnifferConnection,), {"port": port})
+        agg_class = type("Aggregator", (sniffer.SnifferAggregator,), {})
+        agg_class.connection_class = connection
+        agg = agg_class(list(hosts), sink, hosts=hosts)
+
+    # The aggregator sends SIGINT when all the nodes are closed
+    previous = signal.signal(signal.SIGINT, lambda *_: None)
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    try:
+        with agg:
+            sent = conn.recv()
+            agg.thread.join()
+    finally:
+        signal.signal(signal.SIGINT, previous)
+    end_usage = resource.getrusage(resource.RUSAGE_SELF)
+    generator.join()
+
+    received = sink.lines if kind == "serial" else agg.rx_packets
+    cpu = (end_usage.ru_utime - usage.ru_utime) + (end_usage.ru_stime - usage.ru_stime)
+    elapsed = (sink.last - sink.first) if received else 0.0
+    return {
+        "kind": kind,
+        "nodes": nodes,
+        "size": size,
+        "rate": rate,
+        "duration": duration,
+        "connected": len(agg.connect_times) - len(agg.connect_errors),
+        "sent": sent,
+        "received": received,
+        "dropped": sent - received,
+        "msgs_per_s": received / elapsed if elapsed else None,
+        "bytes_per_s": received * size / elapsed if elapsed else None,
+        "cpu_s": cpu,
+        "cpu_us_per_msg": cpu * 1e6 / received if received else None,
+        "max_rss_kb": end_usage.ru_maxrss,
+        "latency_ms": {
+            name: value * 1000 if value is not None else None
+            for name, value in (
+                ("p50", percentile(sink.latencies, 0.5)),
+                ("p99", percentile(sink.latencies, 0.99)),
+                ("max", percentile(sink.latencies, 1.0)),
+            )
+        },
+    }
+
+
+def main():
+    """Run the benchmark scenarios."""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument(
+        "--kind", nargs="+", choices=("serial", "sniffer"), default=["serial"]
+    )
+    parser.add_argument("--nodes", nargs="+", type=int, default=[10])
+    parser.add_argument(
+        "--size", type=int, default=64, help="line or ZEP payload bytes"
+    )
+    parser.add_argument(
+        "--rate", nargs="+", type=int, default=[0], help="msgs/s per node, 0: max"
+    )
+    parser.add_argument("--duration", type=float, default=5.0)
+    parser.add_argument("--port", type=int, default=21000)
+    parser.add_argument("-o", "--outfile", help="Json results file")
+    opts = parser.parse_args()
+
+    LOGGER.setLevel("WARNING")
+    results = []
+    for kind in opts.kind:
+        for nodes in opts.nodes:
+            for rate in opts.rate:
+                result = run_scenario(
+                    kind, nodes, opts.size, rate, opts.duration, opts.port
+                )
+                result["version"] = iotlabaggregator.__version__
+                result["python"] = platform.python_version()
+                print(json.dumps(result))
+                results.append(result)
+    if opts.outfile:
+        with open(opts.outfile, "w", encoding="utf-8") as outfile:
+            json.dump(results, outfile, indent=2)
+
+
+if __name__ == "__main__":
+    main()
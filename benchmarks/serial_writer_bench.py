@@ -0,0 +1,102 @@
+#! /usr/bin/env python
+
+# This file is a part of IoT-LAB aggregation-tools
+# Copyright (C) 2015 INRIA (Contact: admin@iot-lab.info)
+# Contributor(s) : see AUTHORS file
+#
+# This software is governed by the CeCILL license under French law
+# and abiding by the rules of distribution of free software.  You can  use,
+# modify and/ or redistribute the software under the terms of the CeCILL
+# license as circulated by CEA, CNRS and INRIA at the following URL
+# http://www.cecill.info.
+#
+# As a counterpart to the access to the source code and  rights to copy,
+# modify and redistribute granted by the license, users are provided only
+# with a limited warranty  and the software's author,  the holder of the
+# economic rights,  and the successive licensors  have only  limited
+# liability.
+#
+# The fact that you are presently reading this means that you have had
+# knowledge of the CeCILL license and that you accept its terms.
+
+"""Serial lines output micro-benchmark
+
+Print the lines/s rate of the logging records output path, formatting each
+line with ``LOG_FMT``, and of ``output.LineWriter`` formatting the lines of
+one read at once, to a null output or to a file.
+
+    $ PYTHONPATH=. python benchmarks/serial_writer_bench.py [-n LINES] [-b BATCH]
+"""
+
+import argparse
+import io
+import logging
+import time
+
+from iotlabaggregator import LOG_FMT, output, serial
+
+
+class NullOutput(io.RawIOBase):
+    """Binary output discarding data."""
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        """Discard data."""
+        return len(data)
+
+
+def bench(func, num):
+    """Return the lines/s rate of ``func`` writing ``num`` lines."""
+    start = time.perf_counter()
+    func()
+    return num / (time.perf_counter() - start)
+
+
+def main():
+    """Run the benchmark."""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("-n", "--lines", type=int, default=200000)
+    parser.add_argument("-b", "--batch", type=int, default=8, help="lines per read")
+    parser.add_argument("-c", "--color", action="store_true")
+    parser.add_argument("-o", "--outfile", help="Write to file, like /dev/null")
+    opts = parser.parse_args()
+
+    lines = ["Senslab Simple Demo program: some sensor value 1234"] * opts.batch
+    num = opts.lines // opts.batch * opts.batch
+    color = serial.color_str("m3-1") if opts.color else ""
+    reset = serial.COLOR_RESET if opts.color else ""
+
+    def outfile():
+        return open(opts.outfile, "wb") if opts.outfile else NullOutput()
+
+    # Previous output path: one logging record per line
+    handler = logging.StreamHandler(io.TextIOWrapper(outfile(), "utf-8", "replace"))
+    handler.setFormatter(LOG_FMT)
+    logger = logging.getLogger("serial_writer_bench")
+    logger.propagate = False
+    logger.setLevel(logging.INFO)
+    logger.addHandler(handler)
+    fmt = f"{color}%s;%s{reset}"
+
+    def logging_path():
+        for _ in range(num // len(lines)):
+            for line in lines:
+                logger.info(fmt, "m3-1", line)
+            handler.flush()
+
+    writer = output.LineWriter(outfile(), output.FlushPolicy(output.FlushPolicy.IDLE))
+    prefix = f"{color}m3-1;"
+
+    def writer_path():
+        for _ in range(num // len(lines)):
+            writer.write_lines(lines, prefix, reset)
+            writer.idle()
+
+    print(f"logging:     {bench(logging_path, num):12.0f} lines/s")
+    print(f"line writer: {bench(writer_path, num):12.0f} lines/s")
+
+
+if __name__ == "__main__":
+    main()
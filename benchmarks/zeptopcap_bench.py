@@ -0,0 +1,173 @@
+#! /usr/bin/env python
+
+# This file is a part of IoT-LAB aggregation-tools
+# Copyright (C) 2015 INRIA (Contact: admin@iot-lab.info)
+# Contributor(s) : see AUTHORS file
+#
+# This software is governed by the CeCILL license under French law
+# and abiding by the rules of distribution of free software.  You can  use,
+# modify and/ or redistribute the software under the terms of the CeCILL
+# license as circulated by CEA, CNRS and INRIA at the following URL
+# http://www.cecill.info.
+#
+# As a counterpart to the access to the source code and  rights to copy,
+# modify and redistribute granted by the license, users are provided only
+# with a limited warranty  and the software's author,  the holder of the
+# economic rights,  and the successive licensors  have only  limited
+# liability.
+#
+# The fact that you are presently reading this means that you have had
+# knowledge of the CeCILL license and that you accept its terms.
+
+"""ZepPcap encoding micro-benchmark
+
+Print the packets/s rate of ``ZepPcap`` writing packets one by one and by
+batches, to a null output or to a file, and of the previous encoder packing
+each header separately, as a baseline.
+
+    $ PYTHONPATH=. python benchmarks/zeptopcap_bench.py [-n PACKETS] [-b BATCH]
+"""
+
+import argparse
+import contextlib
+import struct
+import time
+
+from iotlabaggregator import zeptopcap
+
+
+class NullOutput:
+    """Binary output discarding data."""
+
+    def write(self, data):
+        """Discard data."""
+        return len(data)
+
+    def flush(self):
+        """Nothing to flush."""
+
+
+class LegacyZepPcap:
+    """Previous encoder, packing and writing each packet headers separately."""
+
+    ZEP = zeptopcap.ZepPcap
+    eth_hdr = struct.pack("!3H3HH", 0, 0, 0, 0, 0, 0, 0x0800)
+
+    def __init__(self, outfile, raw=False):
+        self.out = outfile
+        self.write = self._write_raw if raw else self._write_zep
+        link = self.ZEP.LINKTYPE_IEEE802_15_4 if raw else self.ZEP.LINKTYPE_ETHERNET
+        self.out.write(self.ZEP._main_pcap_header(link))
+        self.out.flush()
+
+    def _write_zep(self, packet):
+        """Encapsulate ZEP ``packet`` bytes in pcap outfile"""
+        t_s, t_us = self._timestamp(packet)
+        length = len(packet)
+        udp_hdr = self._udp_header(length)
+        length += len(udp_hdr)
+        ip_hdr = self._ip_header(length)
+        length += len(ip_hdr) + len(self.eth_hdr)
+        self.out.write(self._pcap_header(length, t_s, t_us))
+        self.out.write(self.eth_hdr)
+        self.out.write(ip_hdr)
+        self.out.write(udp_hdr)
+        self.out.write(packet)
+        self.out.flush()
+
+    def _write_raw(self, packet):
+        """Only write the ZEP ``packet`` bytes payload as pcap"""
+        t_s, t_us = self._timestamp(packet)
+        payload = memoryview(packet)[self.ZEP.ZEP_HDR_LEN :]
+        self.out.write(self._pcap_header(len(payload), t_s, t_us))
+        self.out.write(payload)
+        self.out.flush()
+
+    def _timestamp(self, packet):
+        """Return packet NTP timestamp as an unix time tuple (s, us)"""
+        ntp_t = struct.unpack_from("!LL", packet, self.ZEP.ZEP_TIME_IDX)
+        t_s = ntp_t[0] - self.ZEP.NTP_JAN_1970
+        t_us = (1000000 * ntp_t[1]) / self.ZEP.NTP_SECONDS_FRAC
+        return t_s, round(t_us)
+
+    def _udp_header(self, pkt_len):
+        """Return the UDP header"""
+        hdr_struct = struct.Struct("!HHHH")
+        udp_len = hdr_struct.size + pkt_len
+        return hdr_struct.pack(self.ZEP.ZEP_PORT, self.ZEP.ZEP_PORT, udp_len, 0)
+
+    def _ip_header(self, pkt_len):
+        """Return the IP header, packed twice to compute its checksum"""
+        hdr_struct = struct.Struct("!BBHHHBBHLL")
+        ip_len = hdr_struct.size + pkt_len
+        fields = [0x45, 0, ip_len, 0, 0x4000, 0xFF, 0x11, 0, 0x7F000001, 0x7F000001]
+        fields[7] = self._ip_checksum(hdr_struct.pack(*fields))
+        return hdr_struct.pack(*fields)
+
+    @staticmethod
+    def _pcap_header(pkt_len, t_s, t_us):
+        """Return the pcap record header"""
+        return struct.Struct("=LLLL").pack(t_s, t_us, pkt_len, pkt_len)
+
+    @staticmethod
+    def _ip_checksum(hdr):
+        """Return the ip checksum for given header"""
+        word_pack = struct.Struct("!H")
+        hdr_split = (hdr[i : i + 2] for i in range(0, len(hdr), 2))
+        csum = sum(word_pack.unpack(word)[0] for word in hdr_split)
+        return (csum + (csum >> 16)) & 0xFFFF ^ 0xFFFF
+
+
+def zep_packet(payload_len=20):
+    """Return a ZEP packet with a valid timestamp and ``payload_len`` data."""
+    pkt = bytearray(zeptopcap.ZepPcap.ZEP_HDR_LEN + payload_len)
+    pkt[0:4] = b"EX\x02\x01"
+    struct.pack_into("!LL", pkt, zeptopcap.ZepPcap.ZEP_TIME_IDX, 0xE949B200, 0x80000000)
+    pkt[zeptopcap.ZepPcap.ZEP_HDR_LEN - 1] = payload_len
+    return bytes(pkt)
+
+
+def bench(func, num):
+    """Return the packets/s rate of ``func`` writing ``num`` packets."""
+    start = time.perf_counter()
+    func()
+    return num / (time.perf_counter() - start)
+
+
+def main():
+    """Run the benchmark."""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("-n", "--packets", type=int, default=200000)
+    parser.add_argument("-b", "--batch", type=int, default=32)
+    parser.add_argument("-o", "--outfile", help="Write to file, like /dev/null")
+    opts = parser.parse_args()
+
+    pkt = zep_packet()
+    num = opts.packets
+    batch = [pkt] * opts.batch
+    for raw in (False, True):
+        mode = "raw" if raw else "zep"
+        for name, cls in (("legacy", LegacyZepPcap), ("current", zeptopcap.ZepPcap)):
+            with contextlib.ExitStack() as stack:
+                out = NullOutput()
+                if opts.outfile:
+                    out = stack.enter_context(open(opts.outfile, "wb"))
+                zep = cls(out, raw)
+
+                def single():
+                    for _ in range(num):
+                        zep.write(pkt)  # pylint:disable=cell-var-from-loop
+
+                def batched():
+                    for _ in range(num // len(batch)):
+                        zep.write_packets(None, batch)  # pylint:disable=cell-var-from-loop
+
+                rate = bench(single, num)
+                print(f"{mode} {name} single: {rate:12.0f} packets/s")
+                if cls is not LegacyZepPcap:
+                    rate = bench(batched, num // len(batch) * len(batch))
+                    print(f"{mode} {name} batch {len(batch)}: {rate:10.0f} packets/s")
+
+
+if __name__ == "__main__":
+    main()
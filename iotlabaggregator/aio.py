@@ -0,0 +1,273 @@
+#! /usr/bin/env python
+
+# This file is a part of IoT-LAB aggregation-tools
+# Copyright (C) 2015 INRIA (Contact: admin@iot-lab.info)
+# Contributor(s) : see AUTHORS file
+#
+# This software is governed by the CeCILL license under French law
+# and abiding by the rules of distribution of free software.  You can  use,
+# modify and/ or redistribute the software under the terms of the CeCILL
+# license as circulated by CEA, CNRS and INRIA at the following URL
+# http://www.cecill.info.
+#
+# As a counterpart to the access to the source code and  rights to copy,
+# modify and redistribute granted by the license, users are provided only
+# with a limited warranty  and the software's author,  the holder of the
+# economic rights,  and the successive licensors  have only  limited
+# liability.
+#
+# The fact that you are presently reading this means that you have had
+# knowledge of the CeCILL license and that you accept its terms.
+
+"""Aggregate multiple tcp connections with asyncio
+
+Connections classes are the same as the threaded aggregators ones, their
+``handle_data`` is run by asyncio protocols.
+
+    async def main():
+        async with AsyncSerialAggregator(nodes_list) as aggregator:
+            async for node, line in aggregator.lines():
+                print(node, line)
+
+    aio.run(main())
+
+:func:`run` uses ``uvloop`` event loop when it is installed.
+"""
+
+import asyncio
+import time
+
+from iotlabaggregator import LOGGER, connections, serial, sniffer
+
+try:
+    import uvloop
+
+    HAS_UVLOOP = True
+except ImportError:
+    HAS_UVLOOP = False
+
+_STOP = object()
+
+
+def run(main):
+    """Run ``main`` coroutine, with uvloop event loop when available."""
+    if HAS_UVLOOP:
+        return uvloop.run(main)
+    return asyncio.run(main)
+
+
+class NodeProtocol(asyncio.BufferedProtocol):
+    """Run ``node`` data handler on data received from asyncio transport."""
+
+    def __init__(self, node, aggregator):
+        self.node = node
+        self.aggregator = aggregator
+        self._recv_buff = bytearray(node.recv_size)
+
+    def connection_made(self, transport):
+        self.aggregator.connection_made(self.node, transport)
+
+    def get_buffer(self, sizehint):
+        return self._recv_buff
+
+    def buffer_updated(self, nbytes):
+        buff = self.node.data_buff
+        buff += memoryview(self._recv_buff)[:nbytes]
+        del buff[: self.node.handle_data(buff)]
+
+    def eof_received(self):
+        return False  # Close the transport
+
+    def connection_lost(self, exc):
+        self.aggregator.connection_lost(self.node, exc)
+
+
+class AsyncAggregator(dict):
+    """Create a dict of Connection from ``nodes_list`` run with asyncio.
+
+    Each node is stored in the entry with its node_id.
+    Use it as an asynchronous context manager to connect and close nodes.
+
+    Data received from nodes is queued from connection time, and consumed
+    by iterating on the subclasses ``lines()`` or ``packets()``.
+    When ``queue_size`` items are queued, reading from nodes is paused until
+    the queue is back under half ``queue_size``.
+
+    :param connect_timeout: max time in seconds to resolve and connect a node
+    """
+
+    connection_class = connections.Connection
+    connect_timeout = 10.0
+    queue_size = 4096
+
+    def __init__(self, nodes_list, *args, connect_timeout=None, **kwargs):
+        if not nodes_list:
+            raise ValueError(
+                f"{self.__class__.__name__}: Empty nodes list {nodes_list!r}"
+            )
+        super().__init__()
+        if connect_timeout is not None:
+            self.connect_timeout = connect_timeout
+        self._transports = {}
+        self._queue = asyncio.Queue()
+        self._paused = False
+        self._stopped = False
+        self._started = False
+        self.connect_times = {}
+        self.connect_errors = {}
+        for node_url in nodes_list:
+            node = self.connection_class(node_url, self, *args, **kwargs)
+            self[node_url] = node
+
+    async def start(self):
+        """Connect all nodes concurrently."""
+        await asyncio.gather(*(self._connect(node) for node in self.values()))
+        self._started = True
+        LOGGER.info(
+            "%u/%u nodes connected, failed: %s",
+            len(self._transports),
+            len(self),
+            ",".join(sorted(self.connect_errors)) or "none",
+        )
+        if not self._transports:
+            self._stop_queue()
+
+    async def _connect(self, node):
+        """Resolve and connect ``node`` within ``connect_timeout``."""
+        loop = asyncio.get_running_loop()
+        start_time = time.monotonic()
+        try:
+            await asyncio.wait_for(self._open(loop, node), self.connect_timeout)
+        except (OSError, asyncio.TimeoutError) as err:
+            self.connect_errors[node.hostname] = err
+            LOGGER.error("%s;Connection failed: %r", node.hostname, err)
+            return
+        finally:
+            self.connect_times[node.hostname] = time.monotonic() - start_time
+
+    async def _open(self, loop, node):
+        """Open ``node`` connection, name is resolved by the node."""
+        family, _, proto, _, address = await loop.run_in_executor(None, node.resolve)
+        node.data_buff.clear()
+        return await loop.create_connection(
+            lambda: NodeProtocol(node, self),
+            *address[:2],
+            family=family,
+            proto=proto,
+        )
+
+    async def stop(self):
+        """Close all nodes connections."""
+        LOGGER.info("Stopping")
+        for transport in list(self._transports.values()):
+            transport.close()
+        await asyncio.sleep(0)  # Let transports call connection_lost
+        self._stop_queue()
+
+    async def __aenter__(self):
+        await self.start()
+        return self
+
+    async def __aexit__(self, _type, _value, _traceback):
+        await self.stop()
+
+    def connection_made(self, node, transport):
+        """Save ``node`` connection ``transport``."""
+        self._transports[node] = transport
+        if self._paused:
+            transport.pause_reading()
+
+    def connection_lost(self, node, exc=None):
+        """Remove ``node`` closed connection."""
+        if self._transports.pop(node, None) is None:
+            return
+        if exc is not None:
+            LOGGER.error("%s;Connection lost: %r", node.hostname, exc)
+        else:
+            LOGGER.error("%s;Connection closed", node.hostname)
+        node.data_buff.clear()
+        self.pop(node.hostname, None)
+        if not self._transports and self._started:
+            LOGGER.info("All connections closed")
+            self._stop_queue()
+
+    def send_nodes(self, nodes_list, message):
+        """Send ``message`` to ``nodes_list`` nodes; broadcast if None."""
+        data = message.encode("utf-8", "replace")
+        nodes = self.keys() if nodes_list is None else nodes_list
+        for hostname in nodes:
+            node = self.get(hostname)
+            transport = self._transports.get(node)
+            if transport is None:
+                LOGGER.warning("Node not connected: %s", hostname)
+                continue
+            transport.write(data)
+
+    def broadcast(self, message):
+        """Send a message to all nodes."""
+        self.send_nodes(None, message)
+
+    def _put(self, item):
+        """Queue ``item``, pause reading nodes when the queue is full."""
+        self._queue.put_nowait(item)
+        if not self._paused and self._queue.qsize() >= self.queue_size:
+            self._paused = True
+            for transport in self._transports.values():
+                transport.pause_reading()
+
+    async def _iterate(self):
+        """Iterate over the queued items until the aggregator stops."""
+        while True:
+            item = await self._queue.get()
+            if item is _STOP:
+                self._queue.put_nowait(_STOP)  # for other iterators
+                return
+            if self._paused and self._queue.qsize() <= self.queue_size // 2:
+                self._paused = False
+                for transport in self._transports.values():
+                    transport.resume_reading()
+            yield item
+
+    def _stop_queue(self):
+        """Stop iterators once all queued items are consumed."""
+        if not self._stopped:
+            self._stopped = True
+            self._queue.put_nowait(_STOP)
+
+
+class AsyncSerialAggregator(AsyncAggregator):
+    """Asyncio aggregator for the Serial."""
+
+    connection_class = serial.SerialConnection
+
+    def __init__(self, nodes_list, *args, **kwargs):
+        super().__init__(nodes_list, *args, **kwargs)
+        for node in self.values():
+            node.line_handler.append(self._line_handler)
+
+    def _line_handler(self, identifier, line):
+        self._put((identifier, line))
+
+    def lines(self):
+        """Iterate over ``(node, line)`` lines received from all nodes."""
+        return self._iterate()
+
+
+class AsyncSnifferAggregator(AsyncAggregator):
+    """Asyncio aggregator for the Sniffer."""
+
+    connection_class = sniffer.SnifferConnection
+
+    def __init__(self, nodes_list, *args, **kwargs):
+        super().__init__(nodes_list, *args, **kwargs)
+        self.rx_packets = 0
+        for node in self.values():
+            node.pkts_handler.append(self._pkts_handler)
+
+    def _pkts_handler(self, identifier, pkts):
+        for pkt in pkts:
+            self._put((identifier, pkt))
+
+    def packets(self):
+        """Iterate over ``(node, packet)`` ZEP packets received from all nodes."""
+        return self._iterate()
@@ -23,16 +23,57 @@
 """Common functions that may be required"""
 
 import itertools
+import json
 import os
-
-import iotlabcli
-import iotlabcli.parser.common
-import iotlabcli.parser.node
-from iotlabcli import experiment
+import time
+import urllib.parse
 
 import iotlabaggregator
+from iotlabaggregator import LOGGER
+
+# iotlabcli, and its HTTP client, is only imported when used for a fast startup
+# pylint:disable=import-outside-toplevel
+
+
+def __getattr__(name):
+    """Compute ``HOSTNAME`` on first use."""
+    if name == "HOSTNAME":
+        return globals().setdefault("HOSTNAME", os.uname()[1])
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
 
-HOSTNAME = os.uname()[1]
+
+def _hostname():
+    """Return this server ``HOSTNAME``."""
+    return globals().get("HOSTNAME") or __getattr__("HOSTNAME")
+
+
+class class_parser:  # pylint:disable=invalid-name,too-few-public-methods
+    """Class attribute parser, built by the decorated function on first use.
+
+    >>> class Cmd:
+    ...     @class_parser
+    ...     def parser(cls):
+    ...         print('build')
+    ...         return cls.__name__
+    >>> Cmd.parser
+    build
+    'Cmd'
+    >>> Cmd.parser
+    'Cmd'
+    """
+
+    def __init__(self, build):
+        self.build = build
+        self.name = build.__name__
+        self.__doc__ = build.__doc__
+
+    def __set_name__(self, owner, name):
+        self.name = name
+
+    def __get__(self, instance, owner):
+        parser = self.build(owner)
+        setattr(owner, self.name, parser)
+        return parser
 
 
 # http://stackoverflow.com/questions/1092531/event-system-in-python
@@ -90,35 +131,126 @@ def extract_nodes(resources, hostname=None):
     >>> extract_nodes(resources, hostname='grenoble')
     ['m3-1', 'a8-1']
     """
-    hostname = hostname or HOSTNAME
+    hostname = hostname or _hostname()
     sites_nodes = [n for n in resources["items"] if n["site"] == hostname]
     nodes = [n["network_address"].split(".")[0] for n in sites_nodes]
     return nodes
 
 
-def query_nodes(api, exp_id=None, nodes_list=None, hostname=None):
-    """Get nodes list from nodes_list or current running experiment."""
-    hostname = hostname or HOSTNAME
+class NodesCache:
+    """On-disk cache of experiments nodes lists, per user, experiment and site.
+
+    Entries are JSON files in ``directory``, valid ``ttl`` seconds.
+    """
+
+    def __init__(self, user, ttl, directory=None):
+        self.user = user or ""
+        self.ttl = ttl
+        self.directory = directory or self.default_directory()
+
+    @staticmethod
+    def default_directory():
+        """Return ``$XDG_CACHE_HOME/iotlabaggregator``, ``~/.cache`` default."""
+        cache_home = os.environ.get("XDG_CACHE_HOME") or os.path.expanduser("~/.cache")
+        return os.path.join(cache_home, "iotlabaggregator")
+
+    def path(self, exp_id, site):
+        """Return ``exp_id`` and ``site`` entry path."""
+        name = "-".join(
+            urllib.parse.quote(str(part), safe="") for part in (self.user, exp_id, site)
+        )
+        return os.path.join(self.directory, f"nodes-{name}.json")
+
+    def get(self, exp_id, site):
+        """Return cached nodes list, None if missing or expired."""
+        try:
+            with open(self.path(exp_id, site), encoding="utf-8") as cache_file:
+                entry = json.load(cache_file)
+            age = time.time() - entry["time"]
+            nodes = entry["nodes"]
+        except (OSError, ValueError, KeyError, TypeError):
+            return None
+        if not 0 <= age <= self.ttl:
+            return None
+        return nodes
+
+    def set(self, exp_id, site, nodes):
+        """Store ``nodes`` list, the cache is only best effort."""
+        path = self.path(exp_id, site)
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        try:
+            os.makedirs(self.directory, mode=0o700, exist_ok=True)
+            with open(tmp_path, "w", encoding="utf-8") as cache_file:
+                json.dump({"time": time.time(), "nodes": nodes}, cache_file)
+            os.replace(tmp_path, path)
+        except OSError as err:
+            LOGGER.warning("Nodes cache not written: %s", err)
+
+    def invalidate(self, exp_id, site):
+        """Remove ``exp_id`` and ``site`` entry."""
+        try:
+            os.remove(self.path(exp_id, site))
+        except FileNotFoundError:
+            pass
+
+    def clear(self):
+        """Remove all user entries."""
+        user = urllib.parse.quote(self.user, safe="")
+        try:
+            names = os.listdir(self.directory)
+        except FileNotFoundError:
+            return
+        for name in names:
+            if name.startswith(f"nodes-{user}-") and name.endswith(".json"):
+                os.remove(os.path.join(self.directory, name))
+
+
+def query_nodes(api, exp_id=None, nodes_list=None, hostname=None, cache=None):
+    """Get nodes list from nodes_list or current running experiment.
+
+    With ``cache``, a ``NodesCache``, experiment nodes are read from it
+    instead of the API when valid. The current experiment id is always
+    queried, a new experiment does not get the previous one cached nodes.
+    """
+    hostname = hostname or _hostname()
     nodes_list = nodes_list or []
     # -l grenoble,m3,1 -l grenoble,m3,5
     # [['m3-1.grenoble.iot-lab.info'], ['m3-5.grenoble.iot-lab.info']]
     nodes_list = frozenset(itertools.chain.from_iterable(nodes_list))
     nodes_list = [n.split(".")[0] for n in nodes_list if hostname in n]
-    # try to get currently running experiment
     if exp_id is None:
+        import iotlabcli
+
+        # try to get currently running experiment
         exp_id = iotlabcli.get_current_experiment(api)
-    exp_nodes = experiment.get_experiment(api, exp_id, "nodes")
-    exp_nodes_list = extract_nodes(exp_nodes, hostname)
+    exp_nodes_list = None
+    if cache is not None:
+        exp_nodes_list = cache.get(exp_id, hostname)
+    if exp_nodes_list is None:
+        exp_nodes_list = _query_exp_nodes(api, exp_id, hostname, cache)
     nodes = set(exp_nodes_list).intersection(nodes_list)
     if nodes:
         return sorted(list(nodes))
     return sorted(exp_nodes_list)
 
 
+def _query_exp_nodes(api, exp_id, hostname, cache):
+    """Get experiment nodes with the API, and store them in ``cache``."""
+    from iotlabcli import experiment
+
+    exp_nodes = experiment.get_experiment(api, exp_id, "nodes")
+    exp_nodes_list = extract_nodes(exp_nodes, hostname)
+    if cache is not None:
+        cache.set(exp_id, hostname, exp_nodes_list)
+    return exp_nodes_list
+
+
 def add_nodes_selection_parser(parser):
     """Add parser arguments for selecting nodes"""
 
-    iotlabcli.parser.common.add_auth_arguments(parser)
+    # iotlabcli.parser.common.add_auth_arguments, without importing iotlabcli
+    parser.add_argument("-u", "--user", dest="username")
+    parser.add_argument("-p", "--password", dest="password")
     parser.add_argument(
         "-v", "--version", action="version", version=iotlabaggregator.__version__
     )
@@ -134,18 +266,130 @@ def add_nodes_selection_parser(parser):
         "-l",
         "--list",
         action="append",
-        type=iotlabcli.parser.common.nodes_list_from_str,
+        type=nodes_list_from_str,
         dest="nodes_list",
         help="nodes list",
     )
+    nodes_group.add_argument(
+        "--offline-nodes",
+        metavar="FILE",
+        help=(
+            "select the nodes listed in FILE, without API calls. "
+            "When FILE is missing, save the selected nodes in it"
+        ),
+    )
+    nodes_group.add_argument(
+        "--nodes-cache-ttl",
+        type=float,
+        default=0,
+        metavar="SECONDS",
+        help=(
+            "cache experiments nodes lists for SECONDS in "
+            "~/.cache/iotlabaggregator. Default: 0, no cache"
+        ),
+    )
+    nodes_group.add_argument(
+        "--refresh-nodes",
+        action="store_true",
+        default=False,
+        help="clear the user cached nodes lists before selecting nodes",
+    )
+
+
+def nodes_list_from_str(nodes_list_str):
+    """Parse a nodes list argument with iotlabcli, imported on use."""
+    import iotlabcli.parser.common
 
+    return iotlabcli.parser.common.nodes_list_from_str(nodes_list_str)
 
-def get_nodes_selection(
-    username, password, experiment_id, nodes_list, *_args, **_kwargs
+
+def add_connection_parser(parser):
+    """Add parser arguments for nodes connection"""
+    conn_group = parser.add_argument_group(title="Nodes connection")
+    conn_group.add_argument(
+        "--connect-timeout",
+        type=float,
+        default=None,
+        metavar="SECONDS",
+        help="max time to resolve and connect each node. Default: 10",
+    )
+    conn_group.add_argument(
+        "--hosts-file",
+        metavar="FILE",
+        help=(
+            "select and connect the nodes listed in a hosts format FILE, "
+            "'address node', instead of the experiment nodes"
+        ),
+    )
+    conn_group.add_argument(
+        "--reconnect",
+        action="store_true",
+        default=False,
+        help="reconnect nodes when their connection fails or is closed",
+    )
+
+
+def read_hosts_file(path):
+    """Return ``{node: address}`` from hosts format file ``path``.
+
+    Lines are ``address node [aliases...]``, aliases are ignored.
+    """
+    hosts = {}
+    with open(path, encoding="utf-8") as hosts_file:
+        for line in hosts_file:
+            fields = line.split("#", 1)[0].split()
+            if len(fields) >= 2:
+                hosts[fields[1]] = fields[0]
+    return hosts
+
+
+def read_nodes_file(path):
+    """Return the nodes listed in ``path``, one per line."""
+    with open(path, encoding="utf-8") as nodes_file:
+        nodes = [line.split("#", 1)[0].strip() for line in nodes_file]
+    return sorted(node for node in nodes if node)
+
+
+def write_nodes_file(path, nodes):
+    """Write ``nodes`` in ``path``, one per line."""
+    with open(path, "w", encoding="utf-8") as nodes_file:
+        nodes_file.writelines(f"{node}\n" for node in nodes)
+
+
+def get_nodes_selection(  # pylint:disable=too-many-arguments
+    username,
+    password,
+    experiment_id,
+    nodes_list,
+    *_args,
+    hosts_file=None,
+    offline_nodes=None,
+    nodes_cache_ttl=0,
+    refresh_nodes=False,
+    **_kwargs,
 ):  # pylint:disable=unused-argument
-    """Return the requested nodes from 'experiment_id', and 'nodes_list"""
+    """Return the requested nodes from 'experiment_id', and 'nodes_list'
+
+    With 'hosts_file', return the nodes it lists.
+    With an existing 'offline_nodes' file, return its nodes, else save them.
+    Experiments nodes are cached for 'nodes_cache_ttl' seconds.
+    """
+    if hosts_file:
+        return sorted(read_hosts_file(hosts_file))
+    if offline_nodes and os.path.exists(offline_nodes):
+        return read_nodes_file(offline_nodes)
+    import iotlabcli
+    import iotlabcli.parser.common
+
     username, password = iotlabcli.get_user_credentials(username, password)
+    if refresh_nodes:
+        NodesCache(username, 0).clear()
+    cache = None
+    if nodes_cache_ttl > 0:
+        cache = NodesCache(username, nodes_cache_ttl)
     api = iotlabcli.Api(username, password)
     with iotlabcli.parser.common.catch_missing_auth_cli():
-        nodes = query_nodes(api, experiment_id, nodes_list)
+        nodes = query_nodes(api, experiment_id, nodes_list, cache=cache)
+    if offline_nodes:
+        write_nodes_file(offline_nodes, nodes)
     return nodes
@@ -0,0 +1,301 @@
+#! /usr/bin/env python
+
+# This file is a part of IoT-LAB aggregation-tools
+# Copyright (C) 2015 INRIA (Contact: admin@iot-lab.info)
+# Contributor(s) : see AUTHORS file
+#
+# This software is governed by the CeCILL license under French law
+# and abiding by the rules of distribution of free software.  You can  use,
+# modify and/ or redistribute the software under the terms of the CeCILL
+# license as circulated by CEA, CNRS and INRIA at the following URL
+# http://www.cecill.info.
+#
+# As a counterpart to the access to the source code and  rights to copy,
+# modify and redistribute granted by the license, users are provided only
+# with a limited warranty  and the software's author,  the holder of the
+# economic rights,  and the successive licensors  have only  limited
+# liability.
+#
+# The fact that you are presently reading this means that you have had
+# knowledge of the CeCILL license and that you accept its terms.
+
+"""Compress outputs in a background thread
+
+``CompressedFile`` is a binary file compressing the data written to it in
+a thread, fed by a bounded queue of batches, so the aggregator loop does not
+wait for the compressor. ``gzip`` is always available, ``zstd`` and ``lz4``
+when the ``zstandard`` and ``lz4`` packages are installed.
+"""
+
+import io
+import queue
+import threading
+import time
+import zlib
+
+try:
+    import zstandard
+
+    HAS_ZSTD = True
+except ImportError:
+    HAS_ZSTD = False
+
+try:
+    import lz4.frame
+
+    HAS_LZ4 = True
+except ImportError:
+    HAS_LZ4 = False
+
+_FLUSH = object()
+
+
+class GzipCompressor:
+    """gzip stream compressor."""
+
+    def __init__(self, level=6):
+        self._obj = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+
+    def compress(self, data):
+        """Return compressed ``data``, possibly empty."""
+        return self._obj.compress(data)
+
+    def sync(self):
+        """Return pending compressed data, decompressible up to here."""
+        return self._obj.flush(zlib.Z_SYNC_FLUSH)
+
+    def finish(self):
+        """Return the end of the compressed stream."""
+        return self._obj.flush()
+
+
+class ZstdCompressor(GzipCompressor):
+    """zstd stream compressor."""
+
+    def __init__(self, level=3):  # pylint:disable=super-init-not-called
+        self._obj = zstandard.ZstdCompressor(level=level).compressobj()
+
+    def sync(self):
+        return self._obj.flush(zstandard.COMPRESSOBJ_FLUSH_BLOCK)
+
+
+class Lz4Compressor(GzipCompressor):
+    """lz4 frames compressor, ``sync`` ends the current frame."""
+
+    def __init__(self, level=0):  # pylint:disable=super-init-not-called
+        self._obj = lz4.frame.LZ4FrameCompressor(compression_level=level)
+        self._started = False
+
+    def compress(self, data):
+        header = b""
+        if not self._started:
+            header = self._obj.begin()
+            self._started = True
+        return header + self._obj.compress(data)
+
+    def sync(self):
+        return self.finish()
+
+    def finish(self):
+        if not self._started:
+            return b""
+        self._started = False
+        return self._obj.flush()
+
+
+def _check_length(data, max_length):
+    """Raise ValueError if ``data`` is longer than ``max_length``, if not 0."""
+    if max_length and len(data) > max_length:
+        raise ValueError(f"Decompressed data larger than {max_length} bytes")
+
+
+class GzipDecompressor:
+    """gzip stream decompressor, of ``sync`` delimited chunks."""
+
+    def __init__(self):
+        self._obj = zlib.decompressobj(16 + zlib.MAX_WBITS)
+
+    def decompress(self, data, max_length=0):
+        """Return decompressed ``data``, ValueError if invalid.
+
+        Decompression stops and raises ValueError after ``max_length`` bytes.
+        """
+        try:
+            data = self._obj.decompress(data, max_length and max_length + 1)
+        except zlib.error as err:
+            raise ValueError(f"Invalid compressed data: {err}") from err
+        _check_length(data, max_length)
+        return data
+
+
+class _LimitedBuffer(bytearray):
+    """Decompressed data buffer, ValueError after ``max_length`` bytes."""
+
+    max_length = 0
+
+    def write(self, data):
+        """Append ``data``."""
+        if self.max_length and len(self) + len(data) > self.max_length:
+            raise ValueError(f"Decompressed data larger than {self.max_length} bytes")
+        self.extend(data)
+        return len(data)
+
+
+class ZstdDecompressor(GzipDecompressor):
+    """zstd stream decompressor, output written to a limited buffer."""
+
+    def __init__(self):  # pylint:disable=super-init-not-called
+        self._buff = _LimitedBuffer()
+        self._obj = zstandard.ZstdDecompressor().stream_writer(self._buff)
+
+    def decompress(self, data, max_length=0):
+        self._buff.max_length = max_length
+        try:
+            self._obj.write(data)
+        except zstandard.ZstdError as err:
+            raise ValueError(f"Invalid compressed data: {err}") from err
+        finally:
+            data = bytes(self._buff)
+            self._buff.clear()
+        return data
+
+
+class Lz4Decompressor:  # pylint:disable=too-few-public-methods
+    """lz4 decompressor, chunks are whole frames."""
+
+    @staticmethod
+    def decompress(data, max_length=0):
+        """Return decompressed ``data``, ValueError if invalid.
+
+        Decompression stops and raises ValueError after ``max_length`` bytes.
+        """
+        decompressor = lz4.frame.LZ4FrameDecompressor()
+        try:
+            data = decompressor.decompress(data, max_length + 1 if max_length else -1)
+        except RuntimeError as err:
+            raise ValueError(f"Invalid compressed data: {err}") from err
+        _check_length(data, max_length)
+        return data
+
+
+COMPRESSORS = {"gzip": GzipCompressor}
+DECOMPRESSORS = {"gzip": GzipDecompressor}
+if HAS_ZSTD:
+    COMPRESSORS["zstd"] = ZstdCompressor
+    DECOMPRESSORS["zstd"] = ZstdDecompressor
+if HAS_LZ4:
+    COMPRESSORS["lz4"] = Lz4Compressor
+    DECOMPRESSORS["lz4"] = Lz4Decompressor
+
+
+def add_compress_parser(parser):
+    """Add output compression option to ``parser``."""
+    parser.add_argument(
+        "--compress",
+        choices=sorted(COMPRESSORS),
+        default=None,
+        help="Compress output in a background thread. Default: no compression",
+    )
+
+
+class CompressedFile(io.RawIOBase):
+    """Binary file writing ``method`` compressed data to ``outfile``.
+
+    Written data is compressed and written in a thread, through a queue of
+    at most ``queue_size`` batches, ``write`` only waits when it is full.
+    On ``flush``, compressed data is made readable at most every
+    ``sync_interval`` seconds, to keep a good compression ratio, and at most
+    ``sync_interval`` seconds after the flush.
+    ``outfile`` is not closed.
+    """
+
+    queue_size = 64
+    sync_interval = 1.0
+
+    def __init__(self, outfile, method="gzip"):
+        super().__init__()
+        self.out = outfile
+        self.compressor = COMPRESSORS[method]()
+        self._queue = queue.Queue(self.queue_size)
+        self._error = None
+        self._finished = False
+        self._last_sync = 0.0
+        self._thread = threading.Thread(target=self._run, name="compress", daemon=True)
+        self._thread.start()
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        """Queue ``data`` to compress."""
+        self._check()
+        self._queue.put(bytes(data))
+        return len(data)
+
+    def flush(self):
+        """Request compressed data to be written and flushed."""
+        if not self._finished:
+            self._check()
+            self._queue.put(_FLUSH)
+
+    def close(self):
+        """Compress the queued data and end the compressed stream."""
+        if self.closed:
+            return
+        if not self._finished:
+            self._queue.put(None)
+            self._thread.join()
+            self._finished = True
+        super().close()
+        self._check()
+
+    def _check(self):
+        """Raise the compression thread error."""
+        if self._error is not None:
+            raise OSError(f"Compressed output failed: {self._error}")
+
+    def _next_item(self, deferred):
+        """Return the next queued item, ``_FLUSH`` when a sync is due."""
+        timeout = None
+        if deferred:
+            timeout = max(0.0, self._last_sync + self.sync_interval - time.monotonic())
+        try:
+            return self._queue.get(timeout=timeout)
+        except queue.Empty:
+            return _FLUSH
+
+    def _write_item(self, item, deferred):
+        """Compress ``item`` or sync on ``_FLUSH``, return if a sync is deferred.
+
+        A flush less than ``sync_interval`` after the last sync is deferred
+        until the end of the interval.
+        """
+        if item is not _FLUSH:
+            if data := self.compressor.compress(item):
+                self.out.write(data)
+            return deferred
+        if time.monotonic() - self._last_sync < self.sync_interval:
+            return True
+        self._last_sync = time.monotonic()
+        self.out.write(self.compressor.sync())
+        self.out.flush()
+        return False
+
+    def _run(self):
+        """Compress and write queued data until ``None``."""
+        self._last_sync = time.monotonic()
+        deferred = False
+        while (item := self._next_item(deferred)) is not None:
+            if self._error is not None:
+                deferred = False
+                continue  # Only empty the queue
+            try:
+                deferred = self._write_item(item, deferred)
+            except (OSError, ValueError) as err:
+                self._error = err
+        if self._error is None:
+            try:
+                self.out.write(self.compressor.finish())
+                self.out.flush()
+            except (OSError, ValueError) as err:
+                self._error = err
@@ -21,51 +21,113 @@
 
 """Aggregate multiple tcp connections"""
 
+import collections
+import concurrent.futures
+import contextlib
+import errno
+import functools
+import heapq
+import itertools
 import os
+import random
 import selectors
 import signal
 import socket
 import sys
 import threading
+import time
 
 from iotlabaggregator import LOGGER
+from iotlabaggregator import dispatch as _dispatch
+from iotlabaggregator import metrics as _metrics
+
+
+@functools.cache
+def _zeros(size):
+    """Return ``size`` zero bytes, reused to grow receive buffers."""
+    return bytes(size)
 
 
 class Connection:
     """Handle the connection to one node.
 
+    Received bytes are accumulated in ``data_buff``, a ``bytearray`` filled
+    in place with ``recv_into``.
     Child class should re-implement ``handle_data``.
+
+    Data to send is buffered in ``send_buff``, at most ``max_send_size``
+    bytes, and sent by the aggregator selector loop when the socket is
+    writable.
+
+    ``host`` is the name or address connected to, by default ``hostname``.
+    ``stats`` counts the connection activity, see ``metrics.NodeStats``.
+    ``dispatcher`` is the ``dispatch.Dispatcher`` running slow handlers,
+    or None to run them in the selector loop.
     """
 
     port = 20000
+    recv_size = 8192
+    max_send_size = 1 << 20
+    dispatcher = None
 
     def __init__(self, hostname, aggregator):
         self.hostname = hostname
-        self.data_buff = ""
+        self.host = hostname
+        self.data_buff = bytearray()
+        self.send_buff = bytearray()
         self.aggregator = aggregator
         self._sock = None
-        self._send_lock = threading.Lock()
+        self.connected = False
+        self.stats = _metrics.NodeStats()
 
     def handle_data(self, data):
-        """Dummy handle data."""
+        """Dummy handle data.
+
+        :param data: bytes-like receive buffer, must not be resized
+        :returns: number of bytes consumed from the start of ``data``
+        """
         LOGGER.info("%s received %u bytes", self.hostname, len(data))
-        return ""  # Remaining unprocessed data
+        return len(data)
 
-    def start(self):
-        """Connect to node serial port."""
-        self.data_buff = ""
-        self._sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self._sock.connect((self.hostname, self.port))
+    def resolve(self):
+        """Return node address info. May block, run outside selector loop."""
+        return socket.getaddrinfo(
+            self.host, self.port, socket.AF_INET, socket.SOCK_STREAM
+        )[0]
+
+    def start(self, addrinfo):
+        """Start non-blocking connection to node serial port.
+
+        :param addrinfo: address info tuple as returned by ``resolve``
+        """
+        family, sock_type, proto, _, address = addrinfo
+        self.data_buff.clear()
+        self.send_buff.clear()
+        self.connected = False
+        self._sock = socket.socket(family, sock_type, proto)
+        self._sock.setblocking(False)
+        err = self._sock.connect_ex(address)
+        if err not in (0, errno.EINPROGRESS):
+            raise OSError(err, os.strerror(err))
+
+    def handle_connect(self):
+        """Complete non-blocking connection, raise OSError on failure."""
+        err = self._sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+        if err:
+            raise OSError(err, os.strerror(err))
+        self.connected = True
 
     def handle_close(self):
         """Close the connection and clear buffer."""
-        self.data_buff = ""
+        self.data_buff.clear()
         LOGGER.error("%s;Connection closed", self.hostname)
         self.close()
         self.aggregator.pop(self.hostname, None)
 
     def close(self):
         """Close the underlying socket."""
+        self.connected = False
+        self.send_buff.clear()
         if self._sock is not None:
             try:
                 self._sock.close()
@@ -77,36 +139,165 @@ class Connection:
         """Receive up to n bytes from the socket."""
         return self._sock.recv(n)
 
+    def recv_into(self, buff):
+        """Receive bytes directly into writable ``buff``."""
+        return self._sock.recv_into(buff)
+
     def send(self, data):
-        """Send data to the node."""
-        with self._send_lock:
-            if self._sock is not None:
-                try:
-                    self._sock.sendall(data)
-                except OSError:
-                    pass
+        """Send data to the node, from the aggregator loop. Thread safe."""
+        self.aggregator.send_data([self], data)
+
+    def queue_send(self, data):
+        """Append ``data`` to the send buffer, from the selector loop.
+
+        :raises OSError: not connected or send buffer full
+        """
+        if not self.connected:
+            raise OSError(errno.ENOTCONN, "Not connected")
+        if len(self.send_buff) + len(data) > self.max_send_size:
+            raise OSError(errno.ENOBUFS, "Send buffer full")
+        self.send_buff += data
+
+    def handle_write(self):
+        """Send buffered data, return if the send buffer is empty."""
+        try:
+            sent = self._sock.send(self.send_buff)
+        except BlockingIOError:
+            return False
+        del self.send_buff[:sent]
+        self.stats.tx_bytes += sent
+        return not self.send_buff
 
     def handle_read(self):
-        """Append read bytes to buffer and run data handler."""
-        self.data_buff += self.recv(8192).decode("utf-8", "replace")
-        self.data_buff = self.handle_data(self.data_buff)
+        """Receive bytes at the end of buffer and run data handler.
+
+        The buffer grows by ``recv_size`` and is truncated back to the
+        received length, so data is never copied to be appended.
+        Consumed bytes are removed from the front, which CPython does without
+        moving the remaining data in most cases.
+        """
+        buff = self.data_buff
+        start = end = len(buff)
+        buff.extend(_zeros(self.recv_size))
+        try:
+            with memoryview(buff)[end:] as view:
+                end += self.recv_into(view)
+        except BlockingIOError:
+            return
+        finally:
+            del buff[end:]
+        if end == start:
+            self.handle_eof()
+            return
+        stats = self.stats
+        stats.recv_calls += 1
+        stats.rx_bytes += end - start
+        if end > stats.buffer_max:
+            stats.buffer_max = end
+        del buff[: self.handle_data(buff)]
+
+    def handle_eof(self):
+        """Connection closed by the node."""
+        self.aggregator.connection_lost(self)
 
     def handle_error(self):
         """Log connection error."""
         LOGGER.error("%s;%r", self.hostname, sys.exc_info())
 
 
+class ItemsQueue:
+    """Bounded queue of items put by the selector loop, got by iterators.
+
+    ``put`` waits while ``max_items`` items are queued, so nodes are not
+    read until the iterator catches up. After ``close``, queued items can
+    still be got, new ones are dropped.
+    """
+
+    def __init__(self, max_items):
+        self.max_items = max_items
+        self._cond = threading.Condition()
+        self._items = []
+        self._closed = False
+
+    def put(self, item):
+        """Queue ``item``, wait while the queue is full."""
+        with self._cond:
+            while len(self._items) >= self.max_items and not self._closed:
+                self._cond.wait()
+            if not self._closed:
+                self._items.append(item)
+                self._cond.notify_all()
+
+    def get_all(self, timeout=None):
+        """Return all queued items, waiting for one up to ``timeout``.
+
+        Return an empty list on timeout, None when closed and empty.
+        """
+        with self._cond:
+            self._cond.wait_for(lambda: self._items or self._closed, timeout)
+            if not self._items:
+                return None if self._closed else []
+            items, self._items = self._items, []
+            self._cond.notify_all()
+            return items
+
+    def close(self):
+        """End iteration once the queued items are consumed."""
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+
+
 class Aggregator(dict):
     """Create a dict of Connection from ``nodes_list``.
 
     Each node is stored in the entry with its node_id.
     A background thread runs a selector loop to handle I/O.
     After init, it can be manipulated like a dict.
+
+    ``outputs`` objects are notified by the loop after handling received
+    data with ``idle()``, and flushed on stop with ``flush()``.
+    Their ``timeout`` is the max time the loop may wait between ``idle``
+    calls, or None.
+
+    Messages are sent to nodes by the selector loop, without waiting for
+    slow nodes, each node sending is reported with ``send_done``.
+
+    Received data can also be iterated from another thread, through
+    ``ItemsQueue`` of at most ``items_queue_size`` reads. When all
+    connections are closed, iterations end instead of sending SIGINT.
+
+    :param connect_timeout: max time in seconds to resolve and connect a node
+    :param reconnect: reconnect nodes when their connection is lost or fails,
+        with an exponential backoff delay, from ``reconnect_delay`` to
+        ``reconnect_max_delay``, randomized between half and full delay.
+        Without it, nodes are removed when their connection is closed.
+    :param hosts: ``{node: host}`` addresses to connect nodes to, instead of
+        their name, see ``common.read_hosts_file``
+    :param metrics: ``metrics.MetricsExporter`` arguments to export the nodes
+        metrics, see ``metrics.metrics_options``
+    :param dispatch: ``dispatch.Dispatcher`` arguments to run the connections
+        per item handlers in worker threads, in order for each node
     """
 
     connection_class = Connection
+    connect_timeout = 10.0
+    resolve_workers = 32
+    reconnect_delay = 0.5
+    reconnect_max_delay = 30.0
+    items_queue_size = 1024
 
-    def __init__(self, nodes_list, *args, **kwargs):
+    def __init__(  # pylint:disable=too-many-arguments
+        self,
+        nodes_list,
+        *args,
+        connect_timeout=None,
+        reconnect=False,
+        hosts=None,
+        metrics=None,
+        dispatch=None,
+        **kwargs,
+    ):
         if not nodes_list:
             raise ValueError(
                 f"{self.__class__.__name__}: Empty nodes list {nodes_list!r}"
@@ -115,56 +306,292 @@ class Aggregator(dict):
         self._running = False
         self._selector = selectors.DefaultSelector()
         self.thread = threading.Thread(target=self._loop)
+        self.outputs = []
+        self._items_queues = []
+        if connect_timeout is not None:
+            self.connect_timeout = connect_timeout
+        self.reconnect = reconnect
+
+        # Functions to run in the selector loop
+        self._calls = collections.deque()
+        self._timers = []
+        self._timers_seq = itertools.count()
+        self._wakeup_r = self._wakeup_w = None
+
+        # Nodes connection state and startup report
+        self._resolver = None
+        self._attempts = itertools.count()
+        self._connecting = {}  # node: (attempt, start time)
+        self._failures = {}  # node: consecutive failures
+        self._first_connect = set()
+        self.connect_times = {}
+        self.connect_errors = {}
+
+        hosts = hosts or {}
         for node_url in nodes_list:
             node = self.connection_class(node_url, self, *args, **kwargs)
+            node.host = hosts.get(node_url, node_url)
             self[node_url] = node
 
+        self.dispatcher = None
+        if dispatch is not None:
+            self.dispatcher = _dispatch.Dispatcher(**dispatch)
+            for node in self.values():
+                node.dispatcher = self.dispatcher
+
+        self.metrics = None
+        if metrics is not None:
+            self.metrics = _metrics.MetricsExporter(self, **metrics)
+            self.outputs.append(self.metrics)
+
     def _loop(self):
-        """Run selector loop; send SIGINT when all connections close."""
-        while self._running:
-            events = self._selector.select(timeout=1)
-            for key, mask in events:
-                conn = key.data
-                if mask & selectors.EVENT_READ:
-                    try:
-                        conn.handle_read()
-                    except OSError:
-                        try:
-                            self._selector.unregister(key.fileobj)
-                        except (KeyError, ValueError):
-                            pass
-                        conn.handle_error()
+        """Run selector loop; send SIGINT when all connections close.
+
+        An error, like a failed output, also stops the loop with SIGINT.
+        """
+        idle_timeout = min([1.0] + [out.timeout for out in self.outputs if out.timeout])
+        try:
+            while self._running and self:
+                timeout = idle_timeout
+                if self._timers:
+                    timeout = min(
+                        timeout, max(0, self._timers[0][0] - time.monotonic())
+                    )
+                events = self._selector.select(timeout=timeout)
+                for key, mask in events:
+                    self._handle_event(key, mask)
+                self._run_calls()
+                for out in self.outputs:
+                    out.idle()
+        except Exception:  # pylint:disable=broad-except
+            LOGGER.exception("Selector loop failed")
+            self._close_items_queues()
+            os.kill(os.getpid(), signal.SIGINT)
+            return
         if self._running:
             LOGGER.info("Loop finished, all connections closed")
-            os.kill(os.getpid(), signal.SIGINT)
+            if self._items_queues:
+                self._close_items_queues()
+            else:
+                os.kill(os.getpid(), signal.SIGINT)
+
+    def _handle_event(self, key, mask):
+        """Handle selector event on ``key``."""
+        conn = key.data
+        if conn is None:
+            self._drain_wakeup()
+        elif not conn.connected:
+            self._handle_connect(conn)
+        else:
+            if mask & selectors.EVENT_WRITE:
+                self._handle_write(conn)
+            if mask & selectors.EVENT_READ and conn.connected:
+                try:
+                    conn.handle_read()
+                except OSError:
+                    conn.handle_error()
+                    self.connection_lost(conn)
+
+    def call_soon(self, func, *args):
+        """Run ``func(*args)`` in the selector loop. Thread safe."""
+        self._calls.append((func, args))
+        self._wakeup()
+
+    def call_later(self, delay, func, *args):
+        """Run ``func(*args)`` in the selector loop after ``delay`` seconds.
+
+        Only call it from the selector loop, or before starting it.
+        """
+        when = time.monotonic() + delay
+        heapq.heappush(self._timers, (when, next(self._timers_seq), func, args))
+
+    def _run_calls(self):
+        """Run pending calls and expired timers."""
+        while self._calls:
+            func, args = self._calls.popleft()
+            func(*args)
+        now = time.monotonic()
+        while self._timers and self._timers[0][0] <= now:
+            _, _, func, args = heapq.heappop(self._timers)
+            func(*args)
+
+    def _wakeup(self):
+        """Wake up the selector loop."""
+        if self._wakeup_w is None:
+            return
+        try:
+            self._wakeup_w.send(b"\0")
+        except OSError:
+            pass  # Buffer full, loop will wake up anyway
+
+    def _drain_wakeup(self):
+        """Empty the wake up socket."""
+        try:
+            while self._wakeup_r.recv(4096):
+                pass
+        except OSError:
+            pass
 
     def start(self):
-        """Connect all nodes and start the selector loop thread."""
+        """Connect all nodes and start the selector loop thread.
+
+        Names are resolved in a threads pool and connections are all started
+        at once and completed in the selector loop.
+        Nodes not connected after ``connect_timeout`` are reported failed.
+        """
         self._running = True
+        self._wakeup_r, self._wakeup_w = socket.socketpair()
+        self._wakeup_r.setblocking(False)
+        self._wakeup_w.setblocking(False)
+        self._selector.register(self._wakeup_r, selectors.EVENT_READ, data=None)
+
+        self._resolver = concurrent.futures.ThreadPoolExecutor(
+            min(self.resolve_workers, len(self)), thread_name_prefix="resolve"
+        )
+        self._first_connect = set(self.values())
         for node in self.values():
-            try:
-                node.start()
-            except OSError:
-                node.handle_error()
-                continue
-            if node._sock is not None:
-                self._selector.register(node._sock, selectors.EVENT_READ, data=node)
+            self._start_connect(node)
+
         self.thread.start()
         LOGGER.info("Aggregator started")
 
+    def _start_connect(self, node):
+        """Resolve then connect ``node``, fail after ``connect_timeout``."""
+        attempt = next(self._attempts)
+        self._connecting[node] = (attempt, time.monotonic())
+        self.call_later(self.connect_timeout, self._connect_timeout, node, attempt)
+        future = self._resolver.submit(node.resolve)
+        future.add_done_callback(functools.partial(self._resolved, node, attempt))
+
+    def _is_connecting(self, node, attempt):
+        """Return if ``node`` connection ``attempt`` is in progress."""
+        return self._connecting.get(node, (None,))[0] == attempt
+
+    def _resolved(self, node, attempt, future):
+        """Node name resolution done, connect in the selector loop."""
+        self.call_soon(self._connect, node, attempt, future)
+
+    def _connect(self, node, attempt, future):
+        """Start connecting ``node`` to resolved address."""
+        if not self._is_connecting(node, attempt):
+            return  # Timed out
+        try:
+            node.start(future.result())
+            self._selector.register(node._sock, selectors.EVENT_WRITE, data=node)
+        except OSError as err:
+            self._connect_done(node, err)
+
+    def _handle_connect(self, node):
+        """Node socket is writable, connection is complete."""
+        try:
+            node.handle_connect()
+        except OSError as err:
+            self._connect_done(node, err)
+        else:
+            self._selector.modify(node._sock, selectors.EVENT_READ, data=node)
+            self._connect_done(node)
+
+    def _connect_timeout(self, node, attempt):
+        """Fail ``node`` connection ``attempt`` if still not connected."""
+        if self._is_connecting(node, attempt):
+            err = TimeoutError(errno.ETIMEDOUT, "Connection timed out")
+            self._connect_done(node, err)
+
+    def _connect_done(self, node, err=None):
+        """Save ``node`` connection duration or error, retry if required."""
+        _, start_time = self._connecting.pop(node)
+        duration = time.monotonic() - start_time
+        self.connect_times[node.hostname] = duration
+        if err is None:
+            self.connect_errors.pop(node.hostname, None)
+            self._failures.pop(node, None)
+            LOGGER.debug("%s;Connected in %.3fs", node.hostname, duration)
+        else:
+            self.connect_errors[node.hostname] = err
+            LOGGER.error(
+                "%s;Connection failed after %.3fs: %s", node.hostname, duration, err
+            )
+            self._unregister(node)
+            node.close()
+            if self.reconnect:
+                self._reconnect_later(node)
+
+        if node in self._first_connect:
+            self._first_connect.discard(node)
+            if not self._first_connect:
+                self._connect_report()
+
+    def _connect_report(self):
+        """Log nodes connection summary."""
+        slowest = max(self.connect_times, key=self.connect_times.get)
+        LOGGER.info(
+            "%u/%u nodes connected, failed: %s, slowest: %s (%.3fs)",
+            len(self.connect_times) - len(self.connect_errors),
+            len(self.connect_times),
+            ",".join(sorted(self.connect_errors)) or "none",
+            slowest,
+            self.connect_times[slowest],
+        )
+
+    def connection_lost(self, node):
+        """Handle ``node`` closed connection, reconnect it if enabled.
+
+        Must be called from the selector loop.
+        """
+        self._unregister(node)
+        if not self.reconnect:
+            node.handle_close()
+            return
+        LOGGER.error("%s;Connection lost", node.hostname)
+        node.close()
+        node.data_buff.clear()
+        self._reconnect_later(node)
+
+    def _reconnect_later(self, node):
+        """Schedule ``node`` reconnection with a randomized backoff delay."""
+        failures = self._failures.get(node, 0)
+        self._failures[node] = failures + 1
+        delay = min(self.reconnect_max_delay, self.reconnect_delay * 2**failures)
+        delay = random.uniform(delay / 2, delay)
+        LOGGER.info("%s;Reconnecting in %.1fs", node.hostname, delay)
+        self.call_later(delay, self._reconnect, node)
+
+    def _reconnect(self, node):
+        """Reconnect ``node`` if still managed."""
+        if self._running and self.get(node.hostname) is node:
+            node.stats.reconnects += 1
+            self._start_connect(node)
+
+    def _unregister(self, node):
+        """Remove ``node`` socket from the selector."""
+        if node._sock is None:
+            return
+        try:
+            self._selector.unregister(node._sock)
+        except (KeyError, ValueError):
+            pass
+
     def stop(self):
         """Stop all node connections and the selector loop thread."""
         LOGGER.info("Stopping")
         self._running = False
+        self._close_items_queues()
+        self._wakeup()
+        self.thread.join()
+        if self._resolver is not None:
+            self._resolver.shutdown(wait=False, cancel_futures=True)
         for node in self.values():
-            if node._sock is not None:
-                try:
-                    self._selector.unregister(node._sock)
-                except (KeyError, ValueError):
-                    pass
             node.close()
         self._selector.close()
-        self.thread.join()
+        for sock in (self._wakeup_r, self._wakeup_w):
+            if sock is not None:
+                sock.close()
+        if self.dispatcher is not None:
+            self.dispatcher.close()
+        for out in self.outputs:
+            out.flush()
+        if self.metrics is not None:
+            self.metrics.close()
 
     def run(self):
         """Main function to run."""
@@ -180,26 +607,113 @@ class Aggregator(dict):
     def __exit__(self, _type, _value, _traceback):
         self.stop()
 
+    def iter_items(self, event, convert=None, timeout=None):
+        """Iterate over lists of ``(node, data)`` from nodes ``event`` calls.
+
+        ``event`` is the name of a connection ``Event`` called with
+        ``(identifier, data)`` in the selector loop, ``convert(data)`` is
+        queued. Each list holds the items queued since the previous one, an
+        empty list is returned after ``timeout`` seconds without items.
+
+        Nodes events are handled from this call, before iterating. Call it
+        before ``start`` to get all data, and iterate it until the end.
+        """
+        queue = ItemsQueue(self.items_queue_size)
+
+        def handler(identifier, data):
+            queue.put((identifier, data if convert is None else convert(data)))
+
+        for node in self.values():
+            getattr(node, event).append(handler)
+        self._items_queues.append(queue)
+        return self._iter_queue(queue, event, handler, timeout)
+
+    def _iter_queue(self, queue, event, handler, timeout):
+        """Yield ``queue`` items lists, remove ``handler`` when done."""
+        try:
+            while (items := queue.get_all(timeout)) is not None:
+                yield items
+        finally:
+            queue.close()
+            self._items_queues.remove(queue)
+            self.call_soon(self._remove_handler, event, handler)
+
+    def _remove_handler(self, event, handler):
+        """Remove ``handler`` from nodes ``event``."""
+        for node in self.values():
+            with contextlib.suppress(ValueError):
+                getattr(node, event).remove(handler)
+
+    def _close_items_queues(self):
+        """End items iterations."""
+        for queue in list(self._items_queues):
+            queue.close()
+
     def send_nodes(self, nodes_list, message):
-        """Send ``message`` to ``nodes_list`` nodes; broadcast if None."""
+        """Send ``message`` to ``nodes_list`` nodes; broadcast if None.
+
+        The message is encoded once and sent by the selector loop.
+        """
+        data = message.encode("utf-8", "replace")
         if nodes_list is None:
             LOGGER.debug("Broadcast: %r", message)
-            self.broadcast(message)
+            nodes = list(self.values())
         else:
             LOGGER.debug("Send: %r to %r", message, nodes_list)
-            for node in nodes_list:
-                self._send(node, message)
+            nodes = []
+            for hostname in nodes_list:
+                try:
+                    nodes.append(self[hostname])
+                except KeyError:
+                    LOGGER.warning("Node not managed: %s", hostname)
+        if nodes:
+            self.send_data(nodes, data)
 
     def _send(self, hostname, message):
         """Safely send a message to a single node."""
-        try:
-            self[hostname].send(message.encode("utf-8", "replace"))
-        except KeyError:
-            LOGGER.warning("Node not managed: %s", hostname)
-        except OSError:
-            LOGGER.warning("Send failed: %s", hostname)
+        self.send_nodes([hostname], message)
 
     def broadcast(self, message):
         """Send a message to all nodes."""
-        for node in self.keys():
-            self._send(node, message)
+        self.send_nodes(None, message)
+
+    def send_data(self, nodes, data):
+        """Send ``data`` bytes to ``nodes`` connections. Thread safe."""
+        self.call_soon(self._queue_sends, nodes, bytes(data))
+
+    def _queue_sends(self, nodes, data):
+        """Buffer ``data`` for ``nodes`` and start sending it."""
+        for node in nodes:
+            try:
+                node.queue_send(data)
+            except OSError as err:
+                self.send_done(node, err)
+            else:
+                self._handle_write(node)
+
+    def _handle_write(self, node):
+        """Send ``node`` buffered data, wait for writable socket if needed."""
+        try:
+            done = node.handle_write()
+        except OSError as err:
+            self.send_done(node, err)
+            self.connection_lost(node)
+            return
+        events = selectors.EVENT_READ
+        if not done:
+            events |= selectors.EVENT_WRITE
+        if self._selector.get_key(node._sock).events != events:
+            self._selector.modify(node._sock, events, data=node)
+        if done:
+            self.send_done(node)
+
+    def send_done(self, node, err=None):
+        """``node`` send buffer was sent, or failed with ``err``.
+
+        Run in the selector loop, may be overridden to handle sends results.
+        """
+        if err is None:
+            LOGGER.debug("%s;Sent", node.hostname)
+            return
+        node.stats.send_errors += 1
+        LOGGER.warning("%s;Send failed: %s", node.hostname, err)
@@ -0,0 +1,220 @@
+#! /usr/bin/env python
+
+# This file is a part of IoT-LAB aggregation-tools
+# Copyright (C) 2015 INRIA (Contact: admin@iot-lab.info)
+# Contributor(s) : see AUTHORS file
+#
+# This software is governed by the CeCILL license under French law
+# and abiding by the rules of distribution of free software.  You can  use,
+# modify and/ or redistribute the software under the terms of the CeCILL
+# license as circulated by CEA, CNRS and INRIA at the following URL
+# http://www.cecill.info.
+#
+# As a counterpart to the access to the source code and  rights to copy,
+# modify and redistribute granted by the license, users are provided only
+# with a limited warranty  and the software's author,  the holder of the
+# economic rights,  and the successive licensors  have only  limited
+# liability.
+#
+# The fact that you are presently reading this means that you have had
+# knowledge of the CeCILL license and that you accept its terms.
+
+"""Run slow connections handlers in a threads pool
+
+Handlers are run synchronously by the selector loop by default, so one slow
+handler delays reception for all the nodes. A ``Dispatcher`` runs them in
+worker threads instead: calls of one node are run in order, one at a time,
+calls of different nodes in parallel.
+
+    >>> dispatcher = Dispatcher(workers=2)
+    >>> dispatcher.submit('m3-1', (print,), [('m3-1', 'a'), ('m3-1', 'b')])
+    >>> dispatcher.close()
+    m3-1 a
+    m3-1 b
+    >>> dispatcher.stats[print].calls
+    2
+"""
+
+import collections
+import threading
+import time
+
+from iotlabaggregator import LOGGER
+
+# Queue full policies, as output.QueuedOutput ones
+BLOCK = "block"
+DROP_OLDEST = "drop-oldest"
+DROP_NEWEST = "drop-newest"
+POLICIES = (BLOCK, DROP_OLDEST, DROP_NEWEST)
+
+
+def handler_name(func):
+    """Return ``func`` name used in logs and metrics.
+
+    >>> handler_name(handler_name)
+    'handler_name'
+    >>> handler_name(HandlerStats().__init__)
+    'HandlerStats.__init__'
+    """
+    return getattr(func, "__qualname__", None) or repr(func)
+
+
+class HandlerStats:  # pylint:disable=too-few-public-methods
+    """Counters and timings of one handler."""
+
+    __slots__ = ("calls", "errors", "dropped", "seconds", "max_seconds")
+
+    def __init__(self):
+        self.calls = 0
+        self.errors = 0
+        self.dropped = 0
+        self.seconds = 0.0
+        self.max_seconds = 0.0
+
+
+class Dispatcher:
+    """Run handlers calls in ``workers`` threads, in order for each node.
+
+    Each node has a queue of at most ``queue_size`` pending calls. When full,
+    with ``policy``:
+
+    * ``block``: wait for the workers, reception waits for the handlers
+    * ``drop-oldest``: drop the oldest queued calls of this node
+    * ``drop-newest``: drop the submitted calls
+
+    ``stats`` maps handlers to their ``HandlerStats``. Handlers exceptions
+    are logged and counted, they do not stop the worker.
+    """
+
+    def __init__(self, workers=4, queue_size=1024, policy=BLOCK):
+        if policy not in POLICIES:
+            raise ValueError(f"Invalid queue policy: {policy!r}")
+        if workers < 1:
+            raise ValueError(f"Invalid workers number: {workers!r}")
+        self.queue_size = queue_size
+        self.policy = policy
+        self.stats = collections.defaultdict(HandlerStats)
+        self._cond = threading.Condition()
+        self._queues = {}  # node: deque of (funcs, calls)
+        self._pending = collections.Counter()  # node: queued calls
+        self._ready = collections.deque()  # nodes with calls and no worker
+        self._active = set()  # nodes ready or handled by a worker
+        self._closed = False
+        self._threads = [
+            threading.Thread(target=self._run, name=f"dispatch-{num}", daemon=True)
+            for num in range(workers)
+        ]
+        for thread in self._threads:
+            thread.start()
+
+    def submit(self, node, funcs, calls):
+        """Queue ``calls`` arguments tuples to run with each of ``funcs``.
+
+        For each arguments tuple, ``funcs`` are called in order.
+        """
+        if not (funcs and calls):
+            return
+        funcs = tuple(funcs)
+        with self._cond:
+            if self._closed:
+                raise RuntimeError("Dispatcher closed")
+            queue = self._queues.setdefault(node, collections.deque())
+            # At least one job is accepted, even if bigger than queue_size
+            while queue and self._pending[node] + len(calls) > self.queue_size:
+                if self.policy == DROP_NEWEST:
+                    self._drop(funcs, calls)
+                    return
+                if self.policy == DROP_OLDEST:
+                    dropped = queue.popleft()
+                    self._drop(*dropped)
+                    self._pending[node] -= len(dropped[1])
+                else:
+                    self._cond.wait()
+            queue.append((funcs, calls))
+            self._pending[node] += len(calls)
+            if node not in self._active:
+                self._active.add(node)
+                self._ready.append(node)
+                self._cond.notify_all()
+
+    def _drop(self, funcs, calls):
+        """Count ``calls`` of ``funcs`` as dropped."""
+        for func in funcs:
+            self.stats[func].dropped += len(calls)
+
+    def named_stats(self):
+        """Return ``stats`` by handler name, with their id if not unique.
+
+        >>> dispatcher = Dispatcher(workers=1)
+        >>> dispatcher.submit('m3-1', (print, lambda: 1, lambda: 2), [()])
+        >>> dispatcher.close()
+        <BLANKLINE>
+        >>> sorted(dispatcher.named_stats())  # doctest: +ELLIPSIS
+        ['<lambda>@...', '<lambda>@...', 'print']
+        """
+        with self._cond:
+            handlers = list(self.stats.items())
+        names = collections.Counter(handler_name(func) for func, _ in handlers)
+        named = {}
+        for func, stats in handlers:
+            name = handler_name(func)
+            if names[name] > 1:
+                name = f"{name}@{id(func):x}"
+            named[name] = stats
+        return named
+
+    def close(self):
+        """Run the queued calls and stop the workers threads."""
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+        for thread in self._threads:
+            thread.join()
+
+    def _run(self):
+        """Run the queued calls of ready nodes, one node at a time."""
+        while True:
+            with self._cond:
+                self._cond.wait_for(lambda: self._ready or self._closed)
+                if not self._ready:
+                    return
+                node = self._ready.popleft()
+                jobs = list(self._queues[node])
+                self._queues[node].clear()
+                self._pending[node] = 0
+                self._cond.notify_all()
+            times = [self._call(funcs, calls) for funcs, calls in jobs]
+            with self._cond:
+                if self._queues[node]:
+                    self._ready.append(node)
+                    self._cond.notify_all()
+                else:
+                    self._active.discard(node)
+                for (funcs, calls), job_times in zip(jobs, times):
+                    self._count(funcs, calls, job_times)
+
+    @staticmethod
+    def _call(funcs, calls):
+        """Run ``funcs`` on ``calls``, return their ``(time, max, errors)``."""
+        times = [[0.0, 0.0, 0] for _ in funcs]
+        for args in calls:
+            for func, stats in zip(funcs, times):
+                start = time.perf_counter()
+                try:
+                    func(*args)
+                except Exception:  # pylint:disable=broad-except
+                    LOGGER.exception("Handler %s failed", handler_name(func))
+                    stats[2] += 1
+                elapsed = time.perf_counter() - start
+                stats[0] += elapsed
+                stats[1] = max(stats[1], elapsed)
+        return times
+
+    def _count(self, funcs, calls, times):
+        """Add ``times`` of ``funcs`` run on ``calls`` to ``stats``."""
+        for func, (seconds, max_seconds, errors) in zip(funcs, times):
+            stats = self.stats[func]
+            stats.calls += len(calls)
+            stats.errors += errors
+            stats.seconds += seconds
+            stats.max_seconds = max(stats.max_seconds, max_seconds)
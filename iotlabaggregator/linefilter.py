@@ -0,0 +1,174 @@
+#! /usr/bin/env python
+
+# This file is a part of IoT-LAB aggregation-tools
+# Copyright (C) 2015 INRIA (Contact: admin@iot-lab.info)
+# Contributor(s) : see AUTHORS file
+#
+# This software is governed by the CeCILL license under French law
+# and abiding by the rules of distribution of free software.  You can  use,
+# modify and/ or redistribute the software under the terms of the CeCILL
+# license as circulated by CEA, CNRS and INRIA at the following URL
+# http://www.cecill.info.
+#
+# As a counterpart to the access to the source code and  rights to copy,
+# modify and redistribute granted by the license, users are provided only
+# with a limited warranty  and the software's author,  the holder of the
+# economic rights,  and the successive licensors  have only  limited
+# liability.
+#
+# The fact that you are presently reading this means that you have had
+# knowledge of the CeCILL license and that you accept its terms.
+
+"""Filter serial lines on raw bytes, before decoding them"""
+
+import re
+
+# Regular expressions special characters, other patterns are literals
+SPECIAL = frozenset(b".^$*+?{}[]\\|()")
+
+
+class LineFilter:
+    """Select lines matching any ``grep`` pattern and no ``exclude`` one.
+
+    Patterns are bytes or str regular expressions matched inside each line.
+    Patterns are combined in one regular expression, so all are searched in
+    one pass on the received bytes. With ``grep`` patterns, only the lines
+    where they are found are checked for ``exclude`` ones, else the lines
+    where ``exclude`` patterns are found are dropped, the others are kept in
+    blocks. Regular expressions matches are checked again on their line
+    alone, as a pattern may match across lines.
+    Literal ``grep`` patterns are searched with ``bytes.find``, much faster
+    than a regular expression alternation.
+
+    >>> line_filter = LineFilter(grep=['err', 'warn'], exclude=['debug'])
+    >>> line_filter.filter(b'ok\\nerror 1\\nwarn debug\\nwarning\\n')
+    b'error 1\\nwarning\\n'
+    >>> line_filter.filter(b'ok\\nok\\n')
+    b''
+    >>> LineFilter(exclude=[b'^ok$']).filter(b'ok\\nnok\\n')
+    b'nok\\n'
+    >>> LineFilter(grep=[r'foo\\s+bar']).filter(b'foo\\nbar\\nfoo  bar\\n')
+    b'foo  bar\\n'
+    """
+
+    def __init__(self, grep=(), exclude=()):
+        self.grep = [self._bytes(pattern) for pattern in grep]
+        self.exclude = [self._bytes(pattern) for pattern in exclude]
+        if not (self.grep or self.exclude):
+            raise ValueError("LineFilter: no patterns")
+        self._grep = self._exclude = self._literals = None
+        if self.grep and not any(SPECIAL.intersection(p) for p in self.grep):
+            self._literals = self.grep
+        if self.grep:
+            self._grep = re.compile(self._join(self.grep), re.MULTILINE)
+        if self.exclude:
+            self._exclude = re.compile(self._join(self.exclude), re.MULTILINE)
+
+    @staticmethod
+    def _bytes(pattern):
+        if isinstance(pattern, str):
+            return pattern.encode("utf-8")
+        return pattern
+
+    @staticmethod
+    def _join(patterns):
+        return b"|".join(b"(?:" + pattern + b")" for pattern in patterns)
+
+    def filter(self, data, end=None):
+        """Return the selected lines of ``data[:end]`` complete lines.
+
+        :param data: bytes or bytearray
+        """
+        end = len(data) if end is None else end
+        if self._grep is None:
+            return self._filter_exclude(data, end)
+        selected = []
+        next_match = self._grep_matches(data, end)
+        pos = 0
+        while (match := next_match(pos)) != -1:
+            start = data.rfind(b"\n", 0, match) + 1
+            pos = data.find(b"\n", match, end) + 1
+            if not pos:
+                break  # empty match after the last line
+            # Search without the newline, so '$' only matches the line end
+            if self._literals is None and not self._grep.search(data, start, pos - 1):
+                continue
+            if self._exclude is None or not self._exclude.search(data, start, pos - 1):
+                selected.append(data[start:pos])
+        return b"".join(selected)
+
+    def _filter_exclude(self, data, end):
+        """Return ``data[:end]`` complete lines without ``exclude`` patterns."""
+        search = self._exclude.search
+        selected = []
+        kept = pos = 0
+        while (match := search(data, pos, end)) is not None:
+            start = data.rfind(b"\n", 0, match.start()) + 1
+            pos = data.find(b"\n", match.start(), end) + 1
+            if not pos:
+                break  # empty match after the last line
+            if search(data, start, pos - 1):
+                selected.append(data[kept:start])
+                kept = pos
+        selected.append(data[kept:end])
+        return b"".join(selected)
+
+    def _grep_matches(self, data, end):
+        """Return a function giving the first grep match from ``pos``, or -1."""
+        if self._literals is None:
+            search = self._grep.search
+
+            def next_match(pos):
+                match = search(data, pos, end)
+                return -1 if match is None else match.start()
+
+            return next_match
+
+        # Next position of each literal, only searched again once passed
+        literals = self._literals
+        found = [data.find(literal, 0, end) for literal in literals]
+
+        def next_literal(pos):
+            for index, literal in enumerate(literals):
+                if 0 <= found[index] < pos:
+                    found[index] = data.find(literal, pos, end)
+            return min((i for i in found if i >= 0), default=-1)
+
+        return next_literal
+
+    def __repr__(self):
+        return (
+            f"{self.__class__.__name__}(grep={self.grep!r}, exclude={self.exclude!r})"
+        )
+
+
+def add_filter_parser(parser):
+    """Add lines filter options to ``parser``."""
+    group = parser.add_argument_group(
+        title="Lines filter",
+        description="Lines are filtered on raw bytes, before being handled",
+    )
+    group.add_argument(
+        "--grep",
+        action="append",
+        default=[],
+        metavar="REGEX",
+        help="only keep lines matching REGEX, may be repeated",
+    )
+    group.add_argument(
+        "--exclude",
+        action="append",
+        default=[],
+        metavar="REGEX",
+        help="drop lines matching REGEX, may be repeated",
+    )
+
+
+def line_filter_from_opts(opts):
+    """Return the ``LineFilter`` for parsed ``opts``, or None."""
+    if not (opts.grep or opts.exclude):
+        return None
+    try:
+        return LineFilter(opts.grep, opts.exclude)
+    except re.error as err:
+        raise ValueError(f"Invalid filter pattern: {err}") from err
@@ -0,0 +1,266 @@
+#! /usr/bin/env python
+
+# This file is a part of IoT-LAB aggregation-tools
+# Copyright (C) 2015 INRIA (Contact: admin@iot-lab.info)
+# Contributor(s) : see AUTHORS file
+#
+# This software is governed by the CeCILL license under French law
+# and abiding by the rules of distribution of free software.  You can  use,
+# modify and/ or redistribute the software under the terms of the CeCILL
+# license as circulated by CEA, CNRS and INRIA at the following URL
+# http://www.cecill.info.
+#
+# As a counterpart to the access to the source code and  rights to copy,
+# modify and redistribute granted by the license, users are provided only
+# with a limited warranty  and the software's author,  the holder of the
+# economic rights,  and the successive licensors  have only  limited
+# liability.
+#
+# The fact that you are presently reading this means that you have had
+# knowledge of the CeCILL license and that you accept its terms.
+
+"""Nodes connections live metrics
+
+Each connection counts its activity in a ``NodeStats``, updated in the
+selector loop. ``MetricsExporter`` exports the aggregator nodes counters in
+Prometheus text format, periodically to a file, for the node exporter
+textfile collector, and on each connection to a local UNIX socket:
+
+    $ socat - UNIX-CONNECT:stats.sock
+"""
+
+import os
+import socketserver
+import threading
+import time
+
+from iotlabaggregator import LOGGER
+
+PREFIX = "iotlab_aggregator_node_"
+
+# (counter attribute, metric name, type, help)
+METRICS = (
+    ("rx_bytes", "received_bytes_total", "counter", "Bytes received"),
+    ("recv_calls", "recv_calls_total", "counter", "Socket receive calls"),
+    ("tx_bytes", "sent_bytes_total", "counter", "Bytes sent"),
+    ("lines", "lines_total", "counter", "Serial lines received"),
+    ("packets", "packets_total", "counter", "Sniffer packets received"),
+    ("buffer_max", "buffer_max_bytes", "gauge", "Receive buffer high-water mark"),
+    ("resyncs", "resyncs_total", "counter", "Sniffer stream resynchronizations"),
+    ("skipped", "skipped_bytes_total", "counter", "Bytes skipped on resync"),
+    ("reconnects", "reconnects_total", "counter", "Reconnection attempts"),
+    ("send_errors", "send_errors_total", "counter", "Failed sends to node"),
+)
+
+HANDLER_PREFIX = "iotlab_aggregator_handler_"
+
+# Dispatched handlers (stats attribute, metric name, type, help)
+HANDLER_METRICS = (
+    ("calls", "calls_total", "counter", "Handler calls"),
+    ("errors", "errors_total", "counter", "Handler calls raising an exception"),
+    ("dropped", "dropped_total", "counter", "Handler calls dropped, queue full"),
+    ("seconds", "seconds_total", "counter", "Time spent in handler calls"),
+    ("max_seconds", "max_seconds", "gauge", "Slowest handler call"),
+)
+
+
+class NodeStats:  # pylint:disable=too-few-public-methods,too-many-instance-attributes
+    """Counters of one node connection."""
+
+    __slots__ = tuple(metric[0] for metric in METRICS)
+
+    def __init__(self):
+        for name in self.__slots__:
+            setattr(self, name, 0)
+
+
+def render(nodes):
+    """Return ``nodes`` connections counters in Prometheus text format.
+
+    >>> class Node:
+    ...     hostname = 'm3-1'
+    ...     connected = True
+    ...     stats = NodeStats()
+    >>> Node.stats.rx_bytes = 42
+    >>> text = render([Node])
+    >>> print(text[:text.index('# HELP iotlab_aggregator_node_recv')], end='')
+    # HELP iotlab_aggregator_node_connected Node connected
+    # TYPE iotlab_aggregator_node_connected gauge
+    iotlab_aggregator_node_connected{node="m3-1"} 1
+    # HELP iotlab_aggregator_node_received_bytes_total Bytes received
+    # TYPE iotlab_aggregator_node_received_bytes_total counter
+    iotlab_aggregator_node_received_bytes_total{node="m3-1"} 42
+    """
+    lines = [
+        f"# HELP {PREFIX}connected Node connected",
+        f"# TYPE {PREFIX}connected gauge",
+    ]
+    lines += [
+        f'{PREFIX}connected{{node="{n.hostname}"}} {n.connected:d}' for n in nodes
+    ]
+    for attr, name, kind, text in METRICS:
+        lines.append(f"# HELP {PREFIX}{name} {text}")
+        lines.append(f"# TYPE {PREFIX}{name} {kind}")
+        lines += [
+            f'{PREFIX}{name}{{node="{n.hostname}"}} {getattr(n.stats, attr)}'
+            for n in nodes
+        ]
+    lines.append("")
+    return "\n".join(lines)
+
+
+def render_handlers(stats):
+    """Return dispatched handlers ``{name: HandlerStats}`` in Prometheus format.
+
+    >>> from iotlabaggregator.dispatch import HandlerStats
+    >>> stats = {'print': HandlerStats()}
+    >>> stats['print'].calls = 3
+    >>> text = render_handlers(stats)
+    >>> print(text[:text.index('# HELP iotlab_aggregator_handler_errors')], end='')
+    # HELP iotlab_aggregator_handler_calls_total Handler calls
+    # TYPE iotlab_aggregator_handler_calls_total counter
+    iotlab_aggregator_handler_calls_total{handler="print"} 3
+    """
+    lines = []
+    for attr, name, kind, text in HANDLER_METRICS:
+        lines.append(f"# HELP {HANDLER_PREFIX}{name} {text}")
+        lines.append(f"# TYPE {HANDLER_PREFIX}{name} {kind}")
+        lines += [
+            f'{HANDLER_PREFIX}{name}{{handler="{handler}"}} {getattr(value, attr)}'
+            for handler, value in sorted(stats.items())
+        ]
+    lines.append("")
+    return "\n".join(lines)
+
+
+def add_metrics_parser(parser):
+    """Add metrics export options to ``parser``."""
+    group = parser.add_argument_group(title="Live metrics")
+    group.add_argument(
+        "--metrics-file",
+        metavar="FILE",
+        help="periodically write nodes metrics to FILE in Prometheus format",
+    )
+    group.add_argument(
+        "--metrics-socket",
+        metavar="PATH",
+        help="serve nodes metrics in Prometheus format on UNIX socket PATH",
+    )
+    group.add_argument(
+        "--metrics-interval",
+        type=float,
+        default=MetricsExporter.interval,
+        metavar="SECONDS",
+        help="metrics file update interval. Default: %(default)s",
+    )
+
+
+def metrics_options(opts):
+    """Return ``MetricsExporter`` arguments from parsed ``opts``, or None."""
+    if not (opts.metrics_file or opts.metrics_socket):
+        return None
+    return {
+        "path": opts.metrics_file,
+        "socket_path": opts.metrics_socket,
+        "interval": opts.metrics_interval,
+    }
+
+
+def worker_options(options, index):
+    """Return metrics ``options`` with paths suffixed by worker ``index``.
+
+    >>> worker_options({'path': 'agg.prom', 'socket_path': None}, 1)
+    {'path': 'agg-1.prom', 'socket_path': None}
+    """
+    options = dict(options)
+    for key in ("path", "socket_path"):
+        if options.get(key):
+            root, ext = os.path.splitext(options[key])
+            options[key] = f"{root}-{index}{ext}"
+    return options
+
+
+class _StatsHandler(socketserver.BaseRequestHandler):
+    """Send metrics to the connected client."""
+
+    def handle(self):
+        self.request.sendall(self.server.exporter.render().encode())
+
+
+class MetricsExporter:
+    """Export ``aggregator`` nodes metrics.
+
+    Used as an aggregator output: ``path`` file is written from the selector
+    loop every ``interval`` seconds, and on ``flush``. The file is replaced
+    atomically, write errors are logged once and do not stop the aggregator.
+    ``socket_path`` UNIX socket is served in a thread.
+    """
+
+    interval = 10.0
+
+    def __init__(self, aggregator, path=None, socket_path=None, interval=None):
+        self.aggregator = aggregator
+        self.path = path
+        if interval is not None:
+            self.interval = interval
+        self._next = 0.0
+        self._write_failed = False
+        self._server = None
+        if socket_path is not None:
+            if os.path.exists(socket_path):
+                os.unlink(socket_path)
+            self._server = socketserver.ThreadingUnixStreamServer(
+                socket_path, _StatsHandler
+            )
+            self._server.daemon_threads = True
+            self._server.exporter = self
+            threading.Thread(
+                target=self._server.serve_forever, name="metrics", daemon=True
+            ).start()
+
+    @property
+    def timeout(self):
+        """Max time the aggregator loop may wait before calling ``idle``."""
+        return self.interval if self.path else None
+
+    def render(self):
+        """Return current metrics text."""
+        text = render(list(self.aggregator.values()))
+        dispatcher = getattr(self.aggregator, "dispatcher", None)
+        if dispatcher is not None:
+            text += render_handlers(dispatcher.named_stats())
+        return text
+
+    def idle(self):
+        """Write metrics file if ``interval`` elapsed."""
+        now = time.monotonic()
+        if self.path and now >= self._next:
+            self._next = now + self.interval
+            self.write()
+
+    def flush(self):
+        """Write metrics file."""
+        if self.path:
+            self.write()
+
+    def write(self):
+        """Replace metrics file with current metrics."""
+        tmp_path = f"{self.path}.tmp"
+        try:
+            with open(tmp_path, "w", encoding="utf-8") as metrics_file:
+                metrics_file.write(self.render())
+            os.replace(tmp_path, self.path)
+        except OSError as err:
+            if not self._write_failed:
+                LOGGER.warning("Metrics file not written: %s", err)
+            self._write_failed = True
+        else:
+            self._write_failed = False
+
+    def close(self):
+        """Stop serving metrics socket."""
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            os.unlink(self._server.server_address)
+            self._server = None
@@ -0,0 +1,433 @@
+#! /usr/bin/env python
+
+# This file is a part of IoT-LAB aggregation-tools
+# Copyright (C) 2015 INRIA (Contact: admin@iot-lab.info)
+# Contributor(s) : see AUTHORS file
+#
+# This software is governed by the CeCILL license under French law
+# and abiding by the rules of distribution of free software.  You can  use,
+# modify and/ or redistribute the software under the terms of the CeCILL
+# license as circulated by CEA, CNRS and INRIA at the following URL
+# http://www.cecill.info.
+#
+# As a counterpart to the access to the source code and  rights to copy,
+# modify and redistribute granted by the license, users are provided only
+# with a limited warranty  and the software's author,  the holder of the
+# economic rights,  and the successive licensors  have only  limited
+# liability.
+#
+# The fact that you are presently reading this means that you have had
+# knowledge of the CeCILL license and that you accept its terms.
+
+"""Buffered outputs flushed according to a policy"""
+
+import collections
+import re
+import threading
+import time
+
+from iotlabaggregator import LOGGER
+
+
+class FlushPolicy:
+    """Decide when buffered output is flushed.
+
+    Modes:
+
+    * ``record``: after each record
+    * ``count``: every ``count`` records
+    * ``time``: when the oldest pending record is ``interval`` seconds old
+    * ``idle``: when the aggregator loop has no more data to handle
+
+    With ``count``, pending records are flushed after ``MAX_DELAY`` seconds.
+    """
+
+    RECORD = "record"
+    COUNT = "count"
+    TIME = "time"
+    IDLE = "idle"
+    MAX_DELAY = 1.0
+
+    def __init__(self, mode=RECORD, count=1, interval=0.0):
+        if mode not in (self.RECORD, self.COUNT, self.TIME, self.IDLE):
+            raise ValueError(f"Invalid flush mode: {mode!r}")
+        self.mode = mode
+        self.count = count
+        self.interval = interval
+        if mode == self.COUNT:
+            self.interval = self.MAX_DELAY
+        self.pending = 0
+        self._since = 0.0
+
+    @property
+    def timeout(self):
+        """Max time the loop may wait before calling ``idle``, or None."""
+        return self.interval or None
+
+    @classmethod
+    def from_str(cls, value):
+        """Parse a command line flush policy, None for 'auto'.
+
+        >>> FlushPolicy.from_str('record')
+        FlushPolicy('record')
+        >>> FlushPolicy.from_str('idle')
+        FlushPolicy('idle')
+        >>> FlushPolicy.from_str('100')
+        FlushPolicy('count', count=100)
+        >>> FlushPolicy.from_str('50ms')
+        FlushPolicy('time', interval=0.05)
+        >>> FlushPolicy.from_str('auto') is None
+        True
+        >>> FlushPolicy.from_str('0')
+        Traceback (most recent call last):
+        ...
+        ValueError: Invalid flush policy: '0'
+        """
+        if value == "auto":
+            return None
+        if value in (cls.RECORD, cls.IDLE):
+            return cls(value)
+        match = re.fullmatch(r"([1-9][0-9]*)(ms)?", value)
+        if match is None:
+            raise ValueError(f"Invalid flush policy: {value!r}")
+        if match.group(2):
+            return cls(cls.TIME, interval=int(match.group(1)) / 1000)
+        return cls(cls.COUNT, count=int(match.group(1)))
+
+    @classmethod
+    def auto(cls, stream):
+        """Flush each record on a terminal, else when idle."""
+        try:
+            isatty = stream.isatty()
+        except (AttributeError, ValueError):
+            isatty = False
+        return cls(cls.RECORD if isatty else cls.IDLE)
+
+    def copy(self):
+        """Return a new policy with the same settings, for another output.
+
+        >>> policy = FlushPolicy(FlushPolicy.COUNT, count=10)
+        >>> policy.record()
+        False
+        >>> policy.copy(), policy.copy().pending
+        (FlushPolicy('count', count=10), 0)
+        """
+        return self.__class__(self.mode, self.count, self.interval)
+
+    def record(self, num=1):
+        """Register ``num`` written records, return if flush is required."""
+        if not self.pending:
+            self._since = time.monotonic()
+        self.pending += num
+        if self.mode == self.RECORD:
+            return True
+        if self.mode == self.COUNT and self.pending >= self.count:
+            return True
+        if self.mode == self.TIME:
+            return time.monotonic() - self._since >= self.interval
+        return False
+
+    def idle(self):
+        """Aggregator loop is idle, return if flush is required."""
+        if not self.pending:
+            return False
+        if self.mode == self.IDLE:
+            return True
+        return time.monotonic() - self._since >= self.interval
+
+    def flushed(self):
+        """Output has been flushed."""
+        self.pending = 0
+
+    def __repr__(self):
+        args = [repr(self.mode)]
+        if self.mode == self.COUNT:
+            args.append(f"count={self.count}")
+        if self.mode == self.TIME:
+            args.append(f"interval={self.interval}")
+        return f"{self.__class__.__name__}({', '.join(args)})"
+
+
+def add_flush_parser(parser):
+    """Add flush policy option to ``parser``."""
+    parser.add_argument(
+        "--flush",
+        type=FlushPolicy.from_str,
+        default=None,
+        metavar="POLICY",
+        help=(
+            "Output flush policy: 'record', every N records 'N', "
+            "every T milliseconds 'Tms', when 'idle' or "
+            "'auto' (record on a terminal, else idle). Default: auto"
+        ),
+    )
+
+
+class Output:
+    """Binary output buffered and flushed according to ``policy``.
+
+    Records are accumulated in a buffer and written to ``outfile`` as large
+    writes, at least every ``buffer_size`` bytes.
+    """
+
+    buffer_size = 1 << 16
+
+    def __init__(self, outfile, policy=None):
+        self.out = outfile
+        self.policy = policy or FlushPolicy()
+        self._buff = bytearray()
+
+    @property
+    def timeout(self):
+        """Max time the aggregator loop may wait before calling ``idle``."""
+        return self.policy.timeout
+
+    def write(self, data, records=1, node=None):  # pylint:disable=unused-argument
+        """Write ``data`` containing ``records`` records from ``node``."""
+        self._buff += data
+        if self.policy.record(records):
+            self.flush()
+        elif len(self._buff) >= self.buffer_size:
+            self._write_buffer()
+
+    def idle(self):
+        """Flush if required by policy when aggregator loop is idle."""
+        if self.policy.idle():
+            self.flush()
+
+    def flush(self):
+        """Write buffered data and flush output."""
+        self._write_buffer()
+        self.out.flush()
+        self.policy.flushed()
+
+    def _write_buffer(self):
+        """Write buffered data to output."""
+        if self._buff:
+            data, self._buff = self._buff, bytearray()
+            self.out.write(data)
+
+
+class LineWriter(Output):
+    """Binary output of ``timestamp;prefix line suffix`` text lines.
+
+    Same format as the ``LOG_FMT`` logging output, but all the lines given at
+    once are formatted in one pass without logging records.
+
+    With ``queue``, a ``QueuedOutput`` of this writer, formatted lines are
+    buffered and written by the queue thread.
+    """
+
+    queue = None
+
+    def write_lines(self, lines, prefix="", suffix="", node=None):
+        """Write ``node`` ``lines`` with the current timestamp."""
+        start = f"{time.time():f};{prefix}"
+        end = f"{suffix}\n"
+        text = start + (end + start).join(lines) + end
+        (self.queue or self).write(text.encode("utf-8", "replace"), len(lines), node)
+
+
+def binary_output(stream):
+    """Return the binary buffer of text ``stream``, like ``sys.stdout``.
+
+    Streams without buffer get a wrapper writing decoded bytes to them.
+
+    >>> import io
+    >>> out = binary_output(io.StringIO())
+    >>> out.write('é;a\\n'.encode())
+    5
+    >>> out.stream.getvalue()
+    'é;a\\n'
+    """
+    buffer = getattr(stream, "buffer", None)
+    return TextOutput(stream) if buffer is None else buffer
+
+
+class TextOutput:
+    """Binary output writing utf-8 decoded data to text ``stream``."""
+
+    def __init__(self, stream):
+        self.stream = stream
+
+    def write(self, data):
+        """Write decoded ``data``, return its length."""
+        self.stream.write(str(data, "utf-8", "replace"))
+        return len(data)
+
+    def flush(self):
+        """Flush ``stream``."""
+        self.stream.flush()
+
+    def isatty(self):
+        """Return if ``stream`` is a terminal."""
+        return self.stream.isatty()
+
+
+def add_queue_parser(parser):
+    """Add output queue options to ``parser``."""
+    parser.add_argument(
+        "--output-queue",
+        type=int,
+        default=0,
+        metavar="N",
+        help=(
+            "Write output in a thread, through a queue of N batches, so "
+            "receiving does not wait for a slow output. Default: 0, disabled"
+        ),
+    )
+    parser.add_argument(
+        "--queue-policy",
+        choices=QueuedOutput.POLICIES,
+        default=QueuedOutput.BLOCK,
+        help="When the output queue is full. Default: %(default)s",
+    )
+
+
+def queue_options(opts):
+    """Return ``QueuedOutput`` arguments from parsed ``opts``, or None."""
+    if opts.output_queue <= 0:
+        return None
+    return {"max_batches": opts.output_queue, "policy": opts.queue_policy}
+
+
+class QueuedOutput:
+    """Output stage writing to output ``out`` in a writer thread.
+
+    Written batches are queued, at most ``max_batches``. When full, with
+    ``policy``:
+
+    * ``block``: wait for the writer thread
+    * ``drop-oldest``: drop the oldest queued batch
+    * ``drop-newest``: drop the written batch
+
+    Dropped records are counted by node in ``drops``.
+    ``out`` ``idle`` and ``flush`` are run by the writer thread.
+    When writing to ``out`` fails, the writer thread stops and the error is
+    raised by the next ``write``, ``flush`` or ``close``.
+    """
+
+    BLOCK = "block"
+    DROP_OLDEST = "drop-oldest"
+    DROP_NEWEST = "drop-newest"
+    POLICIES = (BLOCK, DROP_OLDEST, DROP_NEWEST)
+
+    def __init__(self, out, max_batches=1024, policy=BLOCK):
+        if policy not in self.POLICIES:
+            raise ValueError(f"Invalid queue policy: {policy!r}")
+        self.out = out
+        self.max_batches = max_batches
+        self.policy = policy
+        self.drops = collections.Counter()
+        self._queue = collections.deque()
+        self._cond = threading.Condition()
+        self._idle = False
+        self._flushed = []  # flush requests events
+        self._closed = False
+        self._error = None
+        self._thread = threading.Thread(target=self._run, name="output", daemon=True)
+        self._thread.start()
+
+    @property
+    def timeout(self):
+        """The writer thread handles ``out`` timeout."""
+        return None
+
+    def write(self, data, records=1, node=None):
+        """Queue ``data`` containing ``records`` records from ``node``."""
+        item = (bytes(data), records, node)
+        with self._cond:
+            self._check()
+            if self._closed:
+                raise ValueError("Write to closed output queue")
+            if len(self._queue) >= self.max_batches:
+                if self.policy == self.DROP_NEWEST:
+                    self.drops[node] += records
+                    return
+                if self.policy == self.DROP_OLDEST:
+                    _, dropped, dropped_node = self._queue.popleft()
+                    self.drops[dropped_node] += dropped
+                else:
+                    self._cond.wait_for(
+                        lambda: len(self._queue) < self.max_batches or self._error
+                    )
+                    self._check()
+            self._queue.append(item)
+            self._cond.notify_all()
+
+    def idle(self):
+        """Let the writer thread run ``out.idle`` once the queue is written."""
+        if not self._idle:
+            with self._cond:
+                self._idle = True
+                self._cond.notify_all()
+
+    def flush(self):
+        """Wait until queued data is written and ``out`` flushed."""
+        done = threading.Event()
+        with self._cond:
+            self._check()
+            if self._closed:
+                return
+            self._flushed.append(done)
+            self._cond.notify_all()
+        done.wait()
+        self._check()
+
+    def close(self):
+        """Write the queued data, flush ``out`` and stop the writer thread."""
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+        self._thread.join()
+        self._check()
+
+    def _check(self):
+        """Raise the writer thread error."""
+        if self._error is not None:
+            raise OSError(f"Output queue failed: {self._error}") from self._error
+
+    def _run(self):
+        """Write queued batches to ``out`` until closed or failed."""
+        try:
+            while self._write_batches():
+                pass
+        except Exception as err:  # pylint:disable=broad-except
+            with self._cond:
+                self._error = err
+                self._queue.clear()
+                flushed, self._flushed = self._flushed, []
+                self._cond.notify_all()
+            for done in flushed:
+                done.set()
+
+    def _write_batches(self):
+        """Write queued batches, return False once closed."""
+        with self._cond:
+            self._cond.wait_for(
+                lambda: self._queue or self._idle or self._flushed or self._closed,
+                self.out.timeout,
+            )
+            batches, self._queue = self._queue, collections.deque()
+            flushed, self._flushed = self._flushed, []
+            closed = self._closed
+            self._idle = False
+            self._cond.notify_all()
+        for data, records, node in batches:
+            self.out.write(data, records, node)
+        if flushed or closed:
+            self.out.flush()
+            for done in flushed:
+                done.set()
+        else:
+            self.out.idle()
+        return not closed
+
+    def report(self):
+        """Log dropped records by node."""
+        if self.drops:
+            LOGGER.warning(
+                "Output queue: %u records dropped: %s",
+                sum(self.drops.values()),
+                ", ".join(f"{node}={num}" for node, num in sorted(self.drops.items())),
+            )
@@ -0,0 +1,277 @@
+#! /usr/bin/env python
+
+# This file is a part of IoT-LAB aggregation-tools
+# Copyright (C) 2015 INRIA (Contact: admin@iot-lab.info)
+# Contributor(s) : see AUTHORS file
+#
+# This software is governed by the CeCILL license under French law
+# and abiding by the rules of distribution of free software.  You can  use,
+# modify and/ or redistribute the software under the terms of the CeCILL
+# license as circulated by CEA, CNRS and INRIA at the following URL
+# http://www.cecill.info.
+#
+# As a counterpart to the access to the source code and  rights to copy,
+# modify and redistribute granted by the license, users are provided only
+# with a limited warranty  and the software's author,  the holder of the
+# economic rights,  and the successive licensors  have only  limited
+# liability.
+#
+# The fact that you are presently reading this means that you have had
+# knowledge of the CeCILL license and that you accept its terms.
+
+"""Compact binary recording of serial lines, with a time and node index
+
+File format, little endian:
+
+* file header: ``MAGIC``
+* records: ``RECORD`` header ``(tag, node_id, timestamp_ns, length)`` then
+  ``length`` bytes of data, tags are:
+
+  * ``L``: one raw line, without newline
+  * ``N``: node ``node_id`` name, written before its first line
+  * ``I``: json index entry of the previous chunk of records
+  * ``X``: json trailer index, nodes names table and all chunks entries
+
+* footer: ``FOOTER`` ``(trailer_offset, FOOTER_MAGIC)``
+
+Records are grouped by chunks of ``index_interval`` bytes, each chunk index
+entry is ``[offset, first_ts, last_ts, node_ids]``.
+When the trailer is missing, the index is rebuilt by reading all records.
+
+Print a recording as ``timestamp;node;line``:
+
+    $ python -m iotlabaggregator.record FILE [--start T] [--end T] [--node N]
+"""
+
+import argparse
+import json
+import struct
+import sys
+import time
+
+from iotlabaggregator import output
+
+MAGIC = b"IOTLREC1"
+RECORD = struct.Struct("<cHqI")
+FOOTER = struct.Struct("<Q8s")
+FOOTER_MAGIC = b"IOTLIDX1"
+
+LINE = b"L"
+NODE = b"N"
+INDEX = b"I"
+TRAILER = b"X"
+
+
+class RecordWriter(output.Output):
+    """Write lines records to binary ``outfile``, buffered with ``policy``.
+
+    An index entry is written every ``index_interval`` bytes of records,
+    ``close`` writes the trailer index.
+    """
+
+    index_interval = 4 << 20
+
+    def __init__(self, outfile, policy=None):
+        super().__init__(outfile, policy)
+        self.nodes = {}
+        self.index = []
+        self._pos = 0
+        self._chunk = None
+        self._write_raw(MAGIC)
+
+    def write_lines(self, node, data):
+        """Write complete lines ``data`` received from ``node``."""
+        node_id = self.nodes.get(node)
+        if node_id is None:
+            node_id = self._add_node(node)
+        timestamp = time.time_ns()
+        lines = bytes(data).split(b"\n")
+        del lines[-1]  # after last newline
+        pack = RECORD.pack
+        records = b"".join(
+            [pack(LINE, node_id, timestamp, len(line)) + line for line in lines]
+        )
+        if self._chunk is None:
+            self._chunk = [self._pos, timestamp, timestamp, set()]
+        self._chunk[2] = timestamp
+        self._chunk[3].add(node_id)
+        self._write_raw(records, len(lines))
+        if self._pos - self._chunk[0] >= self.index_interval:
+            self._end_chunk()
+
+    def close(self):
+        """Write trailer index and flush."""
+        self._end_chunk()
+        trailer_offset = self._pos
+        names = sorted(self.nodes, key=self.nodes.get)
+        self._write_record(TRAILER, {"nodes": names, "chunks": self.index})
+        self._write_raw(FOOTER.pack(trailer_offset, FOOTER_MAGIC))
+        self.flush()
+
+    def _add_node(self, node):
+        """Intern ``node`` name."""
+        node_id = self.nodes[node] = len(self.nodes)
+        name = node.encode()
+        self._write_raw(RECORD.pack(NODE, node_id, 0, len(name)) + name, 0)
+        return node_id
+
+    def _end_chunk(self):
+        """Write current chunk index entry."""
+        if self._chunk is None:
+            return
+        offset, first_ts, last_ts, nodes = self._chunk
+        entry = [offset, first_ts, last_ts, sorted(nodes)]
+        self.index.append(entry)
+        self._chunk = None
+        self._write_record(INDEX, entry)
+
+    def _write_record(self, tag, value):
+        data = json.dumps(value, separators=(",", ":")).encode()
+        self._write_raw(RECORD.pack(tag, 0, 0, len(data)) + data, 0)
+
+    def _write_raw(self, data, records=0):
+        self._pos += len(data)
+        self.write(data, records)
+
+
+class RecordReader:
+    """Read a lines recording file ``path``.
+
+    Use the file index to only read the chunks of the selected time range
+    and nodes.
+    """
+
+    block_size = 1 << 20
+
+    def __init__(self, path):
+        self._file = open(path, "rb")  # pylint:disable=consider-using-with
+        if self._file.read(len(MAGIC)) != MAGIC:
+            self._file.close()
+            raise ValueError(f"Not a lines recording: {path}")
+        self.nodes = []
+        self.index = []
+        self._end = self._file.seek(0, 2)
+        if not self._read_trailer():
+            self._scan_index()
+
+    def close(self):
+        """Close the file."""
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, _type, _value, _traceback):
+        self.close()
+
+    def lines(self, start=None, end=None, nodes=None):
+        """Iterate over ``(timestamp_ns, node, line)`` records.
+
+        :param start: min timestamp in nanoseconds
+        :param end: max timestamp in nanoseconds
+        :param nodes: only these nodes names
+        """
+        node_ids = None
+        if nodes is not None:
+            node_ids = {i for i, name in enumerate(self.nodes) if name in nodes}
+        for offset, chunk_end in self._chunks(start, end, node_ids):
+            for tag, node_id, timestamp, data in self._records(offset, chunk_end):
+                if tag != LINE or (start is not None and timestamp < start):
+                    continue
+                if end is not None and timestamp > end:
+                    return
+                if node_ids is None or node_id in node_ids:
+                    yield timestamp, self.nodes[node_id], data
+
+    def _chunks(self, start, end, node_ids):
+        """Iterate over ``(offset, end)`` of the chunks matching selection."""
+        chunks_ends = [entry[0] for entry in self.index[1:]] + [self._data_end]
+        for entry, chunk_end in zip(self.index, chunks_ends):
+            offset, first_ts, last_ts, chunk_nodes = entry
+            if end is not None and first_ts > end:
+                return
+            if start is not None and last_ts < start:
+                continue
+            if node_ids is None or not node_ids.isdisjoint(chunk_nodes):
+                yield offset, chunk_end
+
+    def _records(self, offset, end):
+        """Iterate over records in file from ``offset`` to ``end``."""
+        self._file.seek(offset)
+        remaining = end - offset
+        data, pos = b"", 0
+        while True:
+            needed = RECORD.size
+            if pos + RECORD.size <= len(data):
+                tag, node_id, timestamp, length = RECORD.unpack_from(data, pos)
+                needed += length
+                if pos + needed <= len(data):
+                    pos += RECORD.size
+                    yield tag, node_id, timestamp, data[pos : pos + length]
+                    pos += length
+                    continue
+            if not remaining:
+                return  # end of data, or truncated record
+            block = self._file.read(min(remaining, max(self.block_size, needed)))
+            if not block:
+                return
+            remaining -= len(block)
+            data, pos = data[pos:] + block, 0
+
+    def _read_trailer(self):
+        """Read trailer index, return False if not found."""
+        if self._end < len(MAGIC) + FOOTER.size:
+            return False
+        self._file.seek(self._end - FOOTER.size)
+        offset, magic = FOOTER.unpack(self._file.read(FOOTER.size))
+        if magic != FOOTER_MAGIC:
+            return False
+        for tag, _, _, data in self._records(offset, self._end - FOOTER.size):
+            if tag == TRAILER:
+                trailer = json.loads(data)
+                self.nodes, self.index = trailer["nodes"], trailer["chunks"]
+                self._data_end = offset
+                return True
+        return False
+
+    def _scan_index(self):
+        """Rebuild the index from all records, for unfinished recordings."""
+        self._data_end = self._end
+        chunk = None
+        pos = len(MAGIC)
+        for tag, node_id, timestamp, data in self._records(pos, self._end):
+            if tag == NODE:
+                self.nodes.append(data.decode())
+            elif tag == LINE:
+                if chunk is None:
+                    chunk = [pos, timestamp, timestamp, set()]
+                chunk[2] = timestamp
+                chunk[3].add(node_id)
+            elif tag == INDEX and chunk is not None:
+                self.index.append(chunk)
+                chunk = None
+            pos += RECORD.size + len(data)
+        if chunk is not None:
+            self.index.append(chunk)
+
+
+def main(args=None):
+    """Print a lines recording as 'timestamp;node;line' text."""
+    parser = argparse.ArgumentParser(description=main.__doc__)
+    parser.add_argument("file", help="Recording file")
+    parser.add_argument("--start", type=float, help="Start unix timestamp")
+    parser.add_argument("--end", type=float, help="End unix timestamp")
+    parser.add_argument("--node", action="append", help="Only these nodes")
+    opts = parser.parse_args(args)
+
+    start = None if opts.start is None else int(opts.start * 1e9)
+    end = None if opts.end is None else int(opts.end * 1e9)
+    out = sys.stdout.buffer
+    with RecordReader(opts.file) as reader:
+        for timestamp, node, line in reader.lines(start, end, opts.node):
+            out.write(b"%.6f;%s;%s\n" % (timestamp / 1e9, node.encode(), line))
+    out.flush()
+
+
+if __name__ == "__main__":
+    main()
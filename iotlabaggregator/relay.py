@@ -0,0 +1,504 @@
+#! /usr/bin/env python
+
+# This file is a part of IoT-LAB aggregation-tools
+# Copyright (C) 2015 INRIA (Contact: admin@iot-lab.info)
+# Contributor(s) : see AUTHORS file
+#
+# This software is governed by the CeCILL license under French law
+# and abiding by the rules of distribution of free software.  You can  use,
+# modify and/ or redistribute the software under the terms of the CeCILL
+# license as circulated by CEA, CNRS and INRIA at the following URL
+# http://www.cecill.info.
+#
+# As a counterpart to the access to the source code and  rights to copy,
+# modify and redistribute granted by the license, users are provided only
+# with a limited warranty  and the software's author,  the holder of the
+# economic rights,  and the successive licensors  have only  limited
+# liability.
+#
+# The fact that you are presently reading this means that you have had
+# knowledge of the CeCILL license and that you accept its terms.
+
+"""Relay site aggregators output to a central aggregator
+
+For multi-sites experiments, a relay runs on each site server: it aggregates
+the site nodes, like a worker process, and forwards their output to the
+central aggregator on one TCP connection. The central aggregator merges all
+relays output in one serial stream or pcap file:
+
+    central$ relay_aggregator --listen 0.0.0.0:20200 -o -
+    grenoble$ serial_aggregator --relay central.example.org:20200
+    lille$ serial_aggregator --relay central.example.org:20200
+
+Relays are not authenticated: the central aggregator listens on localhost by
+default, only listen on a trusted network interface.
+
+Messages are frames of a tag byte and a payload length, ``!cI``.
+From a relay, the workers messages, after a ``R`` hello message:
+
+* ``R``: json ``{"records": output records function, "nodes": [...],
+  "compress": data compression method or null, "link": pcap link type or
+  null}``, relays with another output format than the first one are rejected
+* ``H``: output header, only the first one is written
+* ``D``: chunk of whole records, compressed as one sync flushed block, at
+  most ``MAX_FRAME_SIZE`` bytes once decompressed
+* ``E``: end of relay, json encoded counters
+
+From the central aggregator, ``C`` json encoded commands: ``[nodes_list,
+message]`` to send to nodes, or ``null`` to stop the relay.
+
+Flow control relies on TCP: the central aggregator reads a relay when its
+output accepted the previous data, and a relay waits for the connection to
+accept data, or drops batches with ``--output-queue`` policies.
+"""
+
+import argparse
+import collections
+import contextlib
+import json
+import os
+import selectors
+import signal
+import socket
+import struct
+import sys
+import threading
+import time
+
+from iotlabaggregator import LOGGER, compress, output, reorder, workers
+
+# serial is only imported for central aggregator input, it imports this module
+# pylint:disable=import-outside-toplevel
+
+FRAME = struct.Struct("!cI")
+HELLO = b"R"
+COMMAND = b"C"
+MAX_FRAME_SIZE = 1 << 24
+DEFAULT_PORT = 20200
+
+# Records splitters relays may use
+RECORDS = {
+    "lines_records": reorder.lines_records,
+    "pcap_records": reorder.pcap_records,
+}
+
+
+def address(value):
+    """Parse a ``[HOST:]PORT`` address.
+
+    >>> address('central.example.org:20200')
+    ('central.example.org', 20200)
+    >>> address('20200')
+    ('', 20200)
+    >>> address('[::1]:20200')
+    ('::1', 20200)
+    >>> address('central:port')
+    Traceback (most recent call last):
+    ...
+    argparse.ArgumentTypeError: Invalid address: 'central:port'
+    """
+    host, _, port = value.rpartition(":")
+    try:
+        port = int(port)
+    except ValueError:
+        port = -1
+    if not 0 <= port <= 0xFFFF:
+        raise argparse.ArgumentTypeError(f"Invalid address: {value!r}")
+    return host.strip("[]"), port
+
+
+def frame(tag, payload=b""):
+    """Return ``tag`` frame of ``payload``."""
+    return FRAME.pack(tag, len(payload)) + payload
+
+
+def read_frames(buff):
+    """Return complete ``(tag, payload)`` frames, remove them from ``buff``.
+
+    >>> buff = bytearray(frame(b'D', b'data') + frame(b'E', b'{}')[:3])
+    >>> read_frames(buff)
+    [(b'D', b'data')]
+    >>> len(buff)
+    3
+    """
+    frames, offset = [], 0
+    while len(buff) - offset >= FRAME.size:
+        tag, length = FRAME.unpack_from(buff, offset)
+        if length > MAX_FRAME_SIZE:
+            raise ValueError(f"Frame too large: {length}")
+        end = offset + FRAME.size + length
+        if end > len(buff):
+            break
+        frames.append((tag, bytes(buff[offset + FRAME.size : end])))
+        offset = end
+    del buff[:offset]
+    return frames
+
+
+def add_relay_parser(parser):
+    """Add relay mode options to ``parser``."""
+    relay_group = parser.add_argument_group(title="Relay")
+    relay_group.add_argument(
+        "--relay",
+        type=address,
+        metavar="HOST:PORT",
+        help=(
+            "forward the nodes output to the central 'relay_aggregator' "
+            "listening on HOST:PORT, instead of writing it"
+        ),
+    )
+    relay_group.add_argument(
+        "--relay-compress",
+        choices=sorted(compress.COMPRESSORS),
+        default=None,
+        help="Compress forwarded output. Default: no compression",
+    )
+
+
+class RelayConnection:
+    """Relay connection to the central aggregator.
+
+    Provides the pipe methods used by ``workers.run_worker``: output messages
+    are sent as frames, ``compress`` method compressing data, and commands
+    are received from frames.
+    """
+
+    def __init__(self, sock, compress_method=None):
+        self.sock = sock
+        self._compressor = None
+        if compress_method:
+            self._compressor = compress.COMPRESSORS[compress_method]()
+        self._buff = bytearray()
+        self._commands = collections.deque()
+
+    @classmethod
+    def connect(  # pylint:disable=too-many-arguments
+        cls, central, records, nodes_list, compress_method=None, link=None, timeout=10
+    ):
+        """Connect to ``central`` address and send the relay hello."""
+        sock = socket.create_connection(central, timeout)
+        sock.settimeout(None)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        hello = {
+            "records": records,
+            "nodes": nodes_list,
+            "compress": compress_method,
+            "link": link,
+        }
+        sock.sendall(frame(HELLO, json.dumps(hello).encode()))
+        return cls(sock, compress_method)
+
+    def send_bytes(self, message):
+        """Send one tagged workers ``message``."""
+        tag, payload = bytes(message[:1]), bytes(message[1:])
+        if tag == workers.DATA and self._compressor is not None:
+            payload = self._compressor.compress(payload) + self._compressor.sync()
+        self.sock.sendall(frame(tag, payload))
+
+    def recv(self):
+        """Return the next command, raise EOFError when the central ended."""
+        while not self._commands:
+            data = self.sock.recv(4096)
+            if not data:
+                raise EOFError
+            self._buff += data
+            for tag, payload in read_frames(self._buff):
+                if tag == COMMAND:
+                    self._commands.append(json.loads(payload))
+        return self._commands.popleft()
+
+    def close(self):
+        """Close the connection."""
+        self.sock.close()
+
+
+def run_relay(aggregator_class, nodes_list, central, relay_compress=None, **kwargs):
+    """Run ``aggregator_class`` on ``nodes_list``, output sent to ``central``.
+
+    ``kwargs`` are given to the aggregator, until the central aggregator
+    stops the relay or the aggregator is interrupted.
+    """
+    records = aggregator_class.output_records.__name__
+    link = aggregator_class.output_link(**kwargs)
+    try:
+        conn = RelayConnection.connect(
+            central, records, nodes_list, relay_compress, link
+        )
+    except OSError as err:
+        raise RuntimeError(f"Relay connection failed: {err}") from err
+    LOGGER.info("Relaying %u nodes to %s:%u", len(nodes_list), *central)
+    workers.run_worker(conn, aggregator_class, nodes_list, kwargs, LOGGER.level)
+
+
+class RelayPeer:  # pylint:disable=too-few-public-methods
+    """Central aggregator side of a relay connection."""
+
+    def __init__(self, sock, peer_address):
+        self.sock = sock
+        host, port = peer_address[:2]
+        self.name = f"{host}:{port}"
+        self.buff = bytearray()
+        self.nodes = ()
+        self.decompressor = None
+        self.hello = False
+
+    def command(self, command):
+        """Send ``command`` to the relay, ignore ended relays."""
+        try:
+            self.sock.sendall(frame(COMMAND, json.dumps(command).encode()))
+        except OSError:
+            pass
+
+
+class RelayServer(dict):
+    """Central aggregator merging relays output in binary ``outfd``.
+
+    Relays connect to ``listen`` address, each node entry is its relay.
+    With ``reorder_window``, merged records are ordered by timestamp.
+    After ``relays`` relays ended, SIGINT is sent to stop the process.
+    """
+
+    recv_size = 1 << 16
+    stop_timeout = 5.0
+
+    def __init__(
+        self, listen, outfd, flush_policy=None, reorder_window=None, relays=None
+    ):
+        super().__init__()
+        family = socket.AF_INET6 if ":" in listen[0] else socket.AF_INET
+        self._listener = socket.create_server(listen, family=family)
+        self.address = self._listener.getsockname()[:2]
+        self.out = output.Output(outfd, flush_policy)
+        self.reorder = None
+        self._reorder_window = reorder_window
+        self._records_out = self.out
+        self.records = None
+        self.link = None
+        self.relays = relays
+        self.ended = 0
+        self.rx_packets = 0
+        self._header = None
+        self._peers = {}
+        self._selector = selectors.DefaultSelector()
+        self._selector.register(self._listener, selectors.EVENT_READ)
+        self.thread = threading.Thread(target=self._loop, daemon=True)
+        self._running = False
+        self._deadline = None
+
+    def start(self):
+        """Start accepting relays."""
+        self._running = True
+        self.thread.start()
+        LOGGER.info("Waiting relays on %s:%u", *self.address)
+
+    def _loop(self):
+        """Handle relays until stopped and relays ended or timed out."""
+        while self._running or (self._peers and time.monotonic() < self._deadline):
+            timeout = min(filter(None, [1.0, self._records_out.timeout]))
+            for key, _ in self._selector.select(timeout):
+                if key.data is None:
+                    self._accept()
+                else:
+                    self._read(key.data)
+            self._records_out.idle()
+        for peer in list(self._peers.values()):
+            self._close_peer(peer)
+        self._selector.close()
+        self._listener.close()
+
+    def _accept(self):
+        """Accept a relay connection."""
+        try:
+            sock, peer_address = self._listener.accept()
+        except OSError:
+            return
+        peer = RelayPeer(sock, peer_address)
+        self._peers[sock] = peer
+        self._selector.register(sock, selectors.EVENT_READ, data=peer)
+        if not self._running:
+            peer.command(None)
+
+    def _read(self, peer):
+        """Read ``peer`` frames, close it on end or protocol error."""
+        try:
+            data = peer.sock.recv(self.recv_size)
+        except OSError:
+            data = b""
+        if not data:
+            self._close_peer(peer)
+            return
+        peer.buff += data
+        try:
+            for tag, payload in read_frames(peer.buff):
+                self._handle_frame(peer, tag, payload)
+        except (ValueError, KeyError, TypeError) as err:
+            LOGGER.error("Relay %s: invalid message: %s", peer.name, err)
+            self._close_peer(peer)
+
+    def _handle_frame(self, peer, tag, payload):
+        """Handle one ``peer`` frame."""
+        if tag == HELLO:
+            self._hello(peer, json.loads(payload))
+        elif not peer.hello:
+            raise ValueError("no hello")
+        elif tag == workers.DATA:
+            if peer.decompressor is not None:
+                payload = peer.decompressor.decompress(payload, MAX_FRAME_SIZE)
+            self._records_out.write(payload, node=peer.name)
+        elif tag == workers.HEADER and self._header is None:
+            self._header = payload
+            self.out.write(payload)
+            self.out.flush()
+        elif tag == workers.END:
+            self.rx_packets += json.loads(payload)["rx_packets"]
+
+    def _hello(self, peer, hello):
+        """Register ``peer`` relay ``hello`` nodes and output format."""
+        records = RECORDS[hello["records"]]
+        link = hello.get("link")
+        if self.records is None:
+            self.records = records
+            self.link = link
+            if self._reorder_window:
+                self.reorder = reorder.ReorderOutput(
+                    self.out, self._reorder_window, records
+                )
+                self._records_out = self.reorder
+        elif records is not self.records:
+            raise ValueError(f"output {hello['records']} differs from other relays")
+        elif link != self.link:
+            raise ValueError(f"link type {link} differs from other relays")
+        if hello["compress"]:
+            peer.decompressor = compress.DECOMPRESSORS[hello["compress"]]()
+        peer.nodes = hello["nodes"]
+        peer.hello = True
+        self.update(dict.fromkeys(peer.nodes, peer))
+        LOGGER.info("Relay %s: %u nodes", peer.name, len(peer.nodes))
+
+    def _close_peer(self, peer):
+        """Close ``peer`` connection, stop when all ``relays`` ended."""
+        self._selector.unregister(peer.sock)
+        peer.sock.close()
+        del self._peers[peer.sock]
+        for node in peer.nodes:
+            if self.get(node) is peer:
+                del self[node]
+        if not peer.hello:
+            return
+        LOGGER.info("Relay %s ended", peer.name)
+        self.ended += 1
+        if self._running and self.relays and self.ended >= self.relays:
+            LOGGER.info("All relays ended")
+            os.kill(os.getpid(), signal.SIGINT)
+
+    def stop(self):
+        """Stop relays, wait for their remaining output and flush it."""
+        LOGGER.info("Stopping")
+        self._deadline = time.monotonic() + self.stop_timeout
+        self._running = False
+        for peer in list(self._peers.values()):
+            peer.command(None)
+        self.thread.join()
+        self._records_out.flush()
+
+    def run(self):
+        """Main function to run."""
+        try:
+            signal.pause()
+        except KeyboardInterrupt:
+            pass
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, _type, _value, _traceback):
+        self.stop()
+
+    def send_nodes(self, nodes_list, message):
+        """Send ``message`` to ``nodes_list`` nodes; broadcast if None."""
+        if nodes_list is None:
+            self.broadcast(message)
+            return
+        shards = {}
+        for node in nodes_list:
+            try:
+                shards.setdefault(self[node], []).append(node)
+            except KeyError:
+                LOGGER.warning("Node not managed: %s", node)
+        for peer, nodes in shards.items():
+            peer.command((nodes, message))
+
+    def broadcast(self, message):
+        """Send a message to all nodes."""
+        for peer in list(self._peers.values()):
+            if peer.hello:
+                peer.command((None, message))
+
+
+def main(args=None):
+    """Merge site relays output in one serial stream or pcap file."""
+    args = args or sys.argv[1:]
+    parser = argparse.ArgumentParser(description=main.__doc__)
+    parser.add_argument(
+        "-L",
+        "--listen",
+        type=address,
+        default=("localhost", DEFAULT_PORT),
+        metavar="[HOST:]PORT",
+        help=(
+            "Address relays connect to, relays are not authenticated. "
+            f"Default: localhost:{DEFAULT_PORT}"
+        ),
+    )
+    parser.add_argument(
+        "-o",
+        "--outfile",
+        default="-",
+        metavar="FILE",
+        help="Merged output file, '-' for stdout. Default: stdout",
+    )
+    parser.add_argument(
+        "--relays",
+        type=workers.workers_count,
+        default=None,
+        metavar="N",
+        help="Stop after N relays ended. Default: run until interrupted",
+    )
+    parser.add_argument(
+        "--input",
+        action="store_true",
+        default=False,
+        help="Send standard input messages to the nodes, as serial_aggregator",
+    )
+    output.add_flush_parser(parser)
+    reorder.add_reorder_parser(parser)
+    opts = parser.parse_args(args)
+    try:
+        with contextlib.ExitStack() as stack:
+            outfd = sys.stdout.buffer
+            if opts.outfile != "-":
+                outfd = stack.enter_context(open(opts.outfile, "wb"))
+            server = RelayServer(
+                opts.listen,
+                outfd,
+                opts.flush or output.FlushPolicy.auto(outfd),
+                opts.reorder_window,
+                opts.relays,
+            )
+            with server:
+                if opts.input:
+                    from iotlabaggregator import serial
+
+                    serial.SerialAggregator.run_input(server)
+                else:
+                    server.run()
+        if server.reorder is not None:
+            server.reorder.report()
+    except OSError as err:
+        sys.stderr.write(f"{err}\n")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
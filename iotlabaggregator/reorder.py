@@ -0,0 +1,223 @@
+#! /usr/bin/env python
+
+# This file is a part of IoT-LAB aggregation-tools
+# Copyright (C) 2015 INRIA (Contact: admin@iot-lab.info)
+# Contributor(s) : see AUTHORS file
+#
+# This software is governed by the CeCILL license under French law
+# and abiding by the rules of distribution of free software.  You can  use,
+# modify and/ or redistribute the software under the terms of the CeCILL
+# license as circulated by CEA, CNRS and INRIA at the following URL
+# http://www.cecill.info.
+#
+# As a counterpart to the access to the source code and  rights to copy,
+# modify and redistribute granted by the license, users are provided only
+# with a limited warranty  and the software's author,  the holder of the
+# economic rights,  and the successive licensors  have only  limited
+# liability.
+#
+# The fact that you are presently reading this means that you have had
+# knowledge of the CeCILL license and that you accept its terms.
+
+"""Reorder output records by timestamp within a latency window
+
+Records written by the aggregators outputs are held up to ``window`` seconds,
+then written sorted by their timestamp, merged from all nodes with a heap.
+Records arriving after newer ones were written are counted as late and written
+immediately.
+"""
+
+import argparse
+import collections
+import heapq
+import itertools
+import struct
+import time
+
+from iotlabaggregator import LOGGER
+
+PCAP_RECORD_HDR = struct.Struct("=LLL")
+PCAPNG_BLOCK_HDR = struct.Struct("=LL")
+PCAPNG_EPB = 6
+
+
+def pcap_records(data):
+    """Split pcap records ``data``, keyed by their timestamp in microseconds.
+
+    >>> rec = PCAP_RECORD_HDR.pack(1, 2, 3) + bytes(4) + b'abc'
+    >>> [(key, bytes(rec)) for key, rec in pcap_records(rec + rec)][0][0]
+    1000002
+    >>> len(list(pcap_records(rec + rec)))
+    2
+    """
+    offset = 0
+    with memoryview(data) as view:
+        while offset < len(view):
+            t_s, t_us, length = PCAP_RECORD_HDR.unpack_from(view, offset)
+            end = offset + 16 + length
+            yield t_s * 1000000 + t_us, view[offset:end]
+            offset = end
+
+
+def pcapng_records(data):
+    """Split pcapng blocks ``data``, keyed by timestamp in nanoseconds.
+
+    Other blocks than packets, like interface descriptions, have a None key:
+    they are written in arrival order, as packets refer to interfaces by
+    their description order.
+
+    >>> idb = struct.pack('=LLL', 1, 12, 12)
+    >>> epb = PCAPNG_BLOCK_HDR.pack(6, 32) + struct.pack('=LLL', 0, 1, 2)
+    >>> epb += bytes(32 - len(epb))
+    >>> [(key, len(rec)) for key, rec in pcapng_records(idb + epb)]
+    [(None, 12), (4294967298, 32)]
+    """
+    offset = 0
+    with memoryview(data) as view:
+        while offset < len(view):
+            block_type, length = PCAPNG_BLOCK_HDR.unpack_from(view, offset)
+            block = view[offset : offset + length]
+            offset += length
+            if block_type != PCAPNG_EPB:
+                yield None, block
+                continue
+            t_high, t_low = struct.unpack_from("=LL", block, 12)
+            yield (t_high << 32) | t_low, block
+
+
+def lines_records(data):
+    """Split lines ``data``, keyed by their 'timestamp;' prefix.
+
+    >>> [(key, bytes(line)) for key, line in lines_records(b'2.5;a\\n1.0;b\\n')]
+    [(2.5, b'2.5;a\\n'), (1.0, b'1.0;b\\n')]
+    >>> [key for key, _ in lines_records(b'no timestamp\\n')]
+    [0.0]
+    """
+    data = bytes(data)
+    offset = 0
+    with memoryview(data) as view:
+        while offset < len(view):
+            end = data.find(b"\n", offset) + 1 or len(view)
+            try:
+                key = float(data[offset : data.index(b";", offset, end)])
+            except ValueError:
+                key = 0.0
+            yield key, view[offset:end]
+            offset = end
+
+
+def window_ms(value):
+    """Parse reorder window in milliseconds, return seconds.
+
+    >>> window_ms('250')
+    0.25
+    >>> window_ms('-1')
+    Traceback (most recent call last):
+    ...
+    argparse.ArgumentTypeError: Invalid reorder window: '-1'
+    """
+    try:
+        window = int(value)
+    except ValueError:
+        window = -1
+    if window <= 0:
+        raise argparse.ArgumentTypeError(f"Invalid reorder window: {value!r}")
+    return window / 1000
+
+
+def add_reorder_parser(parser):
+    """Add reorder window option to ``parser``."""
+    parser.add_argument(
+        "--reorder-window",
+        type=window_ms,
+        default=None,
+        metavar="MS",
+        help=(
+            "Hold records up to MS milliseconds to write them ordered by "
+            "timestamp. Default: write in arrival order"
+        ),
+    )
+
+
+class ReorderOutput:
+    """Output stage writing records to ``out`` ordered by timestamp.
+
+    ``records(data)`` splits written data in ``(key, record)``.
+    Records with a None key are not ordered, they are written directly.
+    A record is held until ``window`` seconds after its arrival, it is then
+    written with all the held records with a smaller key.
+    At most ``max_records`` are held, the oldest are written when exceeded.
+
+    Counters:
+
+    * ``late``: records older than an already written one
+    * ``early``: records written before the end of their window
+    """
+
+    max_records = 100000
+
+    def __init__(self, out, window, records):
+        self.out = out
+        self.window = window
+        self.records = records
+        self.late = 0
+        self.early = 0
+        self._heap = []
+        self._deadlines = collections.deque()
+        self._seq = itertools.count()
+        self._last = None
+
+    @property
+    def timeout(self):
+        """Max time the aggregator loop may wait before calling ``idle``."""
+        return min(filter(None, (self.window / 2, self.out.timeout)))
+
+    def write(self, data, records=1, node=None):  # pylint:disable=unused-argument
+        """Hold ``data`` records."""
+        deadline = time.monotonic() + self.window
+        for key, record in self.records(data):
+            if key is None:
+                self.out.write(record)
+                continue
+            if self._last is not None and key < self._last:
+                self.late += 1
+                self.out.write(record)
+                continue
+            heapq.heappush(self._heap, (key, next(self._seq), bytes(record)))
+            self._deadlines.append((deadline, key))
+        if len(self._heap) > self.max_records:
+            excess = len(self._heap) - self.max_records
+            self.early += excess
+            self._release(None, excess)
+
+    def idle(self):
+        """Write records whose window ended."""
+        now = time.monotonic()
+        limit = None
+        while self._deadlines and self._deadlines[0][0] <= now:
+            key = self._deadlines.popleft()[1]
+            limit = key if limit is None else max(limit, key)
+        if limit is not None:
+            self._release(limit)
+        self.out.idle()
+
+    def flush(self):
+        """Write all held records and flush output."""
+        self._release(None, len(self._heap))
+        self._deadlines.clear()
+        self.out.flush()
+
+    def _release(self, limit, count=0):
+        """Write records with key up to ``limit``, or at least ``count``."""
+        heap, batch, num = self._heap, bytearray(), 0
+        while heap and (num < count or (limit is not None and heap[0][0] <= limit)):
+            key, _, record = heapq.heappop(heap)
+            batch += record
+            num += 1
+            self._last = key
+        if num:
+            self.out.write(batch, num)
+
+    def report(self):
+        """Log reorder counters."""
+        LOGGER.info("Reorder: %u late records, %u written early", self.late, self.early)
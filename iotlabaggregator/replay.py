@@ -0,0 +1,262 @@
+#! /usr/bin/env python
+
+# This file is a part of IoT-LAB aggregation-tools
+# Copyright (C) 2015 INRIA (Contact: admin@iot-lab.info)
+# Contributor(s) : see AUTHORS file
+#
+# This software is governed by the CeCILL license under French law
+# and abiding by the rules of distribution of free software.  You can  use,
+# modify and/ or redistribute the software under the terms of the CeCILL
+# license as circulated by CEA, CNRS and INRIA at the following URL
+# http://www.cecill.info.
+#
+# As a counterpart to the access to the source code and  rights to copy,
+# modify and redistribute granted by the license, users are provided only
+# with a limited warranty  and the software's author,  the holder of the
+# economic rights,  and the successive licensors  have only  limited
+# liability.
+#
+# The fact that you are presently reading this means that you have had
+# knowledge of the CeCILL license and that you accept its terms.
+
+"""Replay recorded captures through local fake nodes
+
+Re-serve a serial aggregator output ``timestamp;node;line``, a serial binary
+recording or a sniffer pcap file, on one local TCP server per node, at their
+original pace, N times faster, or as fast as possible.
+
+Nodes servers listen on ``127.0.0.2``, ``127.0.0.3``... on the serial or
+sniffer port. A hosts file is written to connect the aggregators to them:
+
+    $ python -m iotlabaggregator.replay serial.log --hosts-file hosts --speed 10
+    $ serial_aggregator --hosts-file hosts
+
+Replayed pcap files nodes are named from the ZEP device id, ``zep-<id>``.
+``127.0.0.0/8`` loopback addresses are all local on Linux only.
+"""
+
+import argparse
+import collections
+import ipaddress
+import selectors
+import socket
+import struct
+import sys
+import time
+
+from iotlabaggregator import LOGGER, record, zeptopcap
+from iotlabaggregator.serial import SerialConnection
+from iotlabaggregator.sniffer import SnifferConnection
+
+PCAP_MAGIC = 0xA1B2C3D4
+# Ethernet, IP and UDP headers before the ZEP packets
+NET_HDR_LEN = zeptopcap.ZepPcap.NET_HDR.size
+ZEP_DEV_ID = struct.Struct("!H")
+ZEP_DEV_ID_IDX = 5
+
+
+def load_serial_log(path):
+    """Return ``(timestamp, node, data)`` events of a serial output file."""
+    events = []
+    with open(path, "rb") as log:
+        for line in log:
+            try:
+                timestamp, node, data = line.split(b";", 2)
+                events.append((float(timestamp), node.decode(), data))
+            except ValueError:
+                LOGGER.warning("Invalid serial output line: %r", line)
+    return events
+
+
+def load_record(path):
+    """Return ``(timestamp, node, data)`` events of a serial recording."""
+    with record.RecordReader(path) as reader:
+        return [
+            (timestamp / 1e9, node, line + b"\n")
+            for timestamp, node, line in reader.lines()
+        ]
+
+
+def load_pcap(path):
+    """Return ``(timestamp, node, zep_packet)`` events of a ZepPcap file."""
+    pcap_hdr = zeptopcap.ZepPcap.PCAP_HDR
+    with open(path, "rb") as pcap:
+        data = pcap.read()
+    magic, _, _, _, _, _, link = struct.unpack_from("=LHHLLLL", data)
+    if magic != PCAP_MAGIC or link != zeptopcap.ZepPcap.LINKTYPE_ETHERNET:
+        raise ValueError(f"Not a ZEP encapsulated pcap file: {path}")
+    events = []
+    offset = 24
+    while offset + pcap_hdr.size <= len(data):
+        t_s, t_us, length, _ = pcap_hdr.unpack_from(data, offset)
+        offset += pcap_hdr.size
+        packet = data[offset + NET_HDR_LEN : offset + length]
+        offset += length
+        (dev_id,) = ZEP_DEV_ID.unpack_from(packet, ZEP_DEV_ID_IDX)
+        events.append((t_s + t_us / 1e6, f"zep-{dev_id}", packet))
+    return events
+
+
+def load(path):
+    """Return ``(events, port)`` of ``path`` capture, by file format."""
+    with open(path, "rb") as capture:
+        magic = capture.read(8)
+    if magic == record.MAGIC:
+        return load_record(path), SerialConnection.port
+    if magic[:4] == struct.pack("=L", PCAP_MAGIC):
+        return load_pcap(path), SnifferConnection.port
+    return load_serial_log(path), SerialConnection.port
+
+
+class ReplayServer:
+    """Serve ``events`` to the aggregator, one server per node.
+
+    :param speed: replay speed factor, 0 for as fast as possible
+    :param first_address: address of the first node server
+    """
+
+    def __init__(self, events, port, speed=1.0, first_address="127.0.0.2"):
+        self.events = sorted(events, key=lambda event: event[0])
+        self.speed = speed
+        address = ipaddress.ip_address(first_address)
+        nodes = sorted({event[1] for event in self.events})
+        self.hosts = {node: str(address + i) for i, node in enumerate(nodes)}
+        self._selector = selectors.DefaultSelector()
+        self._clients = {}
+        self._servers = []
+        for node, host in self.hosts.items():
+            server = socket.create_server((host, port))
+            server.setblocking(False)
+            self._servers.append(server)
+            self._selector.register(server, selectors.EVENT_READ, data=node)
+
+    def write_hosts_file(self, path):
+        """Write nodes addresses in hosts format ``path``."""
+        with open(path, "w", encoding="utf-8") as hosts_file:
+            for node, host in self.hosts.items():
+                hosts_file.write(f"{host} {node}\n")
+
+    def wait_clients(self, timeout):
+        """Wait until all nodes are connected, or ``timeout``."""
+        end = time.monotonic() + timeout
+        while len(self._clients) < len(self.hosts) and time.monotonic() < end:
+            self._poll(end - time.monotonic())
+        return len(self._clients)
+
+    def run(self):
+        """Replay events, return the replay duration."""
+        start = time.monotonic()
+        first_ts = self.events[0][0] if self.events else 0.0
+        pending = collections.defaultdict(bytearray)
+        index = 0
+        while index < len(self.events):
+            # Send all the events that are due at once, by node
+            now = time.monotonic() - start
+            while index < len(self.events):
+                timestamp, node, data = self.events[index]
+                delay = (timestamp - first_ts) / self.speed if self.speed else 0
+                if delay > now:
+                    break
+                pending[node] += data
+                index += 1
+            for node, data in pending.items():
+                self._send(node, data)
+            pending.clear()
+            if index < len(self.events):
+                self._poll(max(0.0, delay - (time.monotonic() - start)))
+        return time.monotonic() - start
+
+    def close(self):
+        """Close nodes connections and servers."""
+        for sock in list(self._clients.values()) + self._servers:
+            sock.close()
+        self._selector.close()
+
+    def _send(self, node, data):
+        client = self._clients.get(node)
+        if client is None:
+            return
+        try:
+            client.sendall(data)
+        except OSError:
+            LOGGER.warning("%s;Connection closed", node)
+            del self._clients[node]
+            client.close()
+
+    def _poll(self, timeout):
+        """Accept new nodes connections."""
+        for key, _ in self._selector.select(timeout):
+            client, _ = key.fileobj.accept()
+            client.setblocking(True)
+            old = self._clients.pop(key.data, None)
+            if old is not None:
+                old.close()
+            self._clients[key.data] = client
+
+
+def speed_factor(value):
+    """Parse replay speed.
+
+    >>> speed_factor('max')
+    0.0
+    >>> speed_factor('10')
+    10.0
+    """
+    if value == "max":
+        return 0.0
+    speed = float(value)
+    if speed <= 0:
+        raise argparse.ArgumentTypeError(f"Invalid speed: {value!r}")
+    return speed
+
+
+def main(args=None):
+    """Replay a capture through local fake nodes."""
+    parser = argparse.ArgumentParser(description=main.__doc__)
+    parser.add_argument(
+        "capture", help="serial output, serial recording or sniffer pcap file"
+    )
+    parser.add_argument(
+        "-s",
+        "--speed",
+        type=speed_factor,
+        default=1.0,
+        help="replay speed factor, or 'max'. Default: 1",
+    )
+    parser.add_argument(
+        "--hosts-file",
+        default="replay_hosts",
+        help="Nodes hosts file to write. Default: replay_hosts",
+    )
+    parser.add_argument("--port", type=int, help="Nodes port. Default: by capture")
+    parser.add_argument(
+        "--wait",
+        type=float,
+        default=60.0,
+        help="Max time to wait for all nodes connections. Default: 60",
+    )
+    opts = parser.parse_args(args)
+
+    try:
+        events, port = load(opts.capture)
+        server = ReplayServer(events, opts.port or port, opts.speed)
+    except (OSError, ValueError, struct.error) as err:
+        sys.stderr.write(f"{err}\n")
+        sys.exit(1)
+    try:
+        server.write_hosts_file(opts.hosts_file)
+        LOGGER.info(
+            "Serving %u nodes, hosts file: %s", len(server.hosts), opts.hosts_file
+        )
+        connected = server.wait_clients(opts.wait)
+        LOGGER.info("%u/%u nodes connected", connected, len(server.hosts))
+        duration = server.run()
+        LOGGER.info("Replayed %u events in %.3fs", len(events), duration)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.close()
+
+
+if __name__ == "__main__":
+    main()
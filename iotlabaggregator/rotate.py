@@ -0,0 +1,195 @@
+#! /usr/bin/env python
+
+# This file is a part of IoT-LAB aggregation-tools
+# Copyright (C) 2015 INRIA (Contact: admin@iot-lab.info)
+# Contributor(s) : see AUTHORS file
+#
+# This software is governed by the CeCILL license under French law
+# and abiding by the rules of distribution of free software.  You can  use,
+# modify and/ or redistribute the software under the terms of the CeCILL
+# license as circulated by CEA, CNRS and INRIA at the following URL
+# http://www.cecill.info.
+#
+# As a counterpart to the access to the source code and  rights to copy,
+# modify and redistribute granted by the license, users are provided only
+# with a limited warranty  and the software's author,  the holder of the
+# economic rights,  and the successive licensors  have only  limited
+# liability.
+#
+# The fact that you are presently reading this means that you have had
+# knowledge of the CeCILL license and that you accept its terms.
+
+"""Rotating output files, by size or time, keeping a max number of files
+
+Like ``tcpdump -C/-G/-W``: output is written to ``FILE.0.ext``,
+``FILE.1.ext``... a new file is started when the current one exceeds a size
+or is older than an interval, and only the most recent files are kept.
+``FILE`` may contain ``strftime`` formats, expanded when a file is started.
+
+Files are opened, closed and removed in a background thread, data written
+meanwhile is kept in memory, so writing never waits for the disk.
+"""
+
+import collections
+import concurrent.futures
+import io
+import os
+import time
+
+
+def add_rotate_parser(parser):
+    """Add files rotation options to ``parser``."""
+    group = parser.add_argument_group(
+        title="Files rotation",
+        description="Write the output in rotated FILE.N.ext files",
+    )
+    group.add_argument(
+        "-C",
+        "--file-size",
+        type=float,
+        metavar="MB",
+        help="start a new file when it would exceed MB millions of bytes",
+    )
+    group.add_argument(
+        "-G",
+        "--rotate-seconds",
+        type=float,
+        metavar="SECONDS",
+        help="start a new file every SECONDS",
+    )
+    group.add_argument(
+        "-W",
+        "--file-count",
+        type=int,
+        metavar="COUNT",
+        help="only keep the COUNT most recent files, requires -C or -G",
+    )
+
+
+def rotate_options(parser, opts):
+    """Return ``RotatingFile`` arguments from parsed ``opts``, or None."""
+    if opts.file_count is not None and not (opts.file_size or opts.rotate_seconds):
+        parser.error("-W/--file-count requires -C/--file-size or -G/--rotate-seconds")
+    if not (opts.file_size or opts.rotate_seconds):
+        return None
+    return {
+        "max_size": opts.file_size and int(opts.file_size * 1000000),
+        "interval": opts.rotate_seconds,
+        "max_files": opts.file_count,
+    }
+
+
+class RotatingFile(io.RawIOBase):
+    """Binary output file rotated by ``max_size`` bytes or ``interval`` seconds.
+
+    Data is written to the current file as given, so each ``write`` should
+    contain whole records. The first ``header_size`` bytes written are the
+    files header, written again at the start of each new file.
+
+    :param max_files: number of files to keep, older ones are removed
+    """
+
+    def __init__(  # pylint:disable=too-many-arguments
+        self, path, max_size=None, interval=None, max_files=None, header_size=0
+    ):
+        super().__init__()
+        self.path = path
+        self.max_size = max_size
+        self.interval = interval
+        self.max_files = max_files
+        self.header_size = header_size
+        self.header = bytearray()
+        self.files = collections.deque()
+        self._executor = concurrent.futures.ThreadPoolExecutor(
+            1, thread_name_prefix="rotate"
+        )
+        self._index = 0
+        self._file = None
+        self._next = None  # Future of the file being opened
+        self._pending = bytearray()  # Data written while opening
+        self._size = 0
+        self._deadline = 0.0
+        self._rotate()
+
+    def filename(self, index):
+        """Return file ``index`` name, ``strftime`` formats are expanded."""
+        root, ext = os.path.splitext(time.strftime(self.path))
+        return f"{root}.{index}{ext}"
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        """Write ``data`` to the current file, rotate files before if needed."""
+        length = len(data)
+        if len(self.header) < self.header_size:
+            self.header += data[: self.header_size - len(self.header)]
+        elif self._should_rotate(length):
+            self._rotate()
+        self._size += length
+        if self._file is None and not self._opened():
+            self._pending += data
+        else:
+            self._file.write(data)
+        return length
+
+    def _should_rotate(self, length):
+        if self._size <= len(self.header):
+            return False  # Never rotate an empty file
+        if self.max_size and self._size + length > self.max_size:
+            return True
+        return bool(self.interval) and time.monotonic() >= self._deadline
+
+    def _rotate(self):
+        """Start a new file, close the current one in the background."""
+        if self._next is not None:
+            # Rare: still opening, the pending data must be written first
+            self._next.result()
+            self._opened()
+        if self._file is not None:
+            self._executor.submit(self._file.close)
+            self._file = None
+        name = self.filename(self._index)
+        self._index += 1
+        self._next = self._executor.submit(open, name, "wb")
+        self.files.append(name)
+        if self.max_files and len(self.files) > self.max_files:
+            self._executor.submit(_remove, self.files.popleft())
+        self._pending = bytearray(self.header)
+        self._size = len(self.header)
+        self._deadline = time.monotonic() + (self.interval or 0)
+
+    def _opened(self):
+        """Return if the next file is open, then write the pending data."""
+        if not self._next.done():
+            return False
+        self._file = self._next.result()
+        self._next = None
+        self._file.write(self._pending)
+        self._pending = bytearray()
+        return True
+
+    def flush(self):
+        """Flush the current file if open."""
+        if self._file is None and (self._next is None or not self._opened()):
+            return
+        self._file.flush()
+
+    def close(self):
+        """Write pending data, close the current file and wait for the thread."""
+        if self.closed:
+            return
+        if self._next is not None:
+            self._next.result()
+            self._opened()
+        self._file.close()
+        self._file = None
+        self._executor.shutdown(wait=True)
+        super().close()
+
+
+def _remove(path):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
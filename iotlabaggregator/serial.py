@@ -57,51 +57,68 @@ For multi-sites experiments, you should run the script on each site server.
 """
 
 import argparse
-import logging
-import readline  # noqa: F401
+import contextlib
+import functools
+import importlib.util
 import sys
 
-from iotlabcli.parser import common as common_parser
+from iotlabaggregator import (
+    common,
+    compress,
+    connections,
+    linefilter,
+    metrics,
+    output,
+    record,
+    relay,
+    reorder,
+    workers,
+)
+
+# readline, colorama and iotlabcli are imported on use for a fast startup
+# pylint:disable=import-outside-toplevel
+
+HAS_COLOR = importlib.util.find_spec("colorama") is not None
+
+
+@functools.cache
+def _colors():
+    """Return nodes colors and reset strings, initializing colorama."""
+    if not HAS_COLOR:
+        return ("",), ""
+    import colorama
 
-from iotlabaggregator import LOG_FMT, common, connections
+    colorama.init()
+    fore = colorama.Fore
+    colors = (
+        fore.BLACK,
+        fore.RED,
+        fore.GREEN,
+        fore.YELLOW,
+        fore.BLUE,
+        fore.MAGENTA,
+        fore.CYAN,
+        fore.WHITE,
+    )
+    return tuple(str(color) for color in colors), str(fore.RESET)
 
-try:
-    import colorama
 
-    HAS_COLOR = True
-except ImportError:
-    HAS_COLOR = False
+def __getattr__(name):
+    """Get ``COLOR_RESET`` on first use."""
+    if name == "COLOR_RESET":
+        return _colors()[1]
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
 
 
-if HAS_COLOR:
-    colorama.init()
-    _COLOR = [
-        colorama.Fore.BLACK,
-        colorama.Fore.RED,
-        colorama.Fore.GREEN,
-        colorama.Fore.YELLOW,
-        colorama.Fore.BLUE,
-        colorama.Fore.MAGENTA,
-        colorama.Fore.CYAN,
-        colorama.Fore.WHITE,
-    ]
-    COLOR_RESET = str(colorama.Fore.RESET)
-
-    def _color_hash(string):
-        """Return a hash of the string."""
-        return sum(ord(c) for c in string)
-
-    def color_str(string):
-        """Return color string character for identifier."""
-        color_idx = _color_hash(string) % len(_COLOR)
-        return str(_COLOR[color_idx])
-
-else:
-    COLOR_RESET = ""
-
-    def color_str(_):
-        """No color."""
-        return ""
+def _color_hash(string):
+    """Return a hash of the string."""
+    return sum(ord(c) for c in string)
+
+
+def color_str(string):
+    """Return color string character for identifier, empty without color."""
+    colors = _colors()[0]
+    return colors[_color_hash(string) % len(colors)]
 
 
 class SerialConnection(connections.Connection):
@@ -109,54 +126,96 @@ class SerialConnection(connections.Connection):
 
     Data is managed with a selector loop.
 
-    :param print_lines: should lines be printed to stdout
+    :param print_lines: should lines be printed to ``line_writer``
+    :param line_writer: ``output.LineWriter`` printing the lines, shared by
+        the aggregator connections. Default: a new one on stdout
     :param line_handler: additional function to call on received lines.
-        ``line_handler(identifier, line)``
+        ``line_handler(identifier, line)``, run by ``dispatcher`` if any.
+    :param lines_handler: function called once per read with the complete
+        lines raw bytes, only valid during the call.
+        ``lines_handler(identifier, data)``
+    :param line_filter: ``linefilter.LineFilter`` selecting the lines to
+        handle, others are dropped before any handling. It can be changed
+        with the ``line_filter`` attribute.
     """
 
     port = 20000
 
-    _line_logger = logging.StreamHandler(sys.stdout)
-    _line_logger.setFormatter(LOG_FMT)
-    logger = logging.getLogger("SerialConnection")
-    logger.setLevel(logging.INFO)
-    logger.addHandler(_line_logger)
-
-    def __init__(
+    def __init__(  # pylint:disable=too-many-arguments
         self,
         hostname,
         aggregator,
         print_lines=False,
         line_handler=None,
         color=False,
+        lines_handler=None,
+        line_filter=None,
+        line_writer=None,
     ):
         super().__init__(hostname, aggregator)
+        self.line_filter = line_filter
 
+        self.print_lines = print_lines
+        if line_writer is None and print_lines:
+            line_writer = output.LineWriter(output.binary_output(sys.stdout))
+        self.line_writer = line_writer
         self.line_handler = common.Event()
-        if print_lines:
-            self.line_handler.append(self.print_line)
         if line_handler:
             self.line_handler.append(line_handler)
+        self.lines_handler = common.Event()
+        if lines_handler:
+            self.lines_handler.append(lines_handler)
+
+        self._color = color_str(self.hostname) if color else ""
+        self._suffix = _colors()[1] if color else ""
+        self._scanned = 0  # length of the buffered incomplete line
 
-        self.fmt = "%s;%s"
-        if color:
-            self.fmt = f"{color_str(self.hostname)}{self.fmt}{COLOR_RESET}"
+    def close(self):
+        """Close the socket, the receive buffer is searched again."""
+        super().close()
+        self._scanned = 0
 
     def handle_data(self, data):
-        """Print the data received line by line."""
-        lines = data.splitlines(True)
-        data = ""
-        for line in lines:
-            if line[-1] == "\n":
-                line = line[:-1]
-                self.line_handler(self.hostname, line)
-            else:
-                data = line  # last incomplete line
-        return data
+        """Print and run line handlers on the complete lines received.
 
-    def print_line(self, identifier, line):
-        """Print one line prefixed by id."""
-        self.logger.info(self.fmt, identifier, line)
+        Only complete lines are decoded, in one pass, so a multibyte character
+        split between two reads is decoded correctly.
+        The last incomplete line is kept in the buffer, it is not searched
+        again for a newline when more data is received.
+        Lines not selected by ``line_filter`` are dropped before decoding.
+        """
+        scanned = self._scanned if self._scanned <= len(data) else 0
+        end = data.rfind(b"\n", scanned) + 1
+        if not end:
+            self._scanned = len(data)
+            return 0
+        self._scanned = len(data) - end
+        self.stats.lines += data.count(b"\n", 0, end)
+        if self.line_filter is None:
+            with memoryview(data)[:end] as view:
+                self._handle_lines(view)
+        elif selected := self.line_filter.filter(data, end):
+            self._handle_lines(selected)
+        return end
+
+    def _handle_lines(self, view):
+        """Run lines handlers on ``view`` complete lines."""
+        self.lines_handler(self.hostname, view)
+        if not (self.print_lines or self.line_handler):
+            return
+        lines = str(view, "utf-8", "replace").split("\n")
+        del lines[-1]  # last one is empty
+        if self.print_lines:
+            prefix = f"{self._color}{self.hostname};"
+            self.line_writer.write_lines(lines, prefix, self._suffix, self.hostname)
+        if not self.line_handler:
+            return
+        if self.dispatcher is not None:
+            calls = [(self.hostname, line) for line in lines]
+            self.dispatcher.submit(self.hostname, self.line_handler, calls)
+            return
+        for line in lines:
+            self.line_handler(self.hostname, line)
 
 
 class SerialAggregator(connections.Aggregator):
@@ -164,26 +223,127 @@ class SerialAggregator(connections.Aggregator):
 
     connection_class = SerialConnection
 
-    parser = argparse.ArgumentParser()
-    common.add_nodes_selection_parser(parser)
-    parser.add_argument(
-        "--with-a8",
-        action="store_true",
-        help=(
-            "redirect open-a8 serial port. "
-            "`/etc/init.d/serial_redirection` must be running on the nodes"
-        ),
-    )
-
-    parser.set_defaults(color=False)
-    if HAS_COLOR:
+    @common.class_parser
+    def parser(cls):  # pylint:disable=no-self-argument
+        """Command line parser, built on first use."""
+        parser = argparse.ArgumentParser()
+        common.add_nodes_selection_parser(parser)
+        common.add_connection_parser(parser)
+        output.add_flush_parser(parser)
+        output.add_queue_parser(parser)
+        linefilter.add_filter_parser(parser)
+        reorder.add_reorder_parser(parser)
+        workers.add_workers_parser(parser)
+        metrics.add_metrics_parser(parser)
+        compress.add_compress_parser(parser)
+        relay.add_relay_parser(parser)
+        parser.add_argument(
+            "--record",
+            metavar="FILE",
+            help=(
+                "Record lines in compact binary FILE instead of printing them. "
+                "Read it with 'python -m iotlabaggregator.record FILE'"
+            ),
+        )
         parser.add_argument(
-            "--color",
+            "--with-a8",
             action="store_true",
-            default=False,
-            help="Add color to node lines.",
+            help=(
+                "redirect open-a8 serial port. "
+                "`/etc/init.d/serial_redirection` must be running on the nodes"
+            ),
         )
 
+        parser.set_defaults(color=False)
+        if HAS_COLOR:
+            parser.add_argument(
+                "--color",
+                action="store_true",
+                default=False,
+                help="Add color to node lines.",
+            )
+        return parser
+
+    # Split output records, to reorder them.
+    # One process output is already ordered by receive time.
+    output_records = staticmethod(reorder.lines_records)
+
+    @staticmethod
+    def output_link(**_kwargs):
+        """Lines output has no link type."""
+        return None
+
+    def __init__(  # pylint:disable=too-many-arguments
+        self,
+        nodes_list,
+        *args,
+        flush_policy=None,
+        outfd=None,
+        record_file=None,
+        output_queue=None,
+        **kwargs,
+    ):
+        # Lines are printed through one writer shared by the connections
+        if outfd is None:
+            outfd = output.binary_output(sys.stdout)
+        self.line_writer = writer = output.LineWriter(outfd, flush_policy)
+        super().__init__(nodes_list, *args, line_writer=writer, **kwargs)
+        # Optionally written in a thread through a queue
+        self.queue = None
+        if output_queue is not None:
+            self.queue = writer.queue = output.QueuedOutput(writer, **output_queue)
+        self.outputs.append(self.queue or writer)
+
+        # Binary recording of received lines
+        self.recorder = None
+        if record_file is not None:
+            # Each output counts its own pending records
+            policy = flush_policy and flush_policy.copy()
+            self.recorder = record.RecordWriter(record_file, policy)
+            for node in self.values():
+                node.lines_handler.append(self.recorder.write_lines)
+            self.outputs.append(self.recorder)
+
+    def stop(self):
+        """Stop aggregator, output queue thread and finish recording."""
+        super().stop()
+        if self.queue is not None:
+            self.queue.close()
+        if self.recorder is not None:
+            self.recorder.close()
+
+    def iter_line_batches(self, timeout=None):
+        """Iterate over lists of ``(node, line)`` received since the last one.
+
+        Lines are queued as raw chunks by the selector loop and decoded by
+        the iterating thread. See ``iter_items`` for ``timeout``.
+        """
+        return self._line_batches(self.iter_items("lines_handler", bytes, timeout))
+
+    def iter_lines(self):
+        """Iterate over ``(node, line)`` lines received from all nodes.
+
+        >>> aggregator = SerialAggregator(['m3-1'])
+        >>> lines = aggregator.iter_lines()
+        >>> aggregator['m3-1'].handle_data(bytearray(b'hello\\nworld\\n'))
+        12
+        >>> aggregator._close_items_queues()
+        >>> list(lines)
+        [('m3-1', 'hello'), ('m3-1', 'world')]
+        """
+        return (line for batch in self.iter_line_batches() for line in batch)
+
+    @staticmethod
+    def _line_batches(chunks_lists):
+        """Split ``(node, chunk)`` lists in ``(node, line)`` lists."""
+        for chunks in chunks_lists:
+            batch = []
+            for node, chunk in chunks:
+                lines = str(chunk, "utf-8", "replace").split("\n")
+                del lines[-1]  # last one is empty
+                batch.extend((node, line) for line in lines)
+            yield batch
+
     @staticmethod
     def select_nodes(opts):
         """Select all gateways and open-a8 if ``with_a8``."""
@@ -199,19 +359,30 @@ class SerialAggregator(connections.Aggregator):
 
     def run(self):
         """Read standard input while aggregator is running."""
+        self.run_input(self)
+
+    @classmethod
+    def run_input(cls, aggregator):
+        """Read standard input while ``aggregator`` is running.
+
+        ``aggregator`` may also be a workers aggregator.
+        """
         try:
-            self.read_input()
+            cls.read_input(aggregator)
         except (KeyboardInterrupt, EOFError):
             pass
 
-    def read_input(self):
+    @classmethod
+    def read_input(cls, aggregator):
         """Read input and sends the messages to the given nodes."""
+        import readline  # noqa: F401  # line editing for input()
+
         while True:
             line = input()
-            nodes, message = self.extract_nodes_and_message(line)
+            nodes, message = cls.extract_nodes_and_message(line)
 
             if (None, "") != (nodes, message):
-                self.send_nodes(nodes, message + "\n")
+                aggregator.send_nodes(nodes, message + "\n")
             # else: Only hitting 'enter' to get spacing
 
     @staticmethod
@@ -252,6 +423,8 @@ class SerialAggregator(connections.Aggregator):
         (['node-a8-1'], 'message')
 
         """
+        from iotlabcli.parser import common as common_parser
+
         try:
             nodes_str, message = line.split(";")
             if nodes_str == "-":
@@ -278,16 +451,83 @@ class SerialAggregator(connections.Aggregator):
             return None, line
 
 
+def aggregator_options(opts):
+    """Return ``SerialAggregator`` arguments for ``opts``, except outputs."""
+    return {
+        "print_lines": not opts.record,
+        "color": opts.color,
+        "line_filter": linefilter.line_filter_from_opts(opts),
+        "connect_timeout": opts.connect_timeout,
+        "hosts": opts.hosts_file and common.read_hosts_file(opts.hosts_file),
+        "reconnect": opts.reconnect,
+        "metrics": metrics.metrics_options(opts),
+        "output_queue": output.queue_options(opts),
+    }
+
+
+def parse_args(args):
+    """Parse command line ``args``, exit on incompatible options."""
+    parser = SerialAggregator.parser
+    opts = parser.parse_args(args)
+    if opts.record and opts.workers > 1:
+        parser.error("--record is not supported with --workers")
+    if opts.record and opts.compress:
+        parser.error("--record is not supported with --compress")
+    if opts.relay and (opts.record or opts.compress or opts.workers > 1):
+        parser.error("--relay is not supported with --record, --compress, --workers")
+    return opts
+
+
 def main(args=None):
     """Aggregate all nodes serial links."""
     args = args or sys.argv[1:]
-    opts = SerialAggregator.parser.parse_args(args)
+    opts = parse_args(args)
     try:
         nodes_list = SerialAggregator.select_nodes(opts)
-        with SerialAggregator(
-            nodes_list, print_lines=True, color=opts.color
-        ) as aggregator:
-            aggregator.run()
+        if opts.relay:
+            # Relayed output is sent in batches, the central one flushes it
+            flush_policy = opts.flush or output.FlushPolicy(output.FlushPolicy.IDLE)
+            relay.run_relay(
+                SerialAggregator,
+                nodes_list,
+                opts.relay,
+                opts.relay_compress,
+                flush_policy=flush_policy,
+                **aggregator_options(opts),
+            )
+            return
+        with contextlib.ExitStack() as stack:
+            outfd = sys.stdout
+            lines_out = sys.stdout.buffer
+            if opts.compress:
+                sys.stdout.flush()
+                lines_out = stack.enter_context(
+                    compress.CompressedFile(lines_out, opts.compress)
+                )
+                outfd = lines_out
+            kwargs = aggregator_options(opts)
+            if opts.record:
+                outfd = stack.enter_context(open(opts.record, "wb"))
+                kwargs["record_file"] = outfd
+            kwargs["flush_policy"] = opts.flush or output.FlushPolicy.auto(outfd)
+            if opts.workers > 1:
+                sys.stdout.flush()
+                aggregator = workers.WorkersAggregator(
+                    SerialAggregator,
+                    nodes_list,
+                    opts.workers,
+                    lines_out,
+                    reorder_window=opts.reorder_window,
+                    **kwargs,
+                )
+            else:
+                aggregator = SerialAggregator(nodes_list, outfd=lines_out, **kwargs)
+            with aggregator:
+                SerialAggregator.run_input(aggregator)
+        if getattr(aggregator, "reorder", None) is not None:
+            aggregator.reorder.report()
+        if getattr(aggregator, "queue", None) is not None:
+            aggregator.queue.report()
     except (ValueError, RuntimeError) as err:
         sys.stderr.write(f"{err}\n")
         sys.exit(1)
@@ -26,78 +26,128 @@ import contextlib
 import logging
 import sys
 
-from iotlabaggregator import LOGGER, common, connections, zeptopcap
+from iotlabaggregator import (
+    LOGGER,
+    common,
+    compress,
+    connections,
+    metrics,
+    output,
+    relay,
+    reorder,
+    rotate,
+    workers,
+    zeptopcap,
+)
 
 SNIFFER_NODES_COMPAT = ("a8", "frdm-kw41z", "m3", "nrf52840dk", "samr21")
 
 
 class SnifferConnection(connections.Connection):
-    """Connection to sniffer and data handling."""
+    """Connection to sniffer and data handling.
+
+    :param pkt_handler: function called on each received packet.
+        ``pkt_handler(packet)``, run by ``dispatcher`` if any.
+    :param pkts_handler: additional function called once with all the packets
+        extracted from one read. ``pkts_handler(identifier, packets)``
+    """
 
     port = 30000
     ZEP_HDR_LEN = zeptopcap.ZepPcap.ZEP_HDR_LEN
+    ZEP_MAGIC = b"EX\2"
 
-    def __init__(self, hostname, aggregator, pkt_handler):
+    def __init__(self, hostname, aggregator, pkt_handler=None, pkts_handler=None):
         super().__init__(hostname, aggregator)
         self.pkt_handler = pkt_handler
+        self.pkts_handler = common.Event()
+        if pkts_handler:
+            self.pkts_handler.append(pkts_handler)
 
     def handle_data(self, data):
-        """Print the data received line by line."""
-        while True:
-            data = self._strip_until_pkt_start(data)
-            if not data.startswith("EX\2") or len(data) < self.ZEP_HDR_LEN:
-                break
-            # length = header length + data['len_byte']
-            full_len = self.ZEP_HDR_LEN + ord(data[self.ZEP_HDR_LEN - 1])
-            if len(data) < full_len:
-                break
-
-            # Extract packet
-            pkt, data = data[:full_len], data[full_len:]
-            LOGGER.debug("%s;Packet received len: %d", self.hostname, full_len)
-            self.pkt_handler(pkt)
-            self.aggregator.rx_packets += 1
+        """Extract ZEP packets from ``data`` and run packet handler.
 
-        return data
+        Packets are located using offsets in the buffer, the consumed part is
+        only removed once all complete packets were handled.
+        """
+        start = 0
+        pkts = []
+        with memoryview(data) as view:
+            while True:
+                pkt_start = self._strip_until_pkt_start(data, start)
+                if pkt_start != start:
+                    self.stats.resyncs += 1
+                    self.stats.skipped += pkt_start - start
+                    start = pkt_start
+                if len(data) - start < self.ZEP_HDR_LEN:
+                    break
+                if not data.startswith(self.ZEP_MAGIC, start):
+                    break
+                # length = header length + data['len_byte']
+                full_len = self.ZEP_HDR_LEN + data[start + self.ZEP_HDR_LEN - 1]
+                if len(data) - start < full_len:
+                    break
 
-    def handle_read(self):
-        """Append read bytes to buffer and run data handler."""
-        self.data_buff += self.recv(8192).decode("latin-1")
-        self.data_buff = self.handle_data(self.data_buff)
+                # Extract packet
+                pkts.append(bytes(view[start : start + full_len]))
+                start += full_len
+                LOGGER.debug("%s;Packet received len: %d", self.hostname, full_len)
 
-    @staticmethod
-    def _strip_until_pkt_start(msg):
-        """
-        >>> msg = 'abcdEEEEEEEEEX\2'
-        >>> 'EX\2' == SnifferConnection._strip_until_pkt_start(msg)
-        True
+        if pkts:
+            self.handle_packets(pkts)
+        return start
 
-        >>> msg = 'abcdEEEEEEEEEX\2' '12345'
-        >>> 'EX\2''12345' == SnifferConnection._strip_until_pkt_start(msg)
-        True
+    def handle_packets(self, pkts):
+        """Run packet handlers on ``pkts`` extracted from one read."""
+        self.pkts_handler(self.hostname, pkts)
+        self.aggregator.rx_packets += len(pkts)
+        self.stats.packets += len(pkts)
+        if self.pkt_handler is None:
+            return
+        if self.dispatcher is not None:
+            calls = [(pkt,) for pkt in pkts]
+            self.dispatcher.submit(self.hostname, (self.pkt_handler,), calls)
+            return
+        for pkt in pkts:
+            self.pkt_handler(pkt)
 
-        >>> msg = 'abcdEEE'
-        >>> 'EE' == SnifferConnection._strip_until_pkt_start(msg)
+    @classmethod
+    def _strip_until_pkt_start(cls, data, start=0):
+        """Return the offset of the first packet start in ``data[start:]``.
+
+        >>> msg = b'abcdEEEEEEEEEX\2'
+        >>> SnifferConnection._strip_until_pkt_start(msg)
+        12
+        >>> msg[12:] == b'EX\2'
         True
 
-        >>> msg = 'abcdEEEa'
-        >>> 'Ea' == SnifferConnection._strip_until_pkt_start(msg)
+        >>> msg = b'abcdEEEEEEEEEX\2' b'12345'
+        >>> SnifferConnection._strip_until_pkt_start(msg)
+        12
+
+        >>> msg = b'EX\2' b'12345' b'abEX\2'
+        >>> SnifferConnection._strip_until_pkt_start(msg, 1)
+        10
+
+        >>> msg = b'abcdEEE'
+        >>> msg[SnifferConnection._strip_until_pkt_start(msg):] == b'EE'
         True
 
-        >>> msg = 'a'
-        >>> 'a' == SnifferConnection._strip_until_pkt_start(msg)
+        >>> msg = b'abcdEEEa'
+        >>> msg[SnifferConnection._strip_until_pkt_start(msg):] == b'Ea'
         True
 
+        >>> msg = b'a'
+        >>> SnifferConnection._strip_until_pkt_start(msg)
+        0
+
         """
-        whole_index = msg.find("EX\2")
-        if whole_index == 0:  # is stripped
-            return msg
-        if whole_index != -1:  # found, strip first lines
-            return msg[whole_index:]
+        whole_index = data.find(cls.ZEP_MAGIC, start)
+        if whole_index != -1:  # found, skip data before
+            return whole_index
 
         # not found but remove some chars from the buffer
         # at max 2 required in this case
-        return msg[-2:]
+        return max(start, len(data) - 2)
 
 
 class SnifferAggregator(connections.Aggregator):
@@ -105,61 +155,240 @@ class SnifferAggregator(connections.Aggregator):
 
     connection_class = SnifferConnection
 
-    parser = argparse.ArgumentParser()
-    common.add_nodes_selection_parser(parser)
-    _output = parser.add_argument_group("Sniffer output")
-    _output.add_argument(
-        "-o",
-        "--outfile",
-        metavar="PCAP_FILE",
-        required=True,
-        help="Pcap outfile path. Use '-' for stdout.",
-    )
-    _output.add_argument(
-        "-d",
-        "--debug",
-        action="store_true",
-        default=False,
-        help="Print debug on received packets",
-    )
-    _output.add_argument(
-        "-r",
-        "--raw",
-        "--foren6",
-        action="store_true",
-        default=False,
-        help="Extract payload and no encapsulation. For foren6.",
-    )
-
-    def __init__(self, nodes_list, outfd, raw=False, *args, **kwargs):
-        zep_pcap = zeptopcap.ZepPcap(outfd, raw)
-        super().__init__(nodes_list, pkt_handler=zep_pcap.write, *args, **kwargs)
+    @common.class_parser
+    def parser(cls):  # pylint:disable=no-self-argument
+        """Command line parser, built on first use."""
+        parser = argparse.ArgumentParser()
+        common.add_nodes_selection_parser(parser)
+        common.add_connection_parser(parser)
+        output_group = parser.add_argument_group("Sniffer output")
+        output_group.add_argument(
+            "-o",
+            "--outfile",
+            metavar="PCAP_FILE",
+            help="Pcap outfile path. Use '-' for stdout. Required without --relay",
+        )
+        output_group.add_argument(
+            "-d",
+            "--debug",
+            action="store_true",
+            default=False,
+            help="Print debug on received packets",
+        )
+        output_group.add_argument(
+            "-r",
+            "--raw",
+            "--foren6",
+            action="store_true",
+            default=False,
+            help="Extract payload and no encapsulation. For foren6.",
+        )
+        output_group.add_argument(
+            "--pcapng",
+            action="store_true",
+            default=False,
+            help="Write pcapng, with one interface per node and ns timestamps",
+        )
+        output_group.add_argument(
+            "--comments",
+            action="store_true",
+            default=False,
+            help="Add node, channel, LQI and seqno comments to pcapng packets",
+        )
+        output.add_flush_parser(output_group)
+        output.add_queue_parser(output_group)
+        reorder.add_reorder_parser(output_group)
+        compress.add_compress_parser(output_group)
+        rotate.add_rotate_parser(parser)
+        workers.add_workers_parser(parser)
+        metrics.add_metrics_parser(parser)
+        relay.add_relay_parser(parser)
+        return parser
+
+    # Split output records, to reorder them
+    output_records = staticmethod(reorder.pcap_records)
+
+    @staticmethod
+    def output_link(raw=False, **_kwargs):
+        """Return the pcap link type of the output for aggregator kwargs."""
+        return zeptopcap.ZepPcap.link_type(raw)
+
+    def __init__(
+        self,
+        nodes_list,
+        outfd,
+        raw=False,
+        *args,
+        flush_policy=None,
+        reorder_window=None,
+        pcapng=False,
+        comments=False,
+        output_queue=None,
+        **kwargs,
+    ):
+        block = output.QueuedOutput.BLOCK
+        if pcapng and output_queue and output_queue.get("policy", block) != block:
+            # Dropped batches may hold the nodes interface description blocks
+            raise ValueError("pcapng output requires the 'block' queue policy")
+        if pcapng:
+            zep_pcap = zeptopcap.ZepPcapng(outfd, raw, flush_policy, comments)
+            self.output_records = reorder.pcapng_records
+        else:
+            zep_pcap = zeptopcap.ZepPcap(outfd, raw, flush_policy)
+        self.reorder = None
+        if reorder_window:
+            # pcap header is already written, only records are reordered
+            self.reorder = reorder.ReorderOutput(
+                zep_pcap.out, reorder_window, self.output_records
+            )
+            zep_pcap.out = self.reorder
+        self.queue = None
+        if output_queue is not None:
+            self.queue = output.QueuedOutput(zep_pcap.out, **output_queue)
+            zep_pcap.out = self.queue
+        super().__init__(
+            nodes_list, pkts_handler=zep_pcap.write_packets, *args, **kwargs
+        )
+        self.outputs.append(zep_pcap.out)
         self.rx_packets = 0
 
+    def stop(self):
+        """Stop aggregator and output queue thread."""
+        super().stop()
+        if self.queue is not None:
+            self.queue.close()
+
+    def iter_packet_batches(self, timeout=None):
+        """Iterate over lists of ``(node, packet)`` received since the last one.
+
+        ``packet`` is a ZEP message. See ``iter_items`` for ``timeout``.
+        """
+        return self._packet_batches(self.iter_items("pkts_handler", None, timeout))
+
+    def iter_packets(self):
+        """Iterate over ``(node, packet)`` ZEP messages received from all nodes."""
+        return (pkt for batch in self.iter_packet_batches() for pkt in batch)
+
+    @staticmethod
+    def _packet_batches(pkts_lists):
+        """Flatten ``(node, packets)`` lists in ``(node, packet)`` lists."""
+        for pkts_list in pkts_lists:
+            yield [(node, pkt) for node, pkts in pkts_list for pkt in pkts]
+
     @staticmethod
     def select_nodes(opts):
-        """Select all gateways that support sniffer."""
+        """Select all gateways that support sniffer, or hosts file nodes."""
         nodes = common.get_nodes_selection(**vars(opts))
+        if opts.hosts_file:
+            return nodes
         nodes_list = [n for n in nodes if n.startswith(SNIFFER_NODES_COMPAT)]
         return nodes_list
 
 
+def parse_args(args):
+    """Parse command line ``args``, exit on incompatible options."""
+    parser = SnifferAggregator.parser
+    opts = parser.parse_args(args)
+    if opts.relay:
+        check_relay_args(parser, opts)
+    elif opts.outfile is None:
+        parser.error("the following arguments are required: -o/--outfile")
+    if opts.pcapng and opts.workers > 1:
+        # Each worker would number its own interfaces
+        parser.error("--pcapng is not supported with --workers")
+    queue = output.queue_options(opts)
+    if opts.pcapng and queue and queue["policy"] != output.QueuedOutput.BLOCK:
+        # Dropped batches may hold the nodes interface description blocks
+        parser.error("--pcapng requires the 'block' --queue-policy")
+    if opts.comments and not opts.pcapng:
+        parser.error("--comments requires --pcapng")
+    opts.rotation = rotate.rotate_options(parser, opts)
+    if opts.rotation and (opts.outfile == "-" or opts.pcapng):
+        # pcapng interfaces blocks are only written once
+        parser.error("Files rotation requires a pcap outfile")
+    if opts.rotation and opts.compress:
+        parser.error("Files rotation is not supported with --compress")
+    return opts
+
+
+def check_relay_args(parser, opts):
+    """Exit on options not supported with ``--relay``."""
+    if opts.outfile is not None or opts.compress or opts.workers > 1:
+        parser.error("--relay is not supported with --outfile, --compress, --workers")
+    if opts.pcapng:
+        # Each relay would number its own interfaces
+        parser.error("--pcapng is not supported with --relay")
+
+
+def open_output(stack, opts):
+    """Return the binary output for ``opts``, closed by ``stack``."""
+    if opts.outfile == "-":
+        outfd = sys.stdout.buffer
+    elif opts.rotation:
+        # Each file starts with the pcap global header
+        header_size = zeptopcap.ZepPcap.MAIN_PCAP_HDR.size
+        outfd = stack.enter_context(
+            rotate.RotatingFile(opts.outfile, header_size=header_size, **opts.rotation)
+        )
+    else:
+        outfd = stack.enter_context(open(opts.outfile, "wb"))
+    if opts.compress:
+        outfd = stack.enter_context(compress.CompressedFile(outfd, opts.compress))
+    return outfd
+
+
+def aggregator_options(opts):
+    """Return ``SnifferAggregator`` arguments for ``opts``, except outputs."""
+    return {
+        "raw": opts.raw,
+        "pcapng": opts.pcapng,
+        "comments": opts.comments,
+        "reorder_window": opts.reorder_window,
+        "connect_timeout": opts.connect_timeout,
+        "hosts": opts.hosts_file and common.read_hosts_file(opts.hosts_file),
+        "reconnect": opts.reconnect,
+        "metrics": metrics.metrics_options(opts),
+        "output_queue": output.queue_options(opts),
+    }
+
+
 def main(args=None):
     """Aggregate all nodes radio sniffer."""
     args = args or sys.argv[1:]
-    opts = SnifferAggregator.parser.parse_args(args)
+    opts = parse_args(args)
     try:
         nodes_list = SnifferAggregator.select_nodes(opts)
         if opts.debug:
             LOGGER.setLevel(logging.DEBUG)
+        if opts.relay:
+            # Relayed output is sent in batches, the central one flushes it
+            flush_policy = opts.flush or output.FlushPolicy(output.FlushPolicy.IDLE)
+            relay.run_relay(
+                SnifferAggregator,
+                nodes_list,
+                opts.relay,
+                opts.relay_compress,
+                flush_policy=flush_policy,
+                **aggregator_options(opts),
+            )
+            return
         with contextlib.ExitStack() as stack:
-            if opts.outfile == "-":
-                outfd = sys.stdout.buffer
+            outfd = open_output(stack, opts)
+            kwargs = aggregator_options(opts)
+            kwargs["flush_policy"] = opts.flush or output.FlushPolicy.auto(outfd)
+            if opts.workers > 1:
+                aggregator = workers.WorkersAggregator(
+                    SnifferAggregator, nodes_list, opts.workers, outfd, **kwargs
+                )
             else:
-                outfd = stack.enter_context(open(opts.outfile, "wb"))
-            with SnifferAggregator(nodes_list, outfd, opts.raw) as aggregator:
+                aggregator = SnifferAggregator(nodes_list, outfd, **kwargs)
+            with aggregator:
                 aggregator.run()
                 LOGGER.info("%u packets captured", aggregator.rx_packets)
+            if aggregator.reorder is not None:
+                aggregator.reorder.report()
+            if getattr(aggregator, "queue", None) is not None:
+                aggregator.queue.report()
     except (ValueError, RuntimeError) as err:
         sys.stderr.write(f"{err}\n")
         sys.exit(1)
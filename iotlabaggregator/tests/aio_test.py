@@ -0,0 +1,171 @@
+#! /usr/bin/python
+
+# This file is a part of IoT-LAB aggregation-tools
+# Copyright (C) 2015 INRIA (Contact: admin@iot-lab.info)
+# Contributor(s) : see AUTHORS file
+#
+# This software is governed by the CeCILL license under French law
+# and abiding by the rules of distribution of free software.  You can  use,
+# modify and/ or redistribute the software under the terms of the CeCILL
+# license as circulated by CEA, CNRS and INRIA at the following URL
+# http://www.cecill.info.
+#
+# As a counterpart to the access to the source code and  rights to copy,
+# modify and redistribute granted by the license, users are provided only
+# with a limited warranty  and the software's author,  the holder of the
+# economic rights,  and the successive licensors  have only  limited
+# liability.
+#
+# The fact that you are presently reading this means that you have had
+# knowledge of the CeCILL license and that you accept its terms.
+
+"""Tests for iotlabaggregator.aio"""
+
+import asyncio
+import socket
+import unittest
+from unittest.mock import Mock, patch
+
+from iotlabaggregator import aio, serial, sniffer
+from iotlabaggregator.tests.sniffer_test import TestSnifferHandleRead
+
+ZEP_MESSAGE = TestSnifferHandleRead.zep_message
+
+
+class LocalResolve:
+    """Resolve hostnames with ``addresses``."""
+
+    addresses = {}
+
+    def resolve(self):
+        address = self.addresses[self.hostname]
+        if address is None:
+            raise socket.gaierror(socket.EAI_NONAME, "Name or service not known")
+        return (socket.AF_INET, socket.SOCK_STREAM, 0, "", address)
+
+
+class LocalSerialConnection(LocalResolve, serial.SerialConnection):
+    pass
+
+
+class LocalSnifferConnection(LocalResolve, sniffer.SnifferConnection):
+    pass
+
+
+class SerialAggregator(aio.AsyncSerialAggregator):
+    connection_class = LocalSerialConnection
+
+
+class SnifferAggregator(aio.AsyncSnifferAggregator):
+    connection_class = LocalSnifferConnection
+
+
+@patch("iotlabaggregator.aio.LOGGER", Mock())
+class TestAsyncAggregator(unittest.IsolatedAsyncioTestCase):
+    """Test the asyncio aggregator with local servers."""
+
+    async def asyncSetUp(self):
+        self.clients = []
+        self.server = await asyncio.start_server(self._client, "127.0.0.1", 0)
+        with socket.create_server(("127.0.0.1", 0)) as closed:
+            closed_address = closed.getsockname()
+        LocalResolve.addresses = {
+            "m3-1": self.server.sockets[0].getsockname(),
+            "m3-2": self.server.sockets[0].getsockname(),
+            "m3-3": closed_address,
+            "m3-4": None,
+        }
+        self.data = b""
+        self.received = asyncio.Queue()
+
+    async def asyncTearDown(self):
+        self.server.close()
+        for writer in self.clients:
+            writer.close()
+        await self.server.wait_closed()
+
+    async def _client(self, reader, writer):
+        self.clients.append(writer)
+        if self.data:
+            writer.write(self.data)
+            writer.close()
+        while data := await reader.read(1024):
+            self.received.put_nowait(data)
+
+    def test_empty_nodes_list(self):
+        self.assertRaises(ValueError, aio.AsyncAggregator, [])
+
+    async def test_lines(self):
+        self.data = b"one\ntwo\n"
+        agg = SerialAggregator(sorted(LocalResolve.addresses), connect_timeout=1)
+        async with agg:
+            lines = [line async for line in agg.lines()]
+        self.assertEqual(["m3-3", "m3-4"], sorted(agg.connect_errors))
+        self.assertIsInstance(agg.connect_errors["m3-3"], ConnectionRefusedError)
+        self.assertIsInstance(agg.connect_errors["m3-4"], socket.gaierror)
+        self.assertEqual(4, len(agg.connect_times))
+        self.assertEqual(
+            [("m3-1", "one"), ("m3-1", "two"), ("m3-2", "one"), ("m3-2", "two")],
+            sorted(lines),
+        )
+        self.assertEqual(["m3-3", "m3-4"], sorted(agg))
+
+    async def test_packets(self):
+        self.data = b"garbage" + ZEP_MESSAGE + ZEP_MESSAGE[:10]
+        agg = SnifferAggregator(["m3-1", "m3-2"])
+        async with agg:
+            packets = [pkt async for pkt in agg.packets()]
+        self.assertEqual(
+            [("m3-1", ZEP_MESSAGE), ("m3-2", ZEP_MESSAGE)], sorted(packets)
+        )
+        self.assertEqual(2, agg.rx_packets)
+
+    async def test_no_node_connected(self):
+        agg = SerialAggregator(["m3-3", "m3-4"])
+        async with agg:
+            self.assertEqual([], [line async for line in agg.lines()])
+
+    async def test_backpressure(self):
+        self.data = b"line\n" * 1000
+        agg = SerialAggregator(["m3-1"])
+        agg.queue_size = 10
+        async with agg:
+            lines = agg.lines()
+            self.assertEqual(("m3-1", "line"), await anext(lines))
+            transport = agg._transports[agg["m3-1"]]
+            self.assertFalse(transport.is_reading())
+            count = 1 + len([line async for line in lines])
+        self.assertEqual(1000, count)
+
+    async def test_send(self):
+        agg = SerialAggregator(["m3-1", "m3-3"])
+        async with agg:
+            agg.broadcast("hello\n")
+            self.assertEqual(b"hello\n", await self.received.get())
+            agg.send_nodes(["m3-1", "m3-3", "unknown"], "world\n")
+            self.assertEqual(b"world\n", await self.received.get())
+
+    async def test_stop(self):
+        agg = SerialAggregator(["m3-1"])
+        await agg.start()
+        lines = agg.lines()
+        task = asyncio.ensure_future(anext(lines, None))
+        await agg.stop()
+        self.assertIsNone(await task)
+
+
+class TestRun(unittest.TestCase):
+    async def _main(self):
+        return 42
+
+    @patch("iotlabaggregator.aio.HAS_UVLOOP", False)
+    def test_run(self):
+        self.assertEqual(42, aio.run(self._main()))
+
+    @patch("iotlabaggregator.aio.HAS_UVLOOP", True)
+    def test_run_uvloop(self):
+        with patch("iotlabaggregator.aio.uvloop", create=True) as uvloop:
+            main = self._main()
+            aio.run(main)
+            main.close()
+        uvloop.run.assert_called_with(main)
@@ -19,6 +19,10 @@
 # The fact that you are presently reading this means that you have had
 # knowledge of the CeCILL license and that you accept its terms.
 
+import json
+import os
+import shutil
+import tempfile
 import unittest
 from io import StringIO
 from unittest.mock import patch
@@ -29,7 +33,7 @@ from iotlabaggregator import common
 
 class TestCommonFunctions(unittest.TestCase):
     @patch("iotlabcli.get_current_experiment")
-    @patch("iotlabaggregator.common.experiment.get_experiment")
+    @patch("iotlabcli.experiment.get_experiment")
     def test_query_nodes(self, get_exp, get_cur_exp):
         api = None
         resources = {
@@ -90,7 +94,29 @@ class TestCommonFunctions(unittest.TestCase):
             username=None, password=None, experiment_id=None, nodes_list=()
         )
         self.assertEqual(["a8-1", "m3-1"], ret)
-        query_nodes.assert_called_with(api.return_value, None, ())
+        query_nodes.assert_called_with(api.return_value, None, (), cache=None)
+
+    @patch("iotlabaggregator.common.query_nodes")
+    def test_get_nodes_selection_hosts_file(self, query_nodes):
+        hosts = StringIO("# replay\n127.0.0.3 m3-2\n127.0.0.2 m3-1 alias\n")
+        with patch("builtins.open", return_value=hosts):
+            ret = common.get_nodes_selection(
+                username=None,
+                password=None,
+                experiment_id=None,
+                nodes_list=(),
+                hosts_file="hosts",
+            )
+        self.assertEqual(["m3-1", "m3-2"], ret)
+        query_nodes.assert_not_called()
+
+    def test_read_hosts_file(self):
+        hosts = StringIO("127.0.0.2 m3-1\n\n127.0.0.3 m3-2 # comment\ninvalid\n")
+        with patch("builtins.open", return_value=hosts):
+            self.assertEqual(
+                {"m3-1": "127.0.0.2", "m3-2": "127.0.0.3"},
+                common.read_hosts_file("hosts"),
+            )
 
     @patch("iotlabcli.get_user_credentials")
     @patch("iotlabaggregator.common.query_nodes")
@@ -112,3 +138,110 @@ class TestCommonFunctions(unittest.TestCase):
         self.assertIn(
             "Register your login:password using `iotlab-auth`", stderr.getvalue()
         )
+
+
+RESOURCES = {
+    "items": [
+        {"network_address": "m3-1.grenoble.iot-lab.info", "site": "grenoble"},
+        {"network_address": "m3-2.grenoble.iot-lab.info", "site": "grenoble"},
+    ]
+}
+
+
+class TestNodesCache(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp)
+        patch.dict(os.environ, {"XDG_CACHE_HOME": self.tmp}).start()
+        patch("iotlabaggregator.common._hostname", return_value="grenoble").start()
+        patch("iotlabcli.get_user_credentials", return_value=("user", "pwd")).start()
+        # Stubbed API, no request is ever sent
+        self.api = patch("iotlabcli.Api").start()
+        self.cur_exp = patch("iotlabcli.get_current_experiment").start()
+        self.cur_exp.return_value = 123
+        self.get_exp = patch("iotlabcli.experiment.get_experiment").start()
+        self.get_exp.return_value = RESOURCES
+        self.addCleanup(patch.stopall)
+
+    def select(self, **kwargs):
+        kwargs.setdefault("experiment_id", None)
+        return common.get_nodes_selection(
+            username=None, password=None, nodes_list=(), **kwargs
+        )
+
+    def test_cache(self):
+        self.assertEqual(["m3-1", "m3-2"], self.select(nodes_cache_ttl=60))
+        self.assertEqual(1, self.get_exp.call_count)
+        # current experiment is cached by its id
+        self.assertEqual(["m3-1", "m3-2"], self.select(nodes_cache_ttl=60))
+        self.assertEqual(
+            ["m3-1", "m3-2"], self.select(nodes_cache_ttl=60, experiment_id=123)
+        )
+        self.assertEqual(2, self.cur_exp.call_count)
+        self.assertEqual(1, self.get_exp.call_count)
+        # another experiment
+        self.select(nodes_cache_ttl=60, experiment_id=124)
+        self.assertEqual(2, self.get_exp.call_count)
+        # no cache by default
+        self.select()
+        self.assertEqual(3, self.get_exp.call_count)
+
+    def test_cache_new_experiment(self):
+        self.select(nodes_cache_ttl=60)
+        # A new current experiment, not the previous one cached nodes
+        self.cur_exp.return_value = 124
+        self.get_exp.return_value = {"items": RESOURCES["items"][:1]}
+        self.assertEqual(["m3-1"], self.select(nodes_cache_ttl=60))
+        self.assertEqual(2, self.get_exp.call_count)
+        self.get_exp.assert_called_with(self.api.return_value, 124, "nodes")
+
+    def test_cache_refresh(self):
+        self.select(nodes_cache_ttl=60)
+        self.select(nodes_cache_ttl=60, refresh_nodes=True)
+        self.assertEqual(2, self.get_exp.call_count)
+        self.select(nodes_cache_ttl=60)
+        self.assertEqual(2, self.get_exp.call_count)
+
+    def test_cache_expired(self):
+        cache = common.NodesCache("user", 60)
+        cache.set(123, "grenoble", ["m3-1"])
+        self.assertEqual(["m3-1"], cache.get(123, "grenoble"))
+        with patch(
+            "time.time", return_value=os.path.getmtime(cache.path(123, "grenoble")) + 61
+        ):
+            self.assertIsNone(cache.get(123, "grenoble"))
+        self.assertIsNone(cache.get(124, "grenoble"))
+        self.assertIsNone(common.NodesCache("other", 60).get(123, "grenoble"))
+
+    def test_cache_invalid_entry(self):
+        cache = common.NodesCache("user", 60)
+        os.makedirs(cache.directory)
+        for content in ("not json", "[]", json.dumps({"nodes": []})):
+            with open(cache.path(123, "grenoble"), "w", encoding="utf-8") as entry:
+                entry.write(content)
+            self.assertIsNone(cache.get(123, "grenoble"))
+        cache.invalidate(123, "grenoble")
+        cache.invalidate(123, "grenoble")
+        self.assertFalse(os.listdir(cache.directory))
+
+    def test_cache_user_path(self):
+        cache = common.NodesCache("../user", 60, directory=self.tmp)
+        self.assertEqual(
+            os.path.join(self.tmp, "nodes-..%2Fuser-123-grenoble.json"),
+            cache.path(123, "grenoble"),
+        )
+
+    def test_offline_nodes(self):
+        path = os.path.join(self.tmp, "nodes.txt")
+        self.assertEqual(["m3-1", "m3-2"], self.select(offline_nodes=path))
+        with open(path, encoding="utf-8") as nodes_file:
+            self.assertEqual("m3-1\nm3-2\n", nodes_file.read())
+        self.api.reset_mock()
+        self.assertEqual(["m3-1", "m3-2"], self.select(offline_nodes=path))
+        self.assertEqual(1, self.get_exp.call_count)
+        self.api.assert_not_called()
+
+    def test_read_nodes_file(self):
+        nodes = StringIO("# nodes\nm3-2\n\nm3-1  # first\n")
+        with patch("builtins.open", return_value=nodes):
+            self.assertEqual(["m3-1", "m3-2"], common.read_nodes_file("nodes"))
@@ -0,0 +1,149 @@
+#! /usr/bin/python
+
+# This file is a part of IoT-LAB aggregation-tools
+# Copyright (C) 2015 INRIA (Contact: admin@iot-lab.info)
+# Contributor(s) : see AUTHORS file
+#
+# This software is governed by the CeCILL license under French law
+# and abiding by the rules of distribution of free software.  You can  use,
+# modify and/ or redistribute the software under the terms of the CeCILL
+# license as circulated by CEA, CNRS and INRIA at the following URL
+# http://www.cecill.info.
+#
+# As a counterpart to the access to the source code and  rights to copy,
+# modify and redistribute granted by the license, users are provided only
+# with a limited warranty  and the software's author,  the holder of the
+# economic rights,  and the successive licensors  have only  limited
+# liability.
+#
+# The fact that you are presently reading this means that you have had
+# knowledge of the CeCILL license and that you accept its terms.
+
+"""Tests for iotlabaggregator.compress"""
+
+import gzip
+import io
+import threading
+import unittest
+import zlib
+from unittest import mock
+
+from iotlabaggregator import compress, serial
+
+
+class TestCompressedFile(unittest.TestCase):
+    def test_gzip(self):
+        out = io.BytesIO()
+        with compress.CompressedFile(out, "gzip") as compressed:
+            for _ in range(1000):
+                compressed.write(b"1700000000.000000;m3-1;hello\n")
+        self.assertFalse(out.closed)
+        data = out.getvalue()
+        self.assertLess(len(data), 1000)
+        self.assertEqual(
+            b"1700000000.000000;m3-1;hello\n" * 1000, gzip.decompress(data)
+        )
+
+    def test_flush_sync(self):
+        out = io.BytesIO()
+        compressed = compress.CompressedFile(out)
+        compressed.sync_interval = 0
+        compressed.write(b"first")
+        written = threading.Event()
+        out.flush = mock.Mock(side_effect=written.set)
+        compressed.flush()
+        self.assertTrue(written.wait(5))
+        # Readable without the end of stream
+        decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        self.assertEqual(b"first", decompressor.decompress(out.getvalue()))
+        compressed.close()
+
+    def test_deferred_sync(self):
+        out = io.BytesIO()
+        compressed = compress.CompressedFile(out)
+        compressed.sync_interval = 0.1
+        compressed.write(b"first")
+        written = threading.Event()
+        out.flush = mock.Mock(side_effect=written.set)
+        # Within sync_interval of the start: synced at the end of the interval
+        compressed.flush()
+        self.assertTrue(written.wait(5))
+        decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        self.assertEqual(b"first", decompressor.decompress(out.getvalue()))
+        out.flush.assert_called_once_with()
+        compressed.close()
+
+    def test_write_error(self):
+        out = mock.Mock()
+        out.write.side_effect = OSError("disk full")
+        compressed = compress.CompressedFile(out)
+        compressed.write(b"data")
+        self.assertRaises(OSError, compressed.close)
+        self.assertRaises(OSError, compressed.write, b"data")
+
+    @unittest.skipUnless(compress.HAS_ZSTD, "zstandard not installed")
+    def test_zstd(self):  # pragma: no cover
+        out = io.BytesIO()
+        with compress.CompressedFile(out, "zstd") as compressed:
+            compressed.write(b"hello\n" * 100)
+        reader = compress.zstandard.ZstdDecompressor().stream_reader(
+            io.BytesIO(out.getvalue())
+        )
+        self.assertEqual(b"hello\n" * 100, reader.read())
+
+    @unittest.skipUnless(compress.HAS_LZ4, "lz4 not installed")
+    def test_lz4(self):  # pragma: no cover
+        out = io.BytesIO()
+        compressed = compress.CompressedFile(out, "lz4")
+        compressed.sync_interval = 0
+        compressed.write(b"hello\n" * 100)
+        compressed.flush()
+        compressed.write(b"world\n")
+        compressed.close()
+        self.assertEqual(
+            b"hello\n" * 100 + b"world\n", compress.lz4.frame.decompress(out.getvalue())
+        )
+
+
+class TestDecompressors(unittest.TestCase):
+    def test_sync_chunks(self):
+        for method, decompressor_class in compress.DECOMPRESSORS.items():
+            compressor = compress.COMPRESSORS[method]()
+            decompressor = decompressor_class()
+            for data in (b"hello\n", b"world\n"):
+                chunk = compressor.compress(data) + compressor.sync()
+                self.assertEqual(data, decompressor.decompress(chunk), method)
+            self.assertRaises(ValueError, decompressor.decompress, b"invalid")
+
+    def test_max_length(self):
+        for method, decompressor_class in compress.DECOMPRESSORS.items():
+            compressor = compress.COMPRESSORS[method]()
+            decompressor = decompressor_class()
+            chunk = compressor.compress(bytes(100)) + compressor.sync()
+            self.assertEqual(bytes(100), decompressor.decompress(chunk, 100))
+            chunk = compressor.compress(bytes(101)) + compressor.sync()
+            self.assertRaises(ValueError, decompressor.decompress, chunk, 100)
+
+
+class TestSerialCompress(unittest.TestCase):
+    def test_main(self):
+        stdout = mock.Mock()
+        stdout.buffer = io.BytesIO()
+        parser = serial.SerialAggregator.parser
+        with (
+            mock.patch("sys.stdout", stdout),
+            mock.patch.object(serial, "SerialAggregator") as aggregator_class,
+        ):
+            aggregator_class.parser = parser
+            aggregator_class.select_nodes.return_value = ["m3-1"]
+            serial.main(["--compress", "gzip"])
+        outfd = aggregator_class.call_args[1]["outfd"]
+        self.assertIsInstance(outfd, compress.CompressedFile)
+        self.assertTrue(outfd.closed)
+        self.assertEqual(b"", gzip.decompress(stdout.buffer.getvalue()))
+
+    def test_record_error(self):
+        with mock.patch("sys.stderr", io.StringIO()):
+            self.assertRaises(
+                SystemExit, serial.main, ["--compress", "gzip", "--record", "x"]
+            )
@@ -21,6 +21,11 @@
 
 """Tests for iotlabaggregator.connections"""
 
+import errno
+import selectors
+import socket
+import threading
+import time
 import unittest
 from unittest.mock import MagicMock, Mock, patch
 
@@ -37,14 +42,14 @@ class TestConnection(unittest.TestCase):
     def test_init(self):
         conn = self._make_conn()
         self.assertEqual("m3-1", conn.hostname)
-        self.assertEqual("", conn.data_buff)
+        self.assertEqual(bytearray(), conn.data_buff)
         self.assertIsNone(conn._sock)
 
     def test_handle_data_default(self):
         conn = self._make_conn()
-        # Base implementation returns empty string (remaining unprocessed data)
-        remaining = conn.handle_data("some data")
-        self.assertEqual("", remaining)
+        # Base implementation consumes all the data
+        consumed = conn.handle_data(b"some data")
+        self.assertEqual(9, consumed)
 
     def test_handle_close(self):
         conn = self._make_conn()
@@ -69,31 +74,110 @@ class TestConnection(unittest.TestCase):
         conn.close()  # should not raise
         self.assertIsNone(conn._sock)
 
+    @staticmethod
+    def _recv_into(*chunks):
+        chunks = list(chunks)
+
+        def recv_into(buff):
+            data = chunks.pop(0)
+            buff[: len(data)] = data
+            return len(data)
+
+        return Mock(side_effect=recv_into)
+
     def test_handle_read(self):
         conn = self._make_conn()
-        conn.recv = Mock(return_value=b"hello\nworld\n")
-        conn.handle_data = Mock(return_value="")
+        conn.recv_into = self._recv_into(b"hello\nworld\n")
+        conn.handle_data = Mock(return_value=0)
+        conn.handle_read()
+        conn.handle_data.assert_called_once_with(bytearray(b"hello\nworld\n"))
+
+    def test_handle_read_eof(self):
+        conn = self._make_conn()
+        conn.recv_into = self._recv_into(b"partial", b"")
+        conn.handle_data = Mock(return_value=0)
         conn.handle_read()
-        conn.handle_data.assert_called_once_with("hello\nworld\n")
+        conn.handle_read()
+        conn.handle_data.assert_called_once()
+        conn.aggregator.connection_lost.assert_called_once_with(conn)
+
+    def test_handle_read_keeps_unconsumed(self):
+        conn = self._make_conn()
+        conn.recv_into = self._recv_into(b"hello\nwor", b"ld\n")
+        conn.handle_data = Mock(side_effect=lambda data: data.rfind(b"\n") + 1)
+        conn.handle_read()
+        self.assertEqual(bytearray(b"wor"), conn.data_buff)
+        conn.handle_read()
+        self.assertEqual(bytearray(), conn.data_buff)
+
+    def test_handle_read_grows_buffer(self):
+        conn = self._make_conn()
+        conn.recv_size = 4
+        conn.recv_into = self._recv_into(b"abcd", b"efgh", b"ij")
+        conn.handle_data = Mock(return_value=0)
+        for _ in range(3):
+            conn.handle_read()
+        self.assertEqual(bytearray(b"abcdefghij"), conn.data_buff)
 
     def test_send(self):
         conn = self._make_conn()
-        sock = Mock()
-        conn._sock = sock
         conn.send(b"hello")
-        sock.sendall.assert_called_with(b"hello")
+        conn.aggregator.send_data.assert_called_with([conn], b"hello")
 
-    def test_send_no_socket(self):
+    def test_queue_send_not_connected(self):
         conn = self._make_conn()
-        conn._sock = None
-        conn.send(b"hello")  # should not raise
+        with self.assertRaises(OSError) as ctx:
+            conn.queue_send(b"hello")
+        self.assertEqual(errno.ENOTCONN, ctx.exception.errno)
+        self.assertEqual(b"", conn.send_buff)
 
-    def test_send_socket_error(self):
+    def test_queue_send_full(self):
         conn = self._make_conn()
-        sock = Mock()
-        sock.sendall.side_effect = OSError("broken pipe")
-        conn._sock = sock
-        conn.send(b"hello")  # should not raise
+        conn.connected = True
+        conn.max_send_size = 8
+        conn.queue_send(b"hello")
+        with self.assertRaises(OSError) as ctx:
+            conn.queue_send(b"hello")
+        self.assertEqual(errno.ENOBUFS, ctx.exception.errno)
+        self.assertEqual(b"hello", conn.send_buff)
+
+    def test_handle_write_partial(self):
+        conn = self._make_conn()
+        conn._sock = Mock()
+        conn._sock.send.side_effect = [3, BlockingIOError, 2]
+        conn.connected = True
+        conn.queue_send(b"hello")
+        self.assertFalse(conn.handle_write())
+        self.assertEqual(b"lo", conn.send_buff)
+        self.assertFalse(conn.handle_write())
+        self.assertTrue(conn.handle_write())
+        self.assertEqual(5, conn.stats.tx_bytes)
+
+    def test_handle_write_error(self):
+        conn = self._make_conn()
+        conn._sock = Mock()
+        conn._sock.send.side_effect = OSError("broken pipe")
+        conn.connected = True
+        conn.queue_send(b"hello")
+        self.assertRaises(OSError, conn.handle_write)
+
+    def test_handle_read_would_block(self):
+        conn = self._make_conn()
+        conn.recv_into = Mock(side_effect=BlockingIOError)
+        conn.handle_data = Mock()
+        conn.handle_read()
+        conn.handle_data.assert_not_called()
+        self.assertEqual(b"", conn.data_buff)
+
+    def test_handle_read_stats(self):
+        conn = self._make_conn()
+        conn.recv_into = self._recv_into(b"hello\nwor", b"ld\n")
+        conn.handle_data = Mock(side_effect=lambda data: data.rfind(b"\n") + 1)
+        conn.handle_read()
+        conn.handle_read()
+        self.assertEqual(2, conn.stats.recv_calls)
+        self.assertEqual(12, conn.stats.rx_bytes)
+        self.assertEqual(9, conn.stats.buffer_max)
 
     def test_handle_error(self):
         conn = self._make_conn()
@@ -105,6 +189,170 @@ class TestConnection(unittest.TestCase):
             mock_logger.error.assert_called_once()
 
 
+class TestItemsQueue(unittest.TestCase):
+    def test_get_all(self):
+        queue = connections.ItemsQueue(4)
+        self.assertEqual([], queue.get_all(0.01))
+        queue.put(1)
+        queue.put(2)
+        self.assertEqual([1, 2], queue.get_all())
+        queue.put(3)
+        queue.close()
+        queue.put(4)
+        self.assertEqual([3], queue.get_all())
+        self.assertIsNone(queue.get_all())
+
+    def test_put_full(self):
+        queue = connections.ItemsQueue(2)
+        queue.put(1)
+        queue.put(2)
+        thread = threading.Thread(target=queue.put, args=(3,))
+        thread.start()
+        thread.join(0.05)
+        self.assertTrue(thread.is_alive())
+        self.assertEqual([1, 2], queue.get_all())
+        thread.join(2)
+        self.assertEqual([3], queue.get_all())
+
+    def test_close_full(self):
+        queue = connections.ItemsQueue(1)
+        queue.put(1)
+        thread = threading.Thread(target=queue.put, args=(2,))
+        thread.start()
+        queue.close()
+        thread.join(2)
+        self.assertFalse(thread.is_alive())
+        self.assertEqual([1], queue.get_all())
+
+
+class LocalConnection(connections.Connection):
+    """Connection resolving hostnames with ``addresses``."""
+
+    addresses = {}
+
+    def resolve(self):
+        address = self.addresses[self.hostname]
+        if address is None:
+            raise socket.gaierror(socket.EAI_NONAME, "Name or service not known")
+        if address == "slow":
+            time.sleep(1)
+        return (socket.AF_INET, socket.SOCK_STREAM, 0, "", address)
+
+
+class LinesConnection(LocalConnection):
+    """Connection saving received lines in ``lines``."""
+
+    lines = []
+
+    def handle_data(self, data):
+        end = data.rfind(b"\n") + 1
+        self.lines.extend(bytes(data[:end]).splitlines())
+        return end
+
+
+class LocalAggregator(connections.Aggregator):
+    connection_class = LinesConnection
+
+
+def wait_for(condition, timeout=2.0):
+    """Wait until ``condition()`` is true."""
+    end = time.monotonic() + timeout
+    while not condition() and time.monotonic() < end:
+        time.sleep(0.01)
+    return condition()
+
+
+class TestAggregatorStart(unittest.TestCase):
+    """Test concurrent nodes connection."""
+
+    def setUp(self):
+        self.server = socket.create_server(("127.0.0.1", 0))
+        self.addCleanup(self.server.close)
+        with socket.create_server(("127.0.0.1", 0)) as closed:
+            closed_address = closed.getsockname()
+        LocalConnection.addresses = {
+            "m3-1": self.server.getsockname(),
+            "m3-2": closed_address,
+            "m3-3": None,
+            "m3-4": "slow",
+        }
+
+    def test_start(self):
+        agg = LocalAggregator(sorted(LocalConnection.addresses), connect_timeout=0.3)
+        with patch("iotlabaggregator.connections.LOGGER") as logger:
+            with agg:
+                wait_for(lambda: len(agg.connect_times) == len(agg))
+                self.assertTrue(agg["m3-1"].connected)
+        self.assertEqual(["m3-2", "m3-3", "m3-4"], sorted(agg.connect_errors))
+        self.assertIsInstance(agg.connect_errors["m3-2"], ConnectionRefusedError)
+        self.assertIsInstance(agg.connect_errors["m3-3"], socket.gaierror)
+        self.assertIsInstance(agg.connect_errors["m3-4"], TimeoutError)
+        self.assertGreaterEqual(agg.connect_times["m3-4"], 0.3)
+        self.assertEqual(3, logger.error.call_count)
+        logger.info.assert_any_call(
+            "%u/%u nodes connected, failed: %s, slowest: %s (%.3fs)",
+            1,
+            4,
+            "m3-2,m3-3,m3-4",
+            "m3-4",
+            agg.connect_times["m3-4"],
+        )
+        self.assertFalse(agg["m3-1"].connected)
+
+    def _serve(self, data):
+        """Accept one connection, send ``data`` and close it."""
+        self.server.settimeout(2)
+        sock, _ = self.server.accept()
+        sock.sendall(data)
+        sock.close()
+
+    @patch("iotlabaggregator.connections.os.kill")
+    def test_loop_error(self, kill):
+        out = Mock(timeout=None)
+        out.idle.side_effect = OSError("output failed")
+        agg = LocalAggregator(["m3-1"])
+        agg.outputs.append(out)
+        with patch("iotlabaggregator.connections.LOGGER") as logger:
+            with agg:
+                agg.thread.join(2)
+                self.assertFalse(agg.thread.is_alive())
+        logger.exception.assert_called_once_with("Selector loop failed")
+        kill.assert_called_once()
+
+    @patch("iotlabaggregator.connections.LOGGER", Mock())
+    def test_reconnect(self):
+        LinesConnection.lines = []
+        agg = LocalAggregator(["m3-1"], reconnect=True)
+        agg.reconnect_delay = 0.01
+        with agg:
+            self._serve(b"one\ntwo\npartial")
+            self._serve(b"three\n")
+            self.assertTrue(wait_for(lambda: len(LinesConnection.lines) == 3))
+            self.assertIn("m3-1", agg)
+        self.assertEqual([b"one", b"two", b"three"], LinesConnection.lines)
+
+    @patch("iotlabaggregator.connections.LOGGER", Mock())
+    def test_reconnect_after_failure(self):
+        LocalConnection.addresses["m3-1"] = LocalConnection.addresses["m3-2"]
+        agg = LocalAggregator(["m3-1"], reconnect=True)
+        agg.reconnect_delay = 0.01
+        with agg:
+            self.assertTrue(wait_for(lambda: agg._failures.get(agg["m3-1"], 0) > 2))
+            LocalConnection.addresses["m3-1"] = self.server.getsockname()
+            self.assertTrue(wait_for(lambda: agg["m3-1"].connected))
+        self.assertEqual({}, agg.connect_errors)
+
+    @patch("iotlabaggregator.connections.os.kill")
+    @patch("iotlabaggregator.connections.LOGGER", Mock())
+    def test_no_reconnect(self, kill):
+        agg = LocalAggregator(["m3-1"])
+        with agg:
+            self._serve(b"")
+            agg.thread.join(2)
+            self.assertNotIn("m3-1", agg)
+        kill.assert_called_once()
+
+
 class TestAggregator(unittest.TestCase):
     """Tests for the Aggregator class."""
 
@@ -124,25 +372,83 @@ class TestAggregator(unittest.TestCase):
 
     def test_broadcast(self):
         agg = connections.Aggregator(["m3-1", "m3-2"])
-        agg["m3-1"].send = Mock()
-        agg["m3-2"].send = Mock()
+        agg.send_data = Mock()
         agg.broadcast("hello")
-        agg["m3-1"].send.assert_called_once_with(b"hello")
-        agg["m3-2"].send.assert_called_once_with(b"hello")
+        agg.send_data.assert_called_once_with([agg["m3-1"], agg["m3-2"]], b"hello")
 
     def test_send_nodes_broadcast(self):
         agg = connections.Aggregator(["m3-1"])
-        agg["m3-1"].send = Mock()
+        agg.send_data = Mock()
         agg.send_nodes(None, "hello")
-        agg["m3-1"].send.assert_called_once_with(b"hello")
+        agg.send_data.assert_called_once_with([agg["m3-1"]], b"hello")
 
     def test_send_nodes_specific(self):
         agg = connections.Aggregator(["m3-1", "m3-2"])
-        agg["m3-1"].send = Mock()
-        agg["m3-2"].send = Mock()
+        agg.send_data = Mock()
         agg.send_nodes(["m3-1"], "hello")
-        agg["m3-1"].send.assert_called_once_with(b"hello")
-        agg["m3-2"].send.assert_not_called()
+        agg.send_data.assert_called_once_with([agg["m3-1"]], b"hello")
+
+    def _send_pair(self, agg, node):
+        """Connect ``node`` to a socketpair registered in ``agg``."""
+        sock, peer = socket.socketpair()
+        self.addCleanup(sock.close)
+        self.addCleanup(peer.close)
+        sock.setblocking(False)
+        peer.setblocking(False)
+        node._sock = sock
+        node.connected = True
+        agg._selector.register(sock, selectors.EVENT_READ, data=node)
+        self.addCleanup(agg._selector.close)
+        return peer
+
+    def test_send_data(self):
+        agg = connections.Aggregator(["m3-1", "m3-2"])
+        peer = self._send_pair(agg, agg["m3-1"])
+        agg.send_done = Mock()
+        agg.send_data(list(agg.values()), b"hello")
+        agg._run_calls()
+        self.assertEqual(b"hello", peer.recv(16))
+        agg.send_done.assert_any_call(agg["m3-1"])
+        node, err = agg.send_done.call_args_list[1][0]
+        self.assertIs(agg["m3-2"], node)
+        self.assertEqual(errno.ENOTCONN, err.errno)
+
+    def test_send_data_wait_writable(self):
+        agg = connections.Aggregator(["m3-1"])
+        node = agg["m3-1"]
+        peer = self._send_pair(agg, node)
+        node._sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, 4096)
+        data = bytes(1 << 18)
+        agg.send_done = Mock()
+        agg.send_data([node], data)
+        agg._run_calls()
+        agg.send_done.assert_not_called()
+        key = agg._selector.get_key(node._sock)
+        self.assertEqual(selectors.EVENT_READ | selectors.EVENT_WRITE, key.events)
+        received = bytearray()
+        while len(received) < len(data):
+            try:
+                received += peer.recv(1 << 16)
+            except BlockingIOError:
+                agg._handle_event(key, selectors.EVENT_WRITE)
+        self.assertEqual(data, received)
+        agg.send_done.assert_called_once_with(node)
+        key = agg._selector.get_key(node._sock)
+        self.assertEqual(selectors.EVENT_READ, key.events)
+        self.assertEqual(len(data), node.stats.tx_bytes)
+
+    def test_send_data_error(self):
+        agg = connections.Aggregator(["m3-1"])
+        node = agg["m3-1"]
+        peer = self._send_pair(agg, node)
+        peer.close()
+        agg.connection_lost = Mock()
+        with patch("iotlabaggregator.connections.LOGGER") as mock_logger:
+            agg.send_data([node], b"hello")
+            agg._run_calls()
+            mock_logger.warning.assert_called_once()
+        agg.connection_lost.assert_called_once_with(node)
+        self.assertEqual(1, node.stats.send_errors)
 
     def test_send_unknown_node(self):
         agg = connections.Aggregator(["m3-1"])
@@ -158,6 +464,11 @@ class TestAggregator(unittest.TestCase):
             agg.start.assert_called_once()
         agg.stop.assert_called_once()
 
+    def test_hosts(self):
+        agg = connections.Aggregator(["m3-1", "m3-2"], hosts={"m3-1": "127.0.0.2"})
+        self.assertEqual("127.0.0.2", agg["m3-1"].host)
+        self.assertEqual("m3-2", agg["m3-2"].host)
+
     def test_custom_connection_class(self):
         class MyConn(connections.Connection):
             pass
@@ -189,3 +500,25 @@ class TestAggregator(unittest.TestCase):
         agg._loop()
         t.join()
         # Should exit without sending SIGINT (self._running is False)
+
+    def test_loop_outputs(self):
+        """Outputs are notified when idle and flushed on stop."""
+        agg = connections.Aggregator(["m3-1"])
+        out = Mock()
+        out.timeout = 0.01
+        agg.outputs.append(out)
+        agg._selector = MagicMock()
+        agg._running = True
+
+        def select(timeout):
+            self.assertEqual(0.01, timeout)
+            agg._running = False
+            return []
+
+        agg._selector.select.side_effect = select
+        agg._loop()
+        out.idle.assert_called_once()
+
+        agg.thread = Mock()
+        agg.stop()
+        out.flush.assert_called_once()
@@ -0,0 +1,163 @@
+#! /usr/bin/python
+
+# This file is a part of IoT-LAB aggregation-tools
+# Copyright (C) 2015 INRIA (Contact: admin@iot-lab.info)
+# Contributor(s) : see AUTHORS file
+#
+# This software is governed by the CeCILL license under French law
+# and abiding by the rules of distribution of free software.  You can  use,
+# modify and/ or redistribute the software under the terms of the CeCILL
+# license as circulated by CEA, CNRS and INRIA at the following URL
+# http://www.cecill.info.
+#
+# As a counterpart to the access to the source code and  rights to copy,
+# modify and redistribute granted by the license, users are provided only
+# with a limited warranty  and the software's author,  the holder of the
+# economic rights,  and the successive licensors  have only  limited
+# liability.
+#
+# The fact that you are presently reading this means that you have had
+# knowledge of the CeCILL license and that you accept its terms.
+
+"""Tests for iotlabaggregator.dispatch"""
+
+import threading
+import unittest
+from unittest.mock import patch
+
+from iotlabaggregator import dispatch
+from iotlabaggregator.tests.connections_test import wait_for
+
+
+class TestDispatcher(unittest.TestCase):
+    def setUp(self):
+        self.calls = []
+        self.release = threading.Event()
+
+    def _dispatcher(self, *args, **kwargs):
+        dispatcher = dispatch.Dispatcher(*args, **kwargs)
+        self.addCleanup(dispatcher.close)
+        self.addCleanup(self.release.set)
+        return dispatcher
+
+    def record(self, node, item):
+        """Handler recording calls."""
+        self.calls.append((node, item))
+
+    def wait(self, node, item):
+        """Handler waiting for ``release``."""
+        self.release.wait(2)
+        self.calls.append((node, item))
+
+    def test_node_order(self):
+        dispatcher = self._dispatcher(workers=4, queue_size=10)
+        for item in range(100):
+            for node in ("m3-1", "m3-2", "m3-3"):
+                dispatcher.submit(node, (self.record,), [(node, item)])
+        dispatcher.close()
+        for node in ("m3-1", "m3-2", "m3-3"):
+            items = [item for name, item in self.calls if name == node]
+            self.assertEqual(list(range(100)), items)
+        stats = dispatcher.stats[self.record]
+        self.assertEqual(300, stats.calls)
+        self.assertGreater(stats.seconds, 0.0)
+        self.assertGreaterEqual(stats.seconds, stats.max_seconds)
+
+    def test_nodes_parallel(self):
+        barrier = threading.Barrier(2, timeout=2)
+        dispatcher = self._dispatcher(workers=2)
+        dispatcher.submit("m3-1", (lambda: barrier.wait(),), [()])
+        dispatcher.submit("m3-2", (lambda: barrier.wait(),), [()])
+        dispatcher.close()
+        self.assertFalse(barrier.broken)
+
+    def test_node_serialized(self):
+        dispatcher = self._dispatcher(workers=2)
+        dispatcher.submit("m3-1", (self.wait,), [("m3-1", 1)])
+        dispatcher.submit("m3-1", (self.record,), [("m3-1", 2)])
+        # m3-2 is handled while m3-1 waits
+        dispatcher.submit(
+            "m3-2", (self.record, lambda *_: self.release.set()), [("m3-2", 1)]
+        )
+        dispatcher.close()
+        self.assertEqual([("m3-2", 1), ("m3-1", 1), ("m3-1", 2)], self.calls)
+
+    def test_handlers_order(self):
+        dispatcher = self._dispatcher(workers=1)
+        handlers = (self.record, lambda node, item: self.record(node, -item))
+        dispatcher.submit("m3-1", handlers, [("m3-1", 1), ("m3-1", 2)])
+        dispatcher.submit("m3-1", (), [("m3-1", 3)])
+        dispatcher.close()
+        expected = [("m3-1", 1), ("m3-1", -1), ("m3-1", 2), ("m3-1", -2)]
+        self.assertEqual(expected, self.calls)
+
+    def test_block(self):
+        dispatcher = self._dispatcher(workers=1, queue_size=1)
+        dispatcher.submit("m3-1", (self.wait,), [("m3-1", 1)])
+        # Running calls are not queued anymore
+        self.assertTrue(wait_for(lambda: not dispatcher._queues["m3-1"]))
+        dispatcher.submit("m3-1", (self.record,), [("m3-1", 2)])
+        thread = threading.Thread(
+            target=dispatcher.submit, args=("m3-1", (self.record,), [("m3-1", 3)])
+        )
+        thread.start()
+        thread.join(0.05)
+        self.assertTrue(thread.is_alive())
+        self.release.set()
+        thread.join(2)
+        dispatcher.close()
+        self.assertEqual([("m3-1", 1), ("m3-1", 2), ("m3-1", 3)], self.calls)
+
+    def test_drop(self):
+        for policy, expected in (
+            (dispatch.DROP_NEWEST, [1, 2]),
+            (dispatch.DROP_OLDEST, [1, 3]),
+        ):
+            self.calls = []
+            self.release.clear()
+            dispatcher = dispatch.Dispatcher(workers=1, queue_size=1, policy=policy)
+            dispatcher.submit("m3-1", (self.wait,), [("m3-1", 1)])
+            self.assertTrue(wait_for(lambda: not dispatcher._queues["m3-1"]))
+            dispatcher.submit("m3-1", (self.wait,), [("m3-1", 2)])
+            dispatcher.submit("m3-1", (self.wait,), [("m3-1", 3)])
+            self.release.set()
+            dispatcher.close()
+            self.assertEqual(expected, [item for _, item in self.calls])
+            stats = dispatcher.stats[self.wait]
+            self.assertEqual(1, stats.dropped)
+            self.assertEqual(2, stats.calls)
+
+    @patch("iotlabaggregator.dispatch.LOGGER")
+    def test_errors(self, logger):
+        def fail(item):
+            raise ValueError(item)
+
+        dispatcher = self._dispatcher(workers=1)
+        dispatcher.submit("m3-1", (fail, self.calls.append), [(1,), (2,)])
+        dispatcher.close()
+        self.assertEqual([1, 2], self.calls)
+        self.assertEqual(2, dispatcher.stats[fail].errors)
+        self.assertEqual(2, logger.exception.call_count)
+
+    def test_handlers_stats(self):
+        dispatcher = self._dispatcher(workers=1)
+        handlers = (lambda: None, lambda: None, self.calls.append)
+        dispatcher.submit("m3-1", handlers[:2], [(), ()])
+        dispatcher.submit("m3-1", handlers[2:], [(1,)])
+        dispatcher.close()
+        self.assertEqual([2, 2, 1], [dispatcher.stats[h].calls for h in handlers])
+        named = dispatcher.named_stats()
+        self.assertIs(dispatcher.stats[handlers[2]], named["list.append"])
+        lambdas = [name for name in named if "<lambda>@" in name]
+        self.assertEqual(2, len(lambdas))
+
+    def test_closed(self):
+        dispatcher = dispatch.Dispatcher(workers=1)
+        dispatcher.close()
+        self.assertRaises(
+            RuntimeError, dispatcher.submit, "m3-1", (self.record,), [(1, 2)]
+        )
+
+    def test_invalid(self):
+        self.assertRaises(ValueError, dispatch.Dispatcher, policy="drop")
+        self.assertRaises(ValueError, dispatch.Dispatcher, workers=0)
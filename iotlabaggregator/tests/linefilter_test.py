@@ -0,0 +1,106 @@
+#! /usr/bin/python
+
+# This file is a part of IoT-LAB aggregation-tools
+# Copyright (C) 2015 INRIA (Contact: admin@iot-lab.info)
+# Contributor(s) : see AUTHORS file
+#
+# This software is governed by the CeCILL license under French law
+# and abiding by the rules of distribution of free software.  You can  use,
+# modify and/ or redistribute the software under the terms of the CeCILL
+# license as circulated by CEA, CNRS and INRIA at the following URL
+# http://www.cecill.info.
+#
+# As a counterpart to the access to the source code and  rights to copy,
+# modify and redistribute granted by the license, users are provided only
+# with a limited warranty  and the software's author,  the holder of the
+# economic rights,  and the successive licensors  have only  limited
+# liability.
+#
+# The fact that you are presently reading this means that you have had
+# knowledge of the CeCILL license and that you accept its terms.
+
+"""Tests for iotlabaggregator.linefilter"""
+
+import unittest
+from unittest import mock
+
+from iotlabaggregator import linefilter, serial
+
+
+class TestLineFilter(unittest.TestCase):
+    def test_no_patterns(self):
+        self.assertRaises(ValueError, linefilter.LineFilter)
+
+    def test_end(self):
+        line_filter = linefilter.LineFilter(grep=["^m3"])
+        data = bytearray(b"a8 line\nm3 line\nm3\nm3 part")
+        self.assertEqual(b"m3 line\nm3\n", line_filter.filter(data, 19))
+        line_filter = linefilter.LineFilter(exclude=["a8"])
+        self.assertEqual(b"m3 line\nm3\n", line_filter.filter(data, 19))
+
+    def test_literals(self):
+        line_filter = linefilter.LineFilter(grep=["err", b"warn", "fail"])
+        self.assertIsNotNone(line_filter._literals)
+        data = b"warn err\nok\nerr\nfail\nwarn\n"
+        self.assertEqual(b"warn err\nerr\nfail\nwarn\n", line_filter.filter(data))
+        line_filter = linefilter.LineFilter(grep=["err", "warn"], exclude=["^warn"])
+        self.assertEqual(b"err\n", line_filter.filter(data))
+        self.assertIsNone(linefilter.LineFilter(grep=["err|warn"])._literals)
+
+    def test_empty_match(self):
+        line_filter = linefilter.LineFilter(grep=["$"], exclude=["^$"])
+        self.assertEqual(b"a\nb\n", line_filter.filter(b"a\n\nb\n"))
+
+    def test_patterns_in_line(self):
+        # Patterns do not match across lines
+        line_filter = linefilter.LineFilter(grep=["a.b"], exclude=["c$"])
+        self.assertEqual(b"", line_filter.filter(b"a\nb\n"))
+        self.assertEqual(b"axb\n", line_filter.filter(b"axb\naxbc\nc\n"))
+
+    def test_patterns_across_lines(self):
+        line_filter = linefilter.LineFilter(grep=[r"foo\s+bar"])
+        self.assertEqual(b"foo bar\n", line_filter.filter(b"foo\nbar\nfoo bar\n"))
+        line_filter = linefilter.LineFilter(exclude=[r"foo\s+bar"])
+        data = b"foo\nbar\nfoo bar\nbaz\n"
+        self.assertEqual(b"foo\nbar\nbaz\n", line_filter.filter(data))
+
+    def test_groups(self):
+        # Whole lines are selected, not the patterns groups
+        line_filter = linefilter.LineFilter(exclude=["(debug|trace)"])
+        self.assertEqual(b"ok\nhello\n", line_filter.filter(b"ok\ndebug x\nhello\n"))
+        line_filter = linefilter.LineFilter(grep=["(m3)-([0-9]+)"], exclude=["(a8)"])
+        data = b"m3-1 a8\nm3-2 ok\n"
+        self.assertEqual(b"m3-2 ok\n", line_filter.filter(data))
+
+    def test_from_opts(self):
+        parser = serial.SerialAggregator.parser
+        opts = parser.parse_args(["--grep", "err", "--grep", "warn"])
+        line_filter = linefilter.line_filter_from_opts(opts)
+        self.assertEqual([b"err", b"warn"], line_filter.grep)
+        self.assertEqual([], line_filter.exclude)
+        self.assertIsNone(linefilter.line_filter_from_opts(parser.parse_args([])))
+        opts = parser.parse_args(["--exclude", "("])
+        self.assertRaises(ValueError, linefilter.line_filter_from_opts, opts)
+
+
+class TestSerialConnectionFilter(unittest.TestCase):
+    def test_filter(self):
+        handler = mock.Mock()
+        lines_handler = mock.Mock()
+        conn = serial.SerialConnection(
+            "m3-1",
+            mock.Mock(),
+            line_handler=handler,
+            lines_handler=lines_handler,
+            line_filter=linefilter.LineFilter(exclude=["debug"]),
+        )
+        self.assertEqual(18, conn.handle_data(b"debug\nhello\ndebug\npart"))
+        handler.assert_called_once_with("m3-1", "hello")
+        lines_handler.assert_called_once_with("m3-1", b"hello\n")
+        self.assertEqual(3, conn.stats.lines)
+
+        # Nothing selected
+        handler.reset_mock()
+        conn.line_filter = linefilter.LineFilter(grep=["nothing"])
+        self.assertEqual(6, conn.handle_data(b"hello\n"))
+        handler.assert_not_called()
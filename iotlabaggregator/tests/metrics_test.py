@@ -0,0 +1,133 @@
+#! /usr/bin/python
+
+# This file is a part of IoT-LAB aggregation-tools
+# Copyright (C) 2015 INRIA (Contact: admin@iot-lab.info)
+# Contributor(s) : see AUTHORS file
+#
+# This software is governed by the CeCILL license under French law
+# and abiding by the rules of distribution of free software.  You can  use,
+# modify and/ or redistribute the software under the terms of the CeCILL
+# license as circulated by CEA, CNRS and INRIA at the following URL
+# http://www.cecill.info.
+#
+# As a counterpart to the access to the source code and  rights to copy,
+# modify and redistribute granted by the license, users are provided only
+# with a limited warranty  and the software's author,  the holder of the
+# economic rights,  and the successive licensors  have only  limited
+# liability.
+#
+# The fact that you are presently reading this means that you have had
+# knowledge of the CeCILL license and that you accept its terms.
+
+"""Tests for iotlabaggregator.metrics"""
+
+import os
+import socket
+import tempfile
+import unittest
+from unittest.mock import Mock, patch
+
+from iotlabaggregator import connections, metrics, serial, workers
+
+
+class TestMetricsExporter(unittest.TestCase):
+    def setUp(self):
+        tmp_dir = tempfile.TemporaryDirectory()  # pylint:disable=consider-using-with
+        self.addCleanup(tmp_dir.cleanup)
+        self.tmp_dir = tmp_dir.name
+        self.aggregator = connections.Aggregator(["m3-1", "m3-2"])
+        self.aggregator["m3-1"].stats.rx_bytes = 123
+
+    def test_file(self):
+        path = os.path.join(self.tmp_dir, "agg.prom")
+        exporter = metrics.MetricsExporter(self.aggregator, path, interval=60)
+        self.assertEqual(60, exporter.timeout)
+        exporter.idle()
+        with open(path, encoding="utf-8") as metrics_file:
+            text = metrics_file.read()
+        self.assertIn(
+            'iotlab_aggregator_node_received_bytes_total{node="m3-1"} 123\n', text
+        )
+        self.assertIn('iotlab_aggregator_node_lines_total{node="m3-2"} 0\n', text)
+
+        # Not written again before interval
+        self.aggregator["m3-1"].stats.rx_bytes = 456
+        exporter.idle()
+        with open(path, encoding="utf-8") as metrics_file:
+            self.assertEqual(text, metrics_file.read())
+        exporter.flush()
+        with open(path, encoding="utf-8") as metrics_file:
+            self.assertIn('total{node="m3-1"} 456\n', metrics_file.read())
+        self.assertEqual(["agg.prom"], os.listdir(self.tmp_dir))
+
+    def test_file_error(self):
+        path = os.path.join(self.tmp_dir, "missing", "agg.prom")
+        exporter = metrics.MetricsExporter(self.aggregator, path, interval=0)
+        with patch("iotlabaggregator.metrics.LOGGER") as logger:
+            exporter.idle()
+            exporter.flush()
+        # Only logged once, the aggregator keeps running
+        logger.warning.assert_called_once()
+        self.assertFalse(os.path.exists(path))
+
+        os.mkdir(os.path.dirname(path))
+        exporter.flush()
+        self.assertTrue(os.path.exists(path))
+
+    def test_socket(self):
+        path = os.path.join(self.tmp_dir, "stats.sock")
+        exporter = metrics.MetricsExporter(self.aggregator, socket_path=path)
+        self.assertIsNone(exporter.timeout)
+        exporter.idle()  # no file
+        with socket.socket(socket.AF_UNIX) as sock:
+            sock.connect(path)
+            text = b"".join(iter(lambda: sock.recv(4096), b"")).decode()
+        self.assertEqual(exporter.render(), text)
+        exporter.close()
+        self.assertFalse(os.path.exists(path))
+
+    def test_aggregator(self):
+        path = os.path.join(self.tmp_dir, "agg.prom")
+        options = {"path": path, "socket_path": None, "interval": 1.0}
+        aggregator = connections.Aggregator(["m3-1"], metrics=options)
+        self.assertIn(aggregator.metrics, aggregator.outputs)
+        aggregator.metrics.flush()
+        self.assertTrue(os.path.exists(path))
+
+    def test_dispatcher(self):
+        aggregator = connections.Aggregator(["m3-1"], dispatch={"workers": 1})
+        self.assertIs(aggregator.dispatcher, aggregator["m3-1"].dispatcher)
+        aggregator.dispatcher.submit("m3-1", (print,), [()])
+        aggregator.dispatcher.close()
+        text = metrics.MetricsExporter(aggregator).render()
+        self.assertIn(
+            'iotlab_aggregator_handler_calls_total{handler="print"} 1\n', text
+        )
+        self.assertIn('iotlab_aggregator_node_connected{node="m3-1"} 0\n', text)
+
+    def test_reconnects(self):
+        aggregator = connections.Aggregator(["m3-1"], reconnect=True)
+        aggregator._running = True
+        aggregator._start_connect = Mock()
+        aggregator._reconnect(aggregator["m3-1"])
+        self.assertEqual(1, aggregator["m3-1"].stats.reconnects)
+
+
+class TestMetricsOptions(unittest.TestCase):
+    def test_parser(self):
+        parser = serial.SerialAggregator.parser
+        opts = parser.parse_args(["--metrics-file", "agg.prom"])
+        self.assertEqual(
+            {"path": "agg.prom", "socket_path": None, "interval": 10.0},
+            metrics.metrics_options(opts),
+        )
+        self.assertIsNone(metrics.metrics_options(parser.parse_args([])))
+
+    def test_workers(self):
+        options = {"path": None, "socket_path": "/tmp/stats.sock", "interval": 1.0}
+        aggregator = workers.WorkersAggregator(
+            serial.SerialAggregator, ["m3-1", "m3-2"], 2, Mock(), metrics=options
+        )
+        kwargs = [w[0]._args[3] for w in aggregator._workers.values()]
+        self.assertEqual("/tmp/stats-0.sock", kwargs[0]["metrics"]["socket_path"])
+        self.assertEqual("/tmp/stats-1.sock", kwargs[1]["metrics"]["socket_path"])
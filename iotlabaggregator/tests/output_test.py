@@ -0,0 +1,289 @@
+#! /usr/bin/python
+
+# This file is a part of IoT-LAB aggregation-tools
+# Copyright (C) 2015 INRIA (Contact: admin@iot-lab.info)
+# Contributor(s) : see AUTHORS file
+#
+# This software is governed by the CeCILL license under French law
+# and abiding by the rules of distribution of free software.  You can  use,
+# modify and/ or redistribute the software under the terms of the CeCILL
+# license as circulated by CEA, CNRS and INRIA at the following URL
+# http://www.cecill.info.
+#
+# As a counterpart to the access to the source code and  rights to copy,
+# modify and redistribute granted by the license, users are provided only
+# with a limited warranty  and the software's author,  the holder of the
+# economic rights,  and the successive licensors  have only  limited
+# liability.
+#
+# The fact that you are presently reading this means that you have had
+# knowledge of the CeCILL license and that you accept its terms.
+
+"""Tests for iotlabaggregator.output"""
+
+import argparse
+import io
+import threading
+import time
+import unittest
+from unittest.mock import Mock, patch
+
+from iotlabaggregator import output
+
+
+class TestFlushPolicy(unittest.TestCase):
+    def test_record(self):
+        policy = output.FlushPolicy()
+        self.assertTrue(policy.record())
+        self.assertIsNone(policy.timeout)
+
+    def test_count(self):
+        policy = output.FlushPolicy(output.FlushPolicy.COUNT, count=3)
+        self.assertFalse(policy.record())
+        self.assertFalse(policy.record())
+        self.assertTrue(policy.record())
+        policy.flushed()
+        self.assertFalse(policy.record(2))
+        self.assertTrue(policy.record(2))
+        self.assertEqual(output.FlushPolicy.MAX_DELAY, policy.timeout)
+
+    @patch("iotlabaggregator.output.time.monotonic")
+    def test_time(self, monotonic):
+        policy = output.FlushPolicy(output.FlushPolicy.TIME, interval=0.1)
+        self.assertEqual(0.1, policy.timeout)
+        monotonic.return_value = 10.0
+        self.assertFalse(policy.idle())  # nothing pending
+        self.assertFalse(policy.record())
+        monotonic.return_value = 10.05
+        self.assertFalse(policy.record())
+        self.assertFalse(policy.idle())
+        monotonic.return_value = 10.2
+        self.assertTrue(policy.idle())
+        self.assertTrue(policy.record())
+
+    @patch("iotlabaggregator.output.time.monotonic")
+    def test_count_max_delay(self, monotonic):
+        policy = output.FlushPolicy(output.FlushPolicy.COUNT, count=100)
+        monotonic.return_value = 10.0
+        policy.record()
+        self.assertFalse(policy.idle())
+        monotonic.return_value = 10.0 + output.FlushPolicy.MAX_DELAY
+        self.assertTrue(policy.idle())
+
+    def test_idle(self):
+        policy = output.FlushPolicy(output.FlushPolicy.IDLE)
+        self.assertFalse(policy.idle())
+        self.assertFalse(policy.record())
+        self.assertTrue(policy.idle())
+        policy.flushed()
+        self.assertFalse(policy.idle())
+
+    def test_invalid_mode(self):
+        self.assertRaises(ValueError, output.FlushPolicy, "never")
+
+    def test_auto(self):
+        tty = Mock()
+        tty.isatty.return_value = True
+        self.assertEqual("record", output.FlushPolicy.auto(tty).mode)
+        self.assertEqual("idle", output.FlushPolicy.auto(io.BytesIO()).mode)
+        self.assertEqual("idle", output.FlushPolicy.auto(object()).mode)
+
+
+class TestOutput(unittest.TestCase):
+    def setUp(self):
+        self.out = Mock()
+
+    def test_record_policy(self):
+        out = output.Output(self.out)
+        out.write(b"abc")
+        self.out.write.assert_called_once_with(b"abc")
+        self.out.flush.assert_called_once()
+
+    def test_idle_policy(self):
+        out = output.Output(io.BytesIO(), output.FlushPolicy("idle"))
+        out.write(b"abc")
+        out.write(b"def", records=2)
+        self.assertEqual(b"", out.out.getvalue())
+        self.assertEqual(3, out.policy.pending)
+        out.idle()
+        self.assertEqual(b"abcdef", out.out.getvalue())
+        self.assertEqual(0, out.policy.pending)
+
+    def test_buffer_size(self):
+        out = output.Output(self.out, output.FlushPolicy("idle"))
+        out.buffer_size = 4
+        out.write(b"abc")
+        self.out.write.assert_not_called()
+        out.write(b"def")
+        self.out.write.assert_called_once_with(b"abcdef")
+        self.out.flush.assert_not_called()
+
+    def test_flush(self):
+        out = output.Output(io.BytesIO(), output.FlushPolicy("idle"))
+        out.write(b"abc")
+        out.flush()
+        self.assertEqual(b"abc", out.out.getvalue())
+
+
+class TestLineWriter(unittest.TestCase):
+    @patch("iotlabaggregator.output.time.time", Mock(return_value=12.5))
+    def test_write_lines(self):
+        outfile = io.BytesIO()
+        writer = output.LineWriter(outfile, output.FlushPolicy("idle"))
+        writer.write_lines(["a", "é"], "m3-1;")
+        writer.write_lines(["b"], "<m3-2;", ">")
+        self.assertEqual(3, writer.policy.pending)
+        writer.idle()
+        self.assertEqual(
+            "12.500000;m3-1;a\n12.500000;m3-1;é\n12.500000;<m3-2;b>\n".encode(),
+            outfile.getvalue(),
+        )
+
+
+class TestBinaryOutput(unittest.TestCase):
+    def test_buffer(self):
+        stream = io.TextIOWrapper(io.BytesIO())
+        self.assertIs(stream.buffer, output.binary_output(stream))
+
+    def test_text_stream(self):
+        stream = Mock(spec=io.TextIOBase)
+        out = output.binary_output(stream)
+        self.assertEqual(4, out.write(b"\xffab\n"))
+        stream.write.assert_called_once_with("\ufffdab\n")
+        out.flush()
+        stream.flush.assert_called_once_with()
+        stream.isatty.return_value = True
+        self.assertEqual("record", output.FlushPolicy.auto(out).mode)
+
+
+class TestQueuedOutput(unittest.TestCase):
+    def setUp(self):
+        self.outfile = io.BytesIO()
+        self.out = output.Output(self.outfile, output.FlushPolicy("idle"))
+
+    def _blocked(self, queued):
+        """Block the writer thread in ``out.write`` until the returned event."""
+        blocked, release = threading.Event(), threading.Event()
+        real_write = self.out.write
+
+        def write(*args):
+            blocked.set()
+            release.wait(5)
+            real_write(*args)
+
+        self.out.write = write
+        queued.write(b"first;", 1, "m3-1")
+        self.assertTrue(blocked.wait(5))
+        return release
+
+    def test_write(self):
+        queued = output.QueuedOutput(self.out)
+        self.assertIsNone(queued.timeout)
+        queued.write(b"abc", 1, "m3-1")
+        queued.write(memoryview(b"def"), 2, "m3-2")
+        queued.flush()
+        self.assertEqual(b"abcdef", self.outfile.getvalue())
+
+    def test_idle(self):
+        self.out.flush = Mock(wraps=self.out.flush)
+        queued = output.QueuedOutput(self.out)
+        queued.write(b"abc")
+        queued.idle()
+        for _ in range(100):
+            if self.out.flush.called:
+                break
+            time.sleep(0.01)
+        self.assertEqual(b"abc", self.outfile.getvalue())
+
+    def test_drop_newest(self):
+        queued = output.QueuedOutput(self.out, 1, "drop-newest")
+        release = self._blocked(queued)
+        queued.write(b"a;", 1, "m3-1")
+        queued.write(b"b;", 2, "m3-2")
+        queued.write(b"c;", 1, "m3-1")
+        release.set()
+        queued.flush()
+        self.assertEqual(b"first;a;", self.outfile.getvalue())
+        self.assertEqual({"m3-2": 2, "m3-1": 1}, queued.drops)
+
+    def test_drop_oldest(self):
+        queued = output.QueuedOutput(self.out, 1, "drop-oldest")
+        release = self._blocked(queued)
+        queued.write(b"a;", 1, "m3-1")
+        queued.write(b"b;", 2, "m3-2")
+        queued.write(b"c;", 1, "m3-1")
+        release.set()
+        queued.flush()
+        self.assertEqual(b"first;c;", self.outfile.getvalue())
+        self.assertEqual({"m3-1": 1, "m3-2": 2}, queued.drops)
+        with patch("iotlabaggregator.output.LOGGER") as logger:
+            queued.report()
+        logger.warning.assert_called_once_with(
+            "Output queue: %u records dropped: %s", 3, "m3-1=1, m3-2=2"
+        )
+
+    def test_block(self):
+        queued = output.QueuedOutput(self.out, 1)
+        release = self._blocked(queued)
+        queued.write(b"a;")
+        writer = threading.Thread(target=queued.write, args=(b"b;",))
+        writer.start()
+        writer.join(0.1)
+        self.assertTrue(writer.is_alive())  # Waiting for the writer thread
+        release.set()
+        writer.join(5)
+        queued.flush()
+        self.assertEqual(b"first;a;b;", self.outfile.getvalue())
+        self.assertEqual({}, queued.drops)
+
+    def test_invalid_policy(self):
+        self.assertRaises(ValueError, output.QueuedOutput, self.out, 1, "drop")
+
+    def test_write_error(self):
+        queued = output.QueuedOutput(self.out, 1)
+        release = self._blocked(queued)
+        queued.write(b"a;")
+        writer = threading.Thread(
+            target=self.assertRaises, args=(OSError, queued.write, b"b;")
+        )
+        writer.start()
+        self.outfile.write = Mock(side_effect=BrokenPipeError)
+        release.set()
+        # Waiting writes, flush and close get the error instead of hanging
+        writer.join(5)
+        self.assertFalse(writer.is_alive())
+        with self.assertRaises(OSError) as context:
+            queued.flush()
+        self.assertIsInstance(context.exception.__cause__, BrokenPipeError)
+        self.assertRaises(OSError, queued.write, b"c;")
+        self.assertRaises(OSError, queued.close)
+
+    def test_close(self):
+        self.out.flush = Mock(wraps=self.out.flush)
+        queued = output.QueuedOutput(self.out)
+        queued.write(b"abc")
+        queued.close()
+        self.assertEqual(b"abc", self.outfile.getvalue())
+        self.out.flush.assert_called_once_with()
+        self.assertFalse(queued._thread.is_alive())
+        queued.flush()  # nothing to flush
+        self.assertRaises(ValueError, queued.write, b"def")
+
+    def test_line_writer(self):
+        writer = output.LineWriter(self.outfile)
+        writer.queue = output.QueuedOutput(writer)
+        with patch("time.time", return_value=1.5):
+            writer.write_lines(["a", "b"], "m3-1;", node="m3-1")
+        writer.queue.flush()
+        self.assertEqual(b"1.500000;m3-1;a\n1.500000;m3-1;b\n", self.outfile.getvalue())
+
+    def test_options(self):
+        parser = argparse.ArgumentParser()
+        output.add_queue_parser(parser)
+        opts = parser.parse_args(
+            ["--output-queue", "10", "--queue-policy", "drop-oldest"]
+        )
+        self.assertEqual(
+            {"max_batches": 10, "policy": "drop-oldest"}, output.queue_options(opts)
+        )
+        self.assertIsNone(output.queue_options(parser.parse_args([])))
@@ -0,0 +1,111 @@
+#! /usr/bin/python
+
+# This file is a part of IoT-LAB aggregation-tools
+# Copyright (C) 2015 INRIA (Contact: admin@iot-lab.info)
+# Contributor(s) : see AUTHORS file
+#
+# This software is governed by the CeCILL license under French law
+# and abiding by the rules of distribution of free software.  You can  use,
+# modify and/ or redistribute the software under the terms of the CeCILL
+# license as circulated by CEA, CNRS and INRIA at the following URL
+# http://www.cecill.info.
+#
+# As a counterpart to the access to the source code and  rights to copy,
+# modify and redistribute granted by the license, users are provided only
+# with a limited warranty  and the software's author,  the holder of the
+# economic rights,  and the successive licensors  have only  limited
+# liability.
+#
+# The fact that you are presently reading this means that you have had
+# knowledge of the CeCILL license and that you accept its terms.
+
+"""Tests for iotlabaggregator.record"""
+
+import io
+import os
+import tempfile
+import unittest
+from unittest.mock import patch
+
+from iotlabaggregator import output, record
+
+SECOND = 1000000000
+
+
+class TestRecord(unittest.TestCase):
+    def setUp(self):
+        fd, self.path = tempfile.mkstemp()
+        os.close(fd)
+        self.addCleanup(os.remove, self.path)
+
+    def _record(self, close=True):
+        """Record lines of two nodes, one second per write."""
+        with open(self.path, "wb") as outfile:
+            writer = record.RecordWriter(outfile, output.FlushPolicy("idle"))
+            writer.index_interval = 100
+            with patch("iotlabaggregator.record.time.time_ns") as time_ns:
+                for second in range(10):
+                    time_ns.return_value = (second + 1) * SECOND
+                    node = "m3-1" if second < 5 else "m3-2"
+                    writer.write_lines(node, memoryview(b"%u\nline\n" % second))
+            if close:
+                writer.close()
+            else:
+                writer.flush()
+        return writer
+
+    def test_read(self):
+        writer = self._record()
+        self.assertEqual({"m3-1": 0, "m3-2": 1}, writer.nodes)
+        self.assertGreater(len(writer.index), 3)
+        with record.RecordReader(self.path) as reader:
+            self.assertEqual(writer.index, reader.index)
+            self.assertEqual(["m3-1", "m3-2"], reader.nodes)
+            lines = list(reader.lines())
+        self.assertEqual(20, len(lines))
+        self.assertEqual((1 * SECOND, "m3-1", b"0"), lines[0])
+        self.assertEqual((10 * SECOND, "m3-2", b"line"), lines[-1])
+
+    def test_select(self):
+        self._record()
+        with record.RecordReader(self.path) as reader:
+            with patch.object(reader, "_records", wraps=reader._records) as records:
+                lines = list(reader.lines(start=3 * SECOND, end=4 * SECOND))
+            self.assertEqual([b"2", b"line", b"3", b"line"], [ln[2] for ln in lines])
+            # Only read chunks in time range
+            self.assertLess(records.call_count, len(reader.index))
+
+            lines = list(reader.lines(nodes=["m3-2"]))
+            self.assertEqual(10, len(lines))
+            self.assertEqual({"m3-2"}, {line[1] for line in lines})
+            self.assertEqual([], list(reader.lines(nodes=["unknown"])))
+
+    def test_unfinished_recording(self):
+        writer = self._record(close=False)
+        with record.RecordReader(self.path) as reader:
+            self.assertEqual(["m3-1", "m3-2"], reader.nodes)
+            self.assertEqual(len(writer.index) + 1, len(reader.index))
+            self.assertEqual(20, len(list(reader.lines())))
+            lines = list(reader.lines(start=10 * SECOND))
+            self.assertEqual([b"9", b"line"], [line[2] for line in lines])
+
+    def test_truncated_recording(self):
+        self._record(close=False)
+        with open(self.path, "r+b") as recording:
+            recording.truncate(os.path.getsize(self.path) - 2)
+        with record.RecordReader(self.path) as reader:
+            self.assertEqual(19, len(list(reader.lines())))
+
+    def test_not_a_recording(self):
+        with open(self.path, "wb") as outfile:
+            outfile.write(b"text\n")
+        self.assertRaises(ValueError, record.RecordReader, self.path)
+
+    def test_main(self):
+        self._record()
+        stdout = io.TextIOWrapper(io.BytesIO())
+        with patch("sys.stdout", stdout):
+            record.main([self.path, "--node", "m3-2", "--start", "10"])
+        self.assertEqual(
+            b"10.000000;m3-2;9\n10.000000;m3-2;line\n", stdout.buffer.getvalue()
+        )
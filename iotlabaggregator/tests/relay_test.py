@@ -0,0 +1,264 @@
+#! /usr/bin/python
+
+# This file is a part of IoT-LAB aggregation-tools
+# Copyright (C) 2015 INRIA (Contact: admin@iot-lab.info)
+# Contributor(s) : see AUTHORS file
+#
+# This software is governed by the CeCILL license under French law
+# and abiding by the rules of distribution of free software.  You can  use,
+# modify and/ or redistribute the software under the terms of the CeCILL
+# license as circulated by CEA, CNRS and INRIA at the following URL
+# http://www.cecill.info.
+#
+# As a counterpart to the access to the source code and  rights to copy,
+# modify and redistribute granted by the license, users are provided only
+# with a limited warranty  and the software's author,  the holder of the
+# economic rights,  and the successive licensors  have only  limited
+# liability.
+#
+# The fact that you are presently reading this means that you have had
+# knowledge of the CeCILL license and that you accept its terms.
+
+"""Tests for iotlabaggregator.relay"""
+
+import io
+import json
+import os
+import socket
+import struct
+import sys
+import threading
+import unittest
+from unittest.mock import patch
+
+from iotlabaggregator import output, relay, reorder, serial, workers
+from iotlabaggregator.tests.connections_test import wait_for
+from iotlabaggregator.tests.workers_test import (
+    NODES,
+    SerialAggregator,
+    SnifferAggregator,
+)
+from iotlabaggregator.tests.zeptopcap_test import ZEP_MESSAGE_VALID_TS
+
+
+class TestFrames(unittest.TestCase):
+    def test_read_frames_too_large(self):
+        buff = bytearray(relay.FRAME.pack(b"D", relay.MAX_FRAME_SIZE + 1))
+        self.assertRaises(ValueError, relay.read_frames, buff)
+
+    def test_relay_connection(self):
+        sock, peer = socket.socketpair()
+        self.addCleanup(peer.close)
+        conn = relay.RelayConnection(sock, "gzip")
+        conn.send_bytes(b"H")
+        conn.send_bytes(bytearray(b"Dhello"))
+        peer.sendall(relay.frame(relay.COMMAND, b'[["m3-1"], "reset"]'))
+        peer.sendall(relay.frame(relay.COMMAND, b"null"))
+        self.assertEqual([["m3-1"], "reset"], conn.recv())
+        self.assertIsNone(conn.recv())
+        conn.close()
+
+        buff = bytearray()
+        while data := peer.recv(4096):
+            buff += data
+        (header, data) = relay.read_frames(buff)
+        self.assertEqual((b"H", b""), header)
+        self.assertEqual(b"D", data[0])
+        decompressor = relay.compress.DECOMPRESSORS["gzip"]()
+        self.assertEqual(b"hello", decompressor.decompress(data[1]))
+
+    def test_relay_connection_eof(self):
+        sock, peer = socket.socketpair()
+        conn = relay.RelayConnection(sock)
+        peer.close()
+        self.assertRaises(EOFError, conn.recv)
+        conn.close()
+
+
+@patch("iotlabaggregator.relay.os.kill")
+class TestRelays(unittest.TestCase):
+    """Relays threads connected to local nodes and to a central aggregator."""
+
+    def setUp(self):
+        self.server = socket.create_server(("127.0.0.1", 0), backlog=len(NODES))
+        self.server.settimeout(10)
+        self.addCleanup(self.server.close)
+        self.port = self.server.getsockname()[1]
+        self.received = []
+        self.relays = []
+
+    def _serve(self, data, until=b""):
+        """Send ``data`` to all nodes, close them after receiving ``until``."""
+        clients = [self.server.accept()[0] for _ in NODES]
+        for sock in clients:
+            sock.sendall(data)
+        for sock in clients:
+            sock.settimeout(10)
+            received = b""
+            while not received.endswith(until):
+                received += sock.recv(1024)
+            self.received.append(received)
+            sock.close()
+
+    def _relay(self, central, aggregator_class, node, relay_compress=None, **kwargs):
+        """Run a relay thread for ``node``."""
+        kwargs["flush_policy"] = output.FlushPolicy(output.FlushPolicy.IDLE)
+        thread = threading.Thread(
+            target=relay.run_relay,
+            args=(aggregator_class, [node], central.address, relay_compress),
+            kwargs=dict(kwargs, port=self.port),
+        )
+        thread.start()
+        self.relays.append(thread)
+
+    def _stop(self, central):
+        central.stop()
+        for thread in self.relays:
+            thread.join(10)
+            self.assertFalse(thread.is_alive())
+
+    def test_serial(self, _kill):
+        outfd = io.BytesIO()
+        central = relay.RelayServer(("127.0.0.1", 0), outfd)
+        with central:
+            self._relay(central, SerialAggregator, NODES[0], print_lines=True)
+            self._relay(central, SerialAggregator, NODES[1], "gzip", print_lines=True)
+            server = threading.Thread(target=self._serve, args=(b"hello\n", b"ping\n"))
+            server.start()
+            self.assertTrue(wait_for(lambda: outfd.getvalue().count(b"\n") == 2, 10))
+            self.assertTrue(wait_for(lambda: len(central) == 2))
+            self.assertIsNot(central[NODES[0]], central[NODES[1]])
+            central.send_nodes(["localhost", "unknown"], "pong\n")
+            central.broadcast("ping\n")
+            server.join()
+            self._stop(central)
+        self.assertEqual(2, central.ended)
+        lines = sorted(line.split(b";", 1)[1] for line in outfd.getvalue().split())
+        self.assertEqual([b"127.0.0.1;hello", b"localhost;hello"], lines)
+        self.assertEqual([b"ping\n", b"pong\nping\n"], sorted(self.received))
+
+    def test_sniffer_link_types(self, _kill):
+        central = relay.RelayServer(("127.0.0.1", 0), io.BytesIO())
+        with patch.object(relay.LOGGER, "error") as error, central:
+            self._relay(central, SnifferAggregator, NODES[0], raw=True)
+            self.assertTrue(wait_for(lambda: NODES[0] in central))
+            # Ethernet encapsulated packets cannot be merged with raw ones
+            self._relay(central, SnifferAggregator, NODES[1])
+            self.assertTrue(wait_for(lambda: error.called))
+            self._stop(central)
+        self.assertEqual(195, central.link)
+        self.assertNotIn(NODES[1], central)
+        self.assertIn("link type 1 differs", str(error.call_args))
+
+    def test_sniffer_reorder(self, _kill):
+        outfd = io.BytesIO()
+        central = relay.RelayServer(("127.0.0.1", 0), outfd, reorder_window=0.01)
+        with central:
+            for node in NODES:
+                self._relay(central, SnifferAggregator, node, "gzip", raw=True)
+            self._serve(ZEP_MESSAGE_VALID_TS)
+            # One pcap header, then two raw packets records
+            record_len = 16 + len(ZEP_MESSAGE_VALID_TS) - 32
+            size = 24 + 2 * record_len
+            self.assertTrue(wait_for(lambda: len(outfd.getvalue()) == size, 10))
+            self._stop(central)
+        self.assertEqual(2, central.rx_packets)
+        self.assertIs(reorder.pcap_records, central.reorder.records)
+        data = outfd.getvalue()
+        self.assertEqual(0xA1B2C3D4, struct.unpack_from("=L", data)[0])
+        self.assertEqual(size, len(data))
+
+    def test_relays_ended(self, kill):
+        central = relay.RelayServer(("127.0.0.1", 0), io.BytesIO(), relays=2)
+        with central:
+            for _ in range(2):
+                conn = relay.RelayConnection.connect(
+                    central.address, "lines_records", ["m3-1"]
+                )
+                conn.send_bytes(workers.END + b'{"rx_packets": 1}')
+                conn.close()
+            self.assertTrue(wait_for(lambda: kill.call_count == 1))
+            self.assertEqual(2, central.rx_packets)
+            self.assertEqual({}, central)
+
+    def test_invalid_relays(self, kill):
+        central = relay.RelayServer(("127.0.0.1", 0), io.BytesIO(), relays=1)
+        with patch("iotlabaggregator.relay.LOGGER") as logger, central:
+            first = relay.RelayConnection.connect(
+                central.address, "lines_records", ["m3-1"]
+            )
+            self.assertTrue(wait_for(lambda: "m3-1" in central))
+            hellos = [
+                {"records": "pcap_records", "nodes": [], "compress": None},
+                {"records": "unknown", "nodes": [], "compress": None},
+                {"records": "lines_records", "nodes": [], "compress": "unknown"},
+                {"records": "lines_records", "nodes": [], "compress": None, "link": 1},
+            ]
+            invalid = [relay.frame(b"D", b"no hello")]
+            invalid += [
+                relay.frame(relay.HELLO, json.dumps(h).encode()) for h in hellos
+            ]
+            for message in invalid:
+                with socket.create_connection(central.address) as sock:
+                    sock.sendall(message)
+                    sock.settimeout(10)
+                    self.assertEqual(b"", sock.recv(16))
+            self.assertEqual(len(invalid), logger.error.call_count)
+            # Only relays which sent their hello are counted
+            first.close()
+            self.assertTrue(wait_for(lambda: kill.call_count == 1))
+
+    @patch("iotlabaggregator.relay.MAX_FRAME_SIZE", 1000)
+    def test_decompressed_too_large(self, _kill):
+        outfd = io.BytesIO()
+        central = relay.RelayServer(("127.0.0.1", 0), outfd)
+        with patch.object(relay.LOGGER, "error") as error, central:
+            conn = relay.RelayConnection.connect(
+                central.address, "lines_records", ["m3-1"], "gzip"
+            )
+            self.assertTrue(wait_for(lambda: "m3-1" in central))
+            conn.send_bytes(workers.DATA + b"1.0;m3-1;hello\n")
+            # Small compressed frame of too large data closes the relay
+            conn.send_bytes(workers.DATA + bytes(2000))
+            self.assertTrue(wait_for(lambda: "m3-1" not in central))
+            conn.close()
+        self.assertIn("larger than 1000 bytes", str(error.call_args))
+        self.assertEqual(b"1.0;m3-1;hello\n", outfd.getvalue())
+
+
+class TestMain(unittest.TestCase):
+    def test_serial_main(self):
+        real_parser = serial.SerialAggregator.parser
+        with (
+            patch("iotlabaggregator.serial.SerialAggregator") as aggregator_class,
+            patch("iotlabaggregator.relay.run_relay") as run_relay,
+        ):
+            aggregator_class.parser = real_parser
+            aggregator_class.select_nodes.return_value = ["m3-1"]
+            serial.main(["--relay", "central:20200", "--flush", "10"])
+            with patch("sys.stderr", io.StringIO()):
+                args = ["--relay", "c:1", "--workers", "2"]
+                self.assertRaises(SystemExit, serial.main, args)
+        args, kwargs = run_relay.call_args
+        self.assertEqual((aggregator_class, ["m3-1"], ("central", 20200), None), args)
+        self.assertEqual(10, kwargs["flush_policy"].count)
+        self.assertTrue(kwargs["print_lines"])
+
+    def test_central_main(self):
+        outfd = io.BytesIO()
+        with (
+            patch("iotlabaggregator.relay.RelayServer") as server_class,
+            patch.object(sys, "stdout", io.TextIOWrapper(outfd)),
+        ):
+            server_class.return_value.reorder = None
+            relay.main(["--listen", "127.0.0.1:0", "--relays", "2"])
+        server = server_class.return_value
+        args = server_class.call_args[0]
+        self.assertEqual((("127.0.0.1", 0), outfd), args[:2])
+        self.assertEqual(2, args[4])
+        server.run.assert_called_once()
+
+        with patch("iotlabaggregator.relay.RelayServer") as server_class:
+            server_class.return_value.reorder = None
+            relay.main(["-o", os.devnull])
+        self.assertEqual(("localhost", 20200), server_class.call_args[0][0])
@@ -0,0 +1,104 @@
+#! /usr/bin/python
+
+# This file is a part of IoT-LAB aggregation-tools
+# Copyright (C) 2015 INRIA (Contact: admin@iot-lab.info)
+# Contributor(s) : see AUTHORS file
+#
+# This software is governed by the CeCILL license under French law
+# and abiding by the rules of distribution of free software.  You can  use,
+# modify and/ or redistribute the software under the terms of the CeCILL
+# license as circulated by CEA, CNRS and INRIA at the following URL
+# http://www.cecill.info.
+#
+# As a counterpart to the access to the source code and  rights to copy,
+# modify and redistribute granted by the license, users are provided only
+# with a limited warranty  and the software's author,  the holder of the
+# economic rights,  and the successive licensors  have only  limited
+# liability.
+#
+# The fact that you are presently reading this means that you have had
+# knowledge of the CeCILL license and that you accept its terms.
+
+"""Tests for iotlabaggregator.reorder"""
+
+import io
+import unittest
+from unittest.mock import patch
+
+from iotlabaggregator import output, reorder
+
+
+def lines(*keys):
+    return b"".join(b"%u;line\n" % key for key in keys)
+
+
+@patch("iotlabaggregator.reorder.time.monotonic")
+class TestReorderOutput(unittest.TestCase):
+    def setUp(self):
+        self.outfile = io.BytesIO()
+        self.out = output.Output(self.outfile, output.FlushPolicy("idle"))
+        self.reorder = reorder.ReorderOutput(self.out, 1.0, reorder.lines_records)
+
+    def test_window(self, monotonic):
+        monotonic.return_value = 10.0
+        self.reorder.write(lines(3, 1))
+        monotonic.return_value = 10.5
+        self.reorder.write(lines(2, 5))
+        self.reorder.idle()
+        self.assertEqual(b"", self.outfile.getvalue())
+
+        # First records window ended, records up to 3 are written
+        monotonic.return_value = 11.0
+        self.reorder.idle()
+        self.assertEqual(lines(1, 2, 3), self.outfile.getvalue())
+
+        monotonic.return_value = 11.5
+        self.reorder.idle()
+        self.assertEqual(lines(1, 2, 3, 5), self.outfile.getvalue())
+        self.assertEqual((0, 0), (self.reorder.late, self.reorder.early))
+
+    def test_late(self, monotonic):
+        monotonic.return_value = 10.0
+        self.reorder.write(lines(3))
+        monotonic.return_value = 11.0
+        self.reorder.idle()
+        self.reorder.write(lines(2, 4))
+        self.reorder.flush()
+        self.assertEqual(lines(3, 2, 4), self.outfile.getvalue())
+        self.assertEqual(1, self.reorder.late)
+
+    def test_unordered_records(self, monotonic):
+        monotonic.return_value = 10.0
+
+        def records(data):
+            for key, record in reorder.lines_records(data):
+                yield (None if key == 0 else key), record
+
+        self.reorder.records = records
+        self.reorder.write(lines(3) + b"header\n" + lines(1))
+        self.assertEqual(b"", self.outfile.getvalue())
+        self.reorder.flush()
+        self.assertEqual(b"header\n" + lines(1, 3), self.outfile.getvalue())
+        self.assertEqual(0, self.reorder.late)
+
+    def test_max_records(self, monotonic):
+        monotonic.return_value = 10.0
+        self.reorder.max_records = 2
+        self.reorder.write(lines(4, 2, 3, 1))
+        self.reorder.idle()
+        self.assertEqual(lines(1, 2), self.outfile.getvalue())
+        self.assertEqual(2, self.reorder.early)
+        self.reorder.flush()
+        self.assertEqual(lines(1, 2, 3, 4), self.outfile.getvalue())
+
+    def test_timeout(self, _monotonic):
+        self.assertEqual(0.5, self.reorder.timeout)
+        self.out.policy = output.FlushPolicy("time", interval=0.1)
+        self.assertEqual(0.1, self.reorder.timeout)
+
+    def test_pcap_records(self, _monotonic):
+        records = [
+            reorder.PCAP_RECORD_HDR.pack(t_s, 0, 2) + bytes(4) + b"xy" for t_s in (2, 1)
+        ]
+        keys = [key for key, _ in reorder.pcap_records(b"".join(records))]
+        self.assertEqual([2000000, 1000000], keys)
@@ -0,0 +1,150 @@
+#! /usr/bin/python
+
+# This file is a part of IoT-LAB aggregation-tools
+# Copyright (C) 2015 INRIA (Contact: admin@iot-lab.info)
+# Contributor(s) : see AUTHORS file
+#
+# This software is governed by the CeCILL license under French law
+# and abiding by the rules of distribution of free software.  You can  use,
+# modify and/ or redistribute the software under the terms of the CeCILL
+# license as circulated by CEA, CNRS and INRIA at the following URL
+# http://www.cecill.info.
+#
+# As a counterpart to the access to the source code and  rights to copy,
+# modify and redistribute granted by the license, users are provided only
+# with a limited warranty  and the software's author,  the holder of the
+# economic rights,  and the successive licensors  have only  limited
+# liability.
+#
+# The fact that you are presently reading this means that you have had
+# knowledge of the CeCILL license and that you accept its terms.
+
+"""Tests for iotlabaggregator.replay"""
+
+import os
+import socket
+import tempfile
+import threading
+import unittest
+from unittest.mock import Mock, patch
+
+from iotlabaggregator import common, record, replay, zeptopcap
+from iotlabaggregator.tests.connections_test import wait_for
+from iotlabaggregator.tests.zeptopcap_test import ZEP_MESSAGE_VALID_TS
+
+
+def free_port():
+    with socket.create_server(("127.0.0.1", 0)) as sock:
+        return sock.getsockname()[1]
+
+
+class TestLoad(unittest.TestCase):
+    def setUp(self):
+        fd, self.path = tempfile.mkstemp()
+        os.close(fd)
+        self.addCleanup(os.remove, self.path)
+
+    def test_serial_log(self):
+        with open(self.path, "wb") as log:
+            log.write(b"1.5;m3-1;hello;world\n2.0;m3-2;\ninvalid\n")
+        with patch("iotlabaggregator.replay.LOGGER") as logger:
+            events, port = replay.load(self.path)
+        self.assertEqual(20000, port)
+        self.assertEqual(
+            [(1.5, "m3-1", b"hello;world\n"), (2.0, "m3-2", b"\n")], events
+        )
+        logger.warning.assert_called_once()
+
+    def test_record(self):
+        with open(self.path, "wb") as outfile:
+            writer = record.RecordWriter(outfile)
+            with patch("iotlabaggregator.record.time.time_ns", return_value=15 * 10**8):
+                writer.write_lines("m3-1", b"a\nb\n")
+            writer.close()
+        events, port = replay.load(self.path)
+        self.assertEqual(20000, port)
+        self.assertEqual([(1.5, "m3-1", b"a\n"), (1.5, "m3-1", b"b\n")], events)
+
+    def test_pcap(self):
+        with open(self.path, "wb") as outfile:
+            zep = zeptopcap.ZepPcap(outfile)
+            zep.write_packets(None, [ZEP_MESSAGE_VALID_TS] * 2)
+            zep.out.flush()
+        events, port = replay.load(self.path)
+        self.assertEqual(30000, port)
+        self.assertEqual(2, len(events))
+        timestamp, node, packet = events[0]
+        self.assertEqual("zep-1", node)
+        self.assertEqual(ZEP_MESSAGE_VALID_TS, packet)
+        self.assertEqual(zep._timestamp(packet)[0], int(timestamp))
+
+    def test_raw_pcap(self):
+        with open(self.path, "wb") as outfile:
+            zeptopcap.ZepPcap(outfile, raw=True)
+        self.assertRaises(ValueError, replay.load, self.path)
+
+
+@patch("iotlabaggregator.replay.LOGGER", Mock())
+class TestReplayServer(unittest.TestCase):
+    def setUp(self):
+        events = [
+            (10.0, "m3-1", b"one\n"),
+            (10.1, "m3-2", b"two\n"),
+            (10.0, "m3-2", b"zero\n"),
+            (10.2, "m3-1", b"three\n"),
+        ]
+        self.port = free_port()
+        self.server = replay.ReplayServer(events, self.port, speed=2.0)
+        self.addCleanup(self.server.close)
+
+    def _connect(self, node):
+        return socket.create_connection((self.server.hosts[node], self.port))
+
+    def test_replay(self):
+        self.assertEqual({"m3-1": "127.0.0.2", "m3-2": "127.0.0.3"}, self.server.hosts)
+        clients = [self._connect(node) for node in ("m3-1", "m3-2")]
+        self.assertEqual(2, self.server.wait_clients(1))
+        duration = self.server.run()
+        self.server.close()
+        # 0.2s replayed 2 times faster
+        self.assertGreaterEqual(duration, 0.1)
+        received = []
+        for client in clients:
+            with client:
+                received.append(client.makefile("rb").read())
+        self.assertEqual([b"one\nthree\n", b"zero\ntwo\n"], received)
+
+    def test_max_speed_missing_node(self):
+        self.server.speed = 0
+        client = self._connect("m3-2")
+        self.assertEqual(1, self.server.wait_clients(0.1))
+        self.assertLess(self.server.run(), 0.1)
+        self.server.close()
+        with client:
+            self.assertEqual(b"zero\ntwo\n", client.makefile("rb").read())
+
+    def test_hosts_file(self):
+        fd, path = tempfile.mkstemp()
+        os.close(fd)
+        self.addCleanup(os.remove, path)
+        self.server.write_hosts_file(path)
+        self.assertEqual(self.server.hosts, common.read_hosts_file(path))
+
+    def test_main(self):
+        self.server.close()
+        fd, path = tempfile.mkstemp()
+        os.close(fd)
+        self.addCleanup(os.remove, path)
+        with open(path, "wb") as log:
+            log.write(b"1.0;m3-1;line\n")
+        hosts = path + ".hosts"
+        self.addCleanup(os.remove, hosts)
+        args = [path, "--hosts-file", hosts, "--port", str(self.port), "--wait", "1"]
+        thread = threading.Thread(target=replay.main, args=(args,))
+        thread.start()
+        self.assertTrue(wait_for(lambda: os.path.exists(hosts)))
+        client = socket.create_connection(("127.0.0.2", self.port))
+        with client:
+            self.assertEqual(b"line\n", client.makefile("rb").read())
+        thread.join()
+        self.assertEqual({"m3-1": "127.0.0.2"}, common.read_hosts_file(hosts))
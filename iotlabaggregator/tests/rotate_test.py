@@ -0,0 +1,122 @@
+#! /usr/bin/python
+
+# This file is a part of IoT-LAB aggregation-tools
+# Copyright (C) 2015 INRIA (Contact: admin@iot-lab.info)
+# Contributor(s) : see AUTHORS file
+#
+# This software is governed by the CeCILL license under French law
+# and abiding by the rules of distribution of free software.  You can  use,
+# modify and/ or redistribute the software under the terms of the CeCILL
+# license as circulated by CEA, CNRS and INRIA at the following URL
+# http://www.cecill.info.
+#
+# As a counterpart to the access to the source code and  rights to copy,
+# modify and redistribute granted by the license, users are provided only
+# with a limited warranty  and the software's author,  the holder of the
+# economic rights,  and the successive licensors  have only  limited
+# liability.
+#
+# The fact that you are presently reading this means that you have had
+# knowledge of the CeCILL license and that you accept its terms.
+
+"""Tests for iotlabaggregator.rotate"""
+
+import os
+import tempfile
+import threading
+import time
+import unittest
+from unittest.mock import patch
+
+from iotlabaggregator import rotate, sniffer
+
+HEADER = b"HEAD"
+
+
+class TestRotatingFile(unittest.TestCase):
+    def setUp(self):
+        tmp_dir = tempfile.TemporaryDirectory()  # pylint:disable=consider-using-with
+        self.addCleanup(tmp_dir.cleanup)
+        self.tmp_dir = tmp_dir.name
+        self.path = os.path.join(self.tmp_dir, "capture.pcap")
+
+    def read(self, index):
+        name = os.path.join(self.tmp_dir, f"capture.{index}.pcap")
+        with open(name, "rb") as out:
+            return out.read()
+
+    def test_size(self):
+        with rotate.RotatingFile(self.path, max_size=12, header_size=4) as out:
+            out.write(HEADER)
+            out.write(b"1234")
+            out.write(b"5678")
+            out.write(b"9")  # Exceeds size
+            out.write(b"0123456789abcdef")  # Bigger than size
+            out.write(b"x")
+        self.assertEqual(HEADER + b"12345678", self.read(0))
+        self.assertEqual(HEADER + b"9", self.read(1))
+        self.assertEqual(HEADER + b"0123456789abcdef", self.read(2))
+        self.assertEqual(HEADER + b"x", self.read(3))
+
+    def test_interval(self):
+        with rotate.RotatingFile(self.path, interval=60) as out:
+            out.write(b"1")
+            out.write(b"2")
+            out._deadline = time.monotonic()
+            out.write(b"3")
+        self.assertEqual(b"12", self.read(0))
+        self.assertEqual(b"3", self.read(1))
+
+    def test_max_files(self):
+        out = rotate.RotatingFile(self.path, max_size=1, max_files=2)
+        for data in (b"a", b"b", b"c", b"d"):
+            out.write(data)
+        out.close()
+        self.assertEqual(
+            ["capture.2.pcap", "capture.3.pcap"], sorted(os.listdir(self.tmp_dir))
+        )
+        self.assertEqual(b"d", self.read(3))
+
+    def test_strftime(self):
+        path = os.path.join(self.tmp_dir, "capture-%Y.pcap")
+        with rotate.RotatingFile(path, max_size=1) as out:
+            out.write(b"a")
+        self.assertEqual(
+            [f"capture-{time.strftime('%Y')}.0.pcap"], os.listdir(self.tmp_dir)
+        )
+
+    def test_write_while_opening(self):
+        opening = threading.Event()
+        real_open = open
+
+        def slow_open(*args):
+            opening.wait(5)
+            return real_open(*args)
+
+        with patch("builtins.open", slow_open):
+            out = rotate.RotatingFile(self.path, max_size=100)
+            # Not waiting for the file to be opened
+            out.write(b"data")
+            out.flush()
+            self.assertEqual(b"data", out._pending)
+            opening.set()
+            out.close()
+        self.assertEqual(b"data", self.read(0))
+
+
+class TestRotateOptions(unittest.TestCase):
+    def test_options(self):
+        parser = sniffer.SnifferAggregator.parser
+        opts = parser.parse_args(["-o", "out.pcap", "-C", "1.5", "-W", "3"])
+        self.assertEqual(
+            {"max_size": 1500000, "interval": None, "max_files": 3},
+            rotate.rotate_options(parser, opts),
+        )
+        opts = parser.parse_args(["-o", "out.pcap"])
+        self.assertIsNone(rotate.rotate_options(parser, opts))
+
+    def test_count_requires_rotation(self):
+        parser = sniffer.SnifferAggregator.parser
+        opts = parser.parse_args(["-o", "out.pcap", "-W", "3"])
+        with patch("sys.stderr"):
+            self.assertRaises(SystemExit, rotate.rotate_options, parser, opts)
@@ -19,17 +19,19 @@
 # The fact that you are presently reading this means that you have had
 # knowledge of the CeCILL license and that you accept its terms.
 
+import io
+import socket
+import threading
 import unittest
 from unittest import mock
 
-from iotlabaggregator import serial
+from iotlabaggregator import dispatch, output, serial
+from iotlabaggregator.tests.connections_test import LocalConnection, wait_for
 
 
 class TestSelectNodes(unittest.TestCase):
     def setUp(self):
-        self.get_exp = mock.patch(
-            "iotlabaggregator.common.experiment.get_experiment"
-        ).start()
+        self.get_exp = mock.patch("iotlabcli.experiment.get_experiment").start()
         self.get_exp.side_effect = self._get_exp
         self.cur_exp = mock.patch("iotlabcli.get_current_experiment").start()
         self.cur_exp.return_value = 123
@@ -103,3 +105,241 @@ class TestColor(unittest.TestCase):
             import colorama as _  # noqa: F401
         else:
             self.assertRaises(ImportError, __import__, "colorama")
+
+
+class TestSerialConnectionPrintLines(unittest.TestCase):
+    def setUp(self):
+        self.writer = mock.Mock()
+        self.write_lines = self.writer.write_lines
+
+    def test_print_lines(self):
+        conn = serial.SerialConnection(
+            "m3-1", mock.Mock(), print_lines=True, line_writer=self.writer
+        )
+        conn.handle_data(b"hello\nworld\n")
+        self.write_lines.assert_called_once_with(
+            ["hello", "world"], "m3-1;", "", "m3-1"
+        )
+
+    def test_no_print_lines(self):
+        conn = serial.SerialConnection("m3-1", mock.Mock(), line_writer=self.writer)
+        conn.handle_data(b"hello\n")
+        self.write_lines.assert_not_called()
+
+    def test_color(self):
+        conn = serial.SerialConnection(
+            "m3-1", mock.Mock(), True, color=True, line_writer=self.writer
+        )
+        conn.handle_data(b"hello\n")
+        prefix = serial.color_str("m3-1") + "m3-1;"
+        self.write_lines.assert_called_once_with(
+            ["hello"], prefix, serial.COLOR_RESET, "m3-1"
+        )
+
+    def test_default_writer(self):
+        # Any stdout, with or without binary buffer
+        with mock.patch("sys.stdout", io.StringIO()) as stdout:
+            conn = serial.SerialConnection("m3-1", mock.Mock(), print_lines=True)
+            conn.handle_data(b"hello\n")
+        self.assertTrue(stdout.getvalue().endswith(";m3-1;hello\n"))
+        self.assertIsNone(serial.SerialConnection("m3-1", mock.Mock()).line_writer)
+
+
+class TestSerialConnectionHandleData(unittest.TestCase):
+    def setUp(self):
+        self.handler = mock.Mock()
+        self.conn = serial.SerialConnection(
+            "m3-1", mock.Mock(), line_handler=self.handler
+        )
+
+    def test_lines(self):
+        consumed = self.conn.handle_data(b"hello\nworld\npartial")
+        self.assertEqual(12, consumed)
+        self.handler.assert_has_calls(
+            [mock.call("m3-1", "hello"), mock.call("m3-1", "world")]
+        )
+        self.assertEqual(2, self.handler.call_count)
+        self.assertEqual(2, self.conn.stats.lines)
+
+    def test_lines_dispatched(self):
+        self.conn.dispatcher = dispatch.Dispatcher(workers=1)
+        self.conn.handle_data(b"hello\nworld\n")
+        self.conn.dispatcher.close()
+        self.handler.assert_has_calls(
+            [mock.call("m3-1", "hello"), mock.call("m3-1", "world")]
+        )
+        self.assertEqual(2, self.handler.call_count)
+        stats = self.conn.dispatcher.stats[self.handler]
+        self.assertEqual(2, stats.calls)
+
+    def test_lines_handler(self):
+        received = []
+        conn = serial.SerialConnection(
+            "m3-1",
+            mock.Mock(),
+            lines_handler=lambda node, data: received.append((node, bytes(data))),
+        )
+        self.assertEqual(12, conn.handle_data(b"hello\nworld\npartial"))
+        self.assertEqual([("m3-1", b"hello\nworld\n")], received)
+
+    def test_record_file(self):
+        record_file = io.BytesIO()
+        agg = serial.SerialAggregator(["m3-1"], record_file=record_file)
+        self.assertIn(agg.recorder, agg.outputs)
+        self.assertEqual([agg.recorder.write_lines], agg["m3-1"].lines_handler)
+
+    def test_record_and_print(self):
+        outfd, record_file = io.BytesIO(), io.BytesIO()
+        agg = serial.SerialAggregator(
+            ["m3-1"],
+            print_lines=True,
+            outfd=outfd,
+            record_file=record_file,
+            flush_policy=output.FlushPolicy(output.FlushPolicy.IDLE),
+        )
+        for line in (b"hello\n", b"world\n"):
+            agg["m3-1"].handle_data(line)
+            for out in agg.outputs:
+                out.idle()
+            # Both outputs are flushed
+            self.assertTrue(outfd.getvalue().endswith(b";m3-1;" + line))
+            self.assertTrue(record_file.getvalue().endswith(line[:-1]))
+
+    def test_output_queue(self):
+        outfd = io.BytesIO()
+        options = {"max_batches": 10, "policy": "block"}
+        agg = serial.SerialAggregator(
+            ["m3-1"], print_lines=True, outfd=outfd, output_queue=options
+        )
+        self.assertEqual([agg.queue], agg.outputs)
+        self.assertIs(agg.queue, agg.line_writer.queue)
+        agg["m3-1"].handle_data(b"hello\n")
+        agg.queue.close()
+        self.assertTrue(outfd.getvalue().endswith(b";m3-1;hello\n"))
+
+        agg = serial.SerialAggregator(["m3-1"], outfd=outfd)
+        self.assertIsNone(agg.line_writer.queue)
+
+    def test_line_writers(self):
+        # Each aggregator prints to its own output
+        outputs = io.BytesIO(), io.BytesIO()
+        aggs = [
+            serial.SerialAggregator(["m3-1"], print_lines=True, outfd=outfd)
+            for outfd in outputs
+        ]
+        self.assertIs(aggs[0].line_writer, aggs[0]["m3-1"].line_writer)
+        for agg, line in zip(aggs, (b"one\n", b"two\n")):
+            agg["m3-1"].handle_data(line)
+        self.assertTrue(outputs[0].getvalue().endswith(b";m3-1;one\n"))
+        self.assertTrue(outputs[1].getvalue().endswith(b";m3-1;two\n"))
+
+    def test_no_complete_line(self):
+        self.assertEqual(0, self.conn.handle_data(b"partial"))
+        self.handler.assert_not_called()
+
+    def test_long_line_chunks(self):
+        # The incomplete line is only searched from the previous length
+        buff = bytearray()
+        for chunk in (b"a" * 10, b"b" * 10, b"c\nd"):
+            buff.extend(chunk)
+            del buff[: self.conn.handle_data(buff)]
+            self.assertEqual(len(buff), self.conn._scanned)
+        self.handler.assert_called_once_with("m3-1", "a" * 10 + "b" * 10 + "c")
+        self.assertEqual(b"d", buff)
+
+        # Reconnecting clears the buffer and the scanned length
+        self.conn.close()
+        self.assertEqual(0, self.conn._scanned)
+        self.assertEqual(3, self.conn.handle_data(b"ef\n"))
+
+    def test_empty_and_crlf_lines(self):
+        self.conn.handle_data(b"\nline\r\n")
+        self.handler.assert_has_calls(
+            [mock.call("m3-1", ""), mock.call("m3-1", "line\r")]
+        )
+
+    def test_split_multibyte_char(self):
+        data = "température\n".encode()
+        split = data.index(b"\xa9")  # inside 'é'
+        chunks = [data[:split], data[split:]]
+
+        def recv_into(buff):
+            chunk = chunks.pop(0)
+            buff[: len(chunk)] = chunk
+            return len(chunk)
+
+        self.conn.recv_into = recv_into
+        self.conn.handle_read()
+        self.handler.assert_not_called()
+        self.conn.handle_read()
+        self.handler.assert_called_once_with("m3-1", "température")
+
+
+class LocalSerialConnection(LocalConnection, serial.SerialConnection):
+    """Serial connection to a local server."""
+
+
+class LocalSerialAggregator(serial.SerialAggregator):
+    connection_class = LocalSerialConnection
+
+
+@mock.patch("iotlabaggregator.connections.os.kill")
+@mock.patch("iotlabaggregator.connections.LOGGER", mock.Mock())
+class TestSerialIterLines(unittest.TestCase):
+    def setUp(self):
+        self.server = socket.create_server(("127.0.0.1", 0), backlog=2)
+        self.server.settimeout(2)
+        self.addCleanup(self.server.close)
+        address = self.server.getsockname()
+        LocalConnection.addresses = {"m3-1": address, "m3-2": address}
+
+    def _serve(self, *chunks):
+        """Send ``chunks`` to the nodes and close them."""
+        clients = [self.server.accept()[0] for _ in range(2)]
+        for chunk in chunks:
+            for sock in clients:
+                sock.sendall(chunk)
+        for sock in clients:
+            sock.close()
+
+    def test_iter_lines(self, kill):
+        aggregator = LocalSerialAggregator(["m3-1", "m3-2"])
+        lines = aggregator.iter_lines()
+        server = threading.Thread(target=self._serve, args=(b"a\nb", b"\xffc\n"))
+        with aggregator:
+            server.start()
+            # Ends when all connections are closed
+            received = list(lines)
+        server.join()
+        kill.assert_not_called()
+        for node in ("m3-1", "m3-2"):
+            node_lines = [line for name, line in received if name == node]
+            self.assertEqual(["a", "b\ufffdc"], node_lines)
+
+    def test_dispatch(self, _kill):
+        received = []
+        aggregator = LocalSerialAggregator(
+            ["m3-1", "m3-2"],
+            line_handler=lambda node, line: received.append((node, line)),
+            dispatch={"workers": 2, "queue_size": 1},
+        )
+        lines = [b"%u\n" % num for num in range(50)]
+        with aggregator:
+            self._serve(*lines)
+            self.assertTrue(wait_for(lambda: not aggregator))
+        # Queued calls are run on stop
+        for node in ("m3-1", "m3-2"):
+            node_lines = [line for name, line in received if name == node]
+            self.assertEqual([str(num) for num in range(50)], node_lines)
+
+    def test_iter_line_batches_timeout(self, _kill):
+        aggregator = LocalSerialAggregator(["m3-1", "m3-2"])
+        batches = aggregator.iter_line_batches(timeout=0.01)
+        with aggregator:
+            self.assertEqual([], next(batches))
+            batches.close()
+            self.assertEqual([], aggregator._items_queues)
+            self.server.accept()[0].close()
+            self.server.accept()[0].close()
+            aggregator.thread.join(2)
+            self.assertTrue(all(not node.lines_handler for node in aggregator.values()))
@@ -21,11 +21,30 @@
 
 import binascii
 import io
+import socket
+import struct
 import sys
 import unittest
 from unittest.mock import MagicMock, Mock, patch
 
-from iotlabaggregator import sniffer
+from iotlabaggregator import compress, dispatch, reorder, sniffer
+from iotlabaggregator.tests.connections_test import LocalConnection
+from iotlabaggregator.tests.zeptopcap_test import (
+    ZEP_MESSAGE_VALID_TS,
+    read_blocks,
+    read_options,
+)
+
+
+def recv_into_from(recv):
+    """Adapt a ``recv(n)`` function to a ``recv_into(buff)`` one."""
+
+    def recv_into(buff):
+        data = recv(len(buff))
+        buff[: len(data)] = data
+        return len(data)
+
+    return recv_into
 
 
 class TestSnifferHandleRead(unittest.TestCase):
@@ -63,11 +82,10 @@ class TestSnifferHandleRead(unittest.TestCase):
         aggregator = Mock()
         aggregator.rx_packets = 0
         sniff = sniffer.SnifferConnection("m3-1", aggregator, self.outfd.write)
-        sniff.recv = Mock(side_effect=recv)
+        sniff.recv_into = Mock(side_effect=recv_into_from(recv))
         sniff.handle_read()
         sniff.handle_read()
-        msg = self.zep_message.decode("latin-1")
-        self.outfd.write.assert_called_with(msg)
+        self.outfd.write.assert_called_with(self.zep_message)
 
     def test_invalid_data_start(self):
         def recv(_):
@@ -76,14 +94,57 @@ class TestSnifferHandleRead(unittest.TestCase):
         aggregator = Mock()
         aggregator.rx_packets = 0
         sniff = sniffer.SnifferConnection("m3-1", aggregator, self.outfd.write)
-        sniff.recv = Mock(side_effect=recv)
+        sniff.recv_into = Mock(side_effect=recv_into_from(recv))
 
         sniff.handle_read()
         sniff.handle_read()
 
         self.assertEqual(2, self.outfd.write.call_count)
-        msg = self.zep_message.decode("latin-1")
-        self.outfd.write.assert_called_with(msg)
+        self.outfd.write.assert_called_with(self.zep_message)
+
+    def test_many_packets_one_read(self):
+        def recv(_):
+            return (b"garbage" + self.zep_message) * 3 + self.zep_message[:10]
+
+        aggregator = Mock()
+        aggregator.rx_packets = 0
+        sniff = sniffer.SnifferConnection("m3-1", aggregator, self.outfd.write)
+        sniff.recv_into = Mock(side_effect=recv_into_from(recv))
+        sniff.handle_read()
+
+        self.assertEqual(3, self.outfd.write.call_count)
+        self.assertEqual(3, aggregator.rx_packets)
+        self.assertEqual(3, sniff.stats.packets)
+        self.assertEqual(3, sniff.stats.resyncs)
+        self.assertEqual(3 * len(b"garbage"), sniff.stats.skipped)
+        pkt = self.outfd.write.call_args[0][0]
+        self.assertIsInstance(pkt, bytes)
+        # Only the incomplete packet remains
+        self.assertEqual(self.zep_message[:10], sniff.data_buff)
+
+    def test_pkts_handler(self):
+        def recv(_):
+            return self.zep_message * 2 + self.zep_message[:10]
+
+        aggregator = Mock()
+        aggregator.rx_packets = 0
+        pkts_handler = Mock()
+        sniff = sniffer.SnifferConnection("m3-1", aggregator, pkts_handler=pkts_handler)
+        sniff.recv_into = Mock(side_effect=recv_into_from(recv))
+        sniff.handle_read()
+        pkts_handler.assert_called_once_with("m3-1", [self.zep_message] * 2)
+        self.assertEqual(2, aggregator.rx_packets)
+
+    def test_pkt_handler_dispatched(self):
+        aggregator = Mock()
+        aggregator.rx_packets = 0
+        received = []
+        sniff = sniffer.SnifferConnection("m3-1", aggregator, received.append)
+        sniff.dispatcher = dispatch.Dispatcher(workers=1)
+        sniff.handle_data(self.zep_message * 2)
+        sniff.dispatcher.close()
+        self.assertEqual([self.zep_message] * 2, received)
+        self.assertEqual(2, aggregator.rx_packets)
 
     def test_read_ret_values(self):
         for i in range(1, 100):
@@ -92,32 +153,107 @@ class TestSnifferHandleRead(unittest.TestCase):
             self.read_return_n_char_per_call(i)
 
     def read_return_n_char_per_call(self, num_chars):
-        msg = list((self.zep_message).decode("latin-1") * 10)
+        msg = bytearray(self.zep_message * 10)
 
         def recv(_):
-            ret = msg[0:num_chars]
+            ret = bytes(msg[0:num_chars])
             del msg[0:num_chars]
-            return ("".join(ret)).encode("latin-1")
+            return ret
 
         aggregator = Mock()
         aggregator.rx_packets = 0
         sniff = sniffer.SnifferConnection("m3-1", aggregator, self.outfd.write)
-        sniff.recv = Mock(side_effect=recv)
+        sniff.recv_into = Mock(side_effect=recv_into_from(recv))
 
         while msg:
             sniff.handle_read()
         self.assertEqual(10, self.outfd.write.call_count)
-        msg = (self.zep_message).decode("latin-1")
-        self.outfd.write.assert_called_with(msg)
+        self.outfd.write.assert_called_with(self.zep_message)
+
+
+class TestSnifferAggregatorReorder(unittest.TestCase):
+    def test_reorder_output(self):
+        outfd = io.BytesIO()
+        agg = sniffer.SnifferAggregator(["m3-1"], outfd, reorder_window=0.1)
+        self.assertIsInstance(agg.reorder, reorder.ReorderOutput)
+        self.assertIn(agg.reorder, agg.outputs)
+        self.assertEqual(24, len(outfd.getvalue()))  # pcap header not held
+
+        agg.reorder.max_records = 0
+        agg["m3-1"].handle_packets([ZEP_MESSAGE_VALID_TS])
+        self.assertEqual(1, agg.reorder.early)
+
+    def test_output_queue(self):
+        outfd = io.BytesIO()
+        options = {"max_batches": 10, "policy": "drop-oldest"}
+        agg = sniffer.SnifferAggregator(
+            ["m3-1"], outfd, reorder_window=0.1, output_queue=options
+        )
+        self.assertIs(agg.reorder, agg.queue.out)
+        self.assertEqual([agg.queue], agg.outputs)
+        agg["m3-1"].handle_packets([ZEP_MESSAGE_VALID_TS])
+        agg.queue.flush()
+        self.assertEqual(
+            24 + 16 + 42 + len(ZEP_MESSAGE_VALID_TS), len(outfd.getvalue())
+        )
+
+    def test_no_reorder(self):
+        agg = sniffer.SnifferAggregator(["m3-1"], io.BytesIO())
+        self.assertIsNone(agg.reorder)
+
+    def test_pcapng_reorder(self):
+        outfd = io.BytesIO()
+        agg = sniffer.SnifferAggregator(
+            ["m3-1"], outfd, pcapng=True, reorder_window=0.1
+        )
+        self.assertIs(reorder.pcapng_records, agg.reorder.records)
+        agg["m3-1"].handle_packets([ZEP_MESSAGE_VALID_TS])
+        agg.reorder.flush()
+        blocks = [block_type for block_type, _ in read_blocks(outfd.getvalue())]
+        self.assertEqual([0x0A0D0D0A, 1, 6], blocks)
+
+    def test_pcapng_reorder_interfaces(self):
+        outfd = io.BytesIO()
+        agg = sniffer.SnifferAggregator(
+            ["m3-1", "m3-2"], outfd, pcapng=True, reorder_window=0.1
+        )
+        later = bytearray(ZEP_MESSAGE_VALID_TS)
+        later[9:13] = struct.pack("!L", 0xE949B200 + 10)
+        # m3-1 first interface, with a packet newer than the m3-2 one
+        agg["m3-1"].handle_packets([bytes(later)])
+        agg["m3-2"].handle_packets([ZEP_MESSAGE_VALID_TS])
+        agg.reorder.flush()
+
+        blocks = read_blocks(outfd.getvalue())[1:]
+        self.assertEqual([1, 1, 6, 6], [block_type for block_type, _ in blocks])
+        names = [read_options(body[8:])[2] for _, body in blocks[:2]]
+        if_ids = [struct.unpack_from("=L", body)[0] for _, body in blocks[2:]]
+        # Packets ordered by timestamp, with their node interface
+        self.assertEqual([b"m3-2", b"m3-1"], [names[if_id] for if_id in if_ids])
+
+    def test_pcapng_drop_policy(self):
+        # Interfaces blocks are written with the first packets, never dropped
+        for policy in ("drop-oldest", "drop-newest"):
+            self.assertRaises(
+                ValueError,
+                sniffer.SnifferAggregator,
+                ["m3-1"],
+                io.BytesIO(),
+                pcapng=True,
+                output_queue={"max_batches": 1, "policy": policy},
+            )
+        options = {"max_batches": 1, "policy": "block"}
+        agg = sniffer.SnifferAggregator(
+            ["m3-1"], io.BytesIO(), pcapng=True, output_queue=options
+        )
+        agg.queue.close()
 
 
 class TestSnifferAggregatorSelectNodes(unittest.TestCase):
     """Tests for SnifferAggregator.select_nodes."""
 
     def setUp(self):
-        self.get_exp = patch(
-            "iotlabaggregator.common.experiment.get_experiment"
-        ).start()
+        self.get_exp = patch("iotlabcli.experiment.get_experiment").start()
         self.get_exp.return_value = {
             "items": [
                 {"network_address": "m3-1.grenoble.iot-lab.info", "site": "grenoble"},
@@ -192,6 +328,87 @@ class TestSnifferMain(unittest.TestCase):
         outfd_used = self._cls.call_args[0][1]
         self.assertIs(fake_file, outfd_used)
 
+    def test_main_flush_policy(self):
+        """--flush policy is given to the aggregator, default depends on output."""
+        sniffer.main(["-o", "-", "--flush", "10"])
+        policy = self._cls.call_args[1]["flush_policy"]
+        self.assertEqual(("count", 10), (policy.mode, policy.count))
+
+        with patch("builtins.open", return_value=io.BytesIO()):
+            sniffer.main(["-o", "/tmp/out.pcap"])
+        self.assertEqual("idle", self._cls.call_args[1]["flush_policy"].mode)
+
+    def test_main_connect_timeout(self):
+        sniffer.main(["-o", "-", "--connect-timeout", "2.5"])
+        self.assertEqual(2.5, self._cls.call_args[1]["connect_timeout"])
+
+    def test_main_reorder_window(self):
+        sniffer.main(["-o", "-", "--reorder-window", "200"])
+        self.assertEqual(0.2, self._cls.call_args[1]["reorder_window"])
+        self._cls.return_value.reorder.report.assert_called_once()
+
+    def test_main_workers(self):
+        with patch("iotlabaggregator.workers.WorkersAggregator") as workers_cls:
+            workers_cls.return_value = self._cls.return_value
+            sniffer.main(["-o", "-", "--workers", "4", "--raw"])
+        self._cls.assert_not_called()
+        args, kwargs = workers_cls.call_args
+        self.assertEqual((self._cls, ["m3-1"], 4, sys.stdout.buffer), args)
+        self.assertTrue(kwargs["raw"])
+
+    def test_main_pcapng(self):
+        sniffer.main(["-o", "-", "--pcapng", "--comments"])
+        self.assertTrue(self._cls.call_args[1]["pcapng"])
+        self.assertTrue(self._cls.call_args[1]["comments"])
+
+    def test_main_pcapng_errors(self):
+        with patch("sys.stderr", io.StringIO()):
+            for args in (
+                ["--pcapng", "--workers", "2"],
+                ["--comments"],
+                ["--pcapng", "--output-queue", "4", "--queue-policy", "drop-newest"],
+            ):
+                self.assertRaises(SystemExit, sniffer.main, ["-o", "-"] + args)
+        sniffer.main(["-o", "-", "--pcapng", "--output-queue", "4"])
+        self.assertEqual("block", self._cls.call_args[1]["output_queue"]["policy"])
+
+    def test_main_rotation(self):
+        with patch("iotlabaggregator.rotate.RotatingFile") as rotating:
+            sniffer.main(["-o", "out.pcap", "-G", "3600", "-W", "24"])
+        rotating.assert_called_once_with(
+            "out.pcap", header_size=24, max_size=None, interval=3600.0, max_files=24
+        )
+        self.assertIs(rotating.return_value.__enter__(), self._cls.call_args[0][1])
+
+        with patch("sys.stderr", io.StringIO()):
+            for args in (["-o", "-", "-C", "1"], ["-o", "a", "-C", "1", "--pcapng"]):
+                self.assertRaises(SystemExit, sniffer.main, args)
+
+    def test_main_compress(self):
+        sniffer.main(["-o", "-", "--compress", "gzip"])
+        outfd = self._cls.call_args[0][1]
+        self.assertIsInstance(outfd, compress.CompressedFile)
+        self.assertIs(sys.stdout.buffer, outfd.out)
+        self.assertTrue(outfd.closed)
+        with patch("sys.stderr", io.StringIO()):
+            args = ["-o", "a", "-C", "1", "--compress", "gzip"]
+            self.assertRaises(SystemExit, sniffer.main, args)
+
+    def test_main_relay(self):
+        with patch("iotlabaggregator.relay.run_relay") as run_relay:
+            sniffer.main(["--relay", "central:20200", "--relay-compress", "gzip"])
+        args, kwargs = run_relay.call_args
+        self.assertEqual((self._cls, ["m3-1"], ("central", 20200), "gzip"), args)
+        self.assertEqual("idle", kwargs["flush_policy"].mode)
+        self._cls.assert_not_called()
+        with patch("sys.stderr", io.StringIO()):
+            for args in (
+                [],
+                ["--relay", "c:1", "-o", "-"],
+                ["--relay", "c:1", "--pcapng"],
+            ):
+                self.assertRaises(SystemExit, sniffer.main, args)
+
     def test_main_empty_nodes_error(self):
         """ValueError (empty node list) is caught and exits with code 1."""
         self._cls.side_effect = ValueError("Empty nodes list")
@@ -206,3 +423,34 @@ class TestSnifferMain(unittest.TestCase):
         with patch("iotlabaggregator.sniffer.LOGGER") as mock_logger:
             sniffer.main(["-o", "-", "--debug"])
         mock_logger.setLevel.assert_called_once_with(logging.DEBUG)
+
+
+class LocalSnifferConnection(LocalConnection, sniffer.SnifferConnection):
+    """Sniffer connection to a local server."""
+
+
+class LocalSnifferAggregator(sniffer.SnifferAggregator):
+    connection_class = LocalSnifferConnection
+
+
+@patch("iotlabaggregator.connections.os.kill")
+@patch("iotlabaggregator.connections.LOGGER", Mock())
+class TestSnifferIterPackets(unittest.TestCase):
+    def test_iter_packets(self, kill):
+        server = socket.create_server(("127.0.0.1", 0))
+        server.settimeout(2)
+        self.addCleanup(server.close)
+        LocalConnection.addresses = {"m3-1": server.getsockname()}
+        outfd = io.BytesIO()
+        aggregator = LocalSnifferAggregator(["m3-1"], outfd)
+        packets = aggregator.iter_packets()
+        with aggregator:
+            sock = server.accept()[0]
+            sock.sendall(b"garbage" + ZEP_MESSAGE_VALID_TS * 2)
+            sock.close()
+            received = list(packets)
+        kill.assert_not_called()
+        self.assertEqual([("m3-1", ZEP_MESSAGE_VALID_TS)] * 2, received)
+        # Packets are still written to the pcap output
+        self.assertEqual(2, aggregator.rx_packets)
+        self.assertGreater(len(outfd.getvalue()), 24)
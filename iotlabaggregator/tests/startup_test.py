@@ -0,0 +1,73 @@
+#! /usr/bin/python
+
+# This file is a part of IoT-LAB aggregation-tools
+# Copyright (C) 2015 INRIA (Contact: admin@iot-lab.info)
+# Contributor(s) : see AUTHORS file
+#
+# This software is governed by the CeCILL license under French law
+# and abiding by the rules of distribution of free software.  You can  use,
+# modify and/ or redistribute the software under the terms of the CeCILL
+# license as circulated by CEA, CNRS and INRIA at the following URL
+# http://www.cecill.info.
+#
+# As a counterpart to the access to the source code and  rights to copy,
+# modify and redistribute granted by the license, users are provided only
+# with a limited warranty  and the software's author,  the holder of the
+# economic rights,  and the successive licensors  have only  limited
+# liability.
+#
+# The fact that you are presently reading this means that you have had
+# knowledge of the CeCILL license and that you accept its terms.
+
+"""Startup import cost regression tests, based on ``python -X importtime``."""
+
+import subprocess
+import sys
+import unittest
+
+# Only imported when used: HTTP client stack, line editing, colors, processes
+LAZY_MODULES = ("iotlabcli", "requests", "readline", "colorama", "multiprocessing")
+
+
+def imported_modules(code):
+    """Return the modules imported when running python ``code``."""
+    proc = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", code],
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    modules = set()
+    for line in proc.stderr.splitlines():
+        if line.startswith("import time:") and line.count("|") == 2:
+            modules.add(line.rsplit("|", 1)[1].strip())
+    return modules
+
+
+class TestStartupImports(unittest.TestCase):
+    def assert_lazy(self, code):
+        modules = imported_modules(code)
+        self.assertIn("iotlabaggregator", modules)
+        for lazy in LAZY_MODULES:
+            self.assertNotIn(lazy, modules, code)
+
+    def test_import(self):
+        self.assert_lazy("import iotlabaggregator.serial, iotlabaggregator.sniffer")
+
+    def test_help(self):
+        for module in ("serial", "sniffer"):
+            for option in ("--help", "--version"):
+                self.assert_lazy(
+                    f"from iotlabaggregator.{module} import main\n"
+                    f"try:\n    main([{option!r}])\n"
+                    "except SystemExit:\n    pass"
+                )
+
+    def test_parser_on_demand(self):
+        self.assert_lazy(
+            "from iotlabaggregator import common, serial\n"
+            "cls = serial.SerialAggregator\n"
+            "assert isinstance(vars(cls)['parser'], common.class_parser)\n"
+            "assert cls.parser.parse_args([]).nodes_list is None\n"
+            "assert vars(cls)['parser'] is cls.parser"
+        )
@@ -0,0 +1,203 @@
+#! /usr/bin/python
+
+# This file is a part of IoT-LAB aggregation-tools
+# Copyright (C) 2015 INRIA (Contact: admin@iot-lab.info)
+# Contributor(s) : see AUTHORS file
+#
+# This software is governed by the CeCILL license under French law
+# and abiding by the rules of distribution of free software.  You can  use,
+# modify and/ or redistribute the software under the terms of the CeCILL
+# license as circulated by CEA, CNRS and INRIA at the following URL
+# http://www.cecill.info.
+#
+# As a counterpart to the access to the source code and  rights to copy,
+# modify and redistribute granted by the license, users are provided only
+# with a limited warranty  and the software's author,  the holder of the
+# economic rights,  and the successive licensors  have only  limited
+# liability.
+#
+# The fact that you are presently reading this means that you have had
+# knowledge of the CeCILL license and that you accept its terms.
+
+"""Tests for iotlabaggregator.workers"""
+
+import io
+import os
+import socket
+import struct
+import subprocess
+import sys
+import tempfile
+import threading
+import unittest
+from unittest.mock import Mock, patch
+
+from iotlabaggregator import replay, serial, sniffer, workers
+from iotlabaggregator.tests.connections_test import wait_for
+from iotlabaggregator.tests.zeptopcap_test import ZEP_MESSAGE_VALID_TS
+
+# Different names for the same local server
+NODES = ["127.0.0.1", "localhost"]
+
+
+class PortSerialConnection(serial.SerialConnection):
+    def __init__(self, hostname, aggregator, port=None, **kwargs):
+        super().__init__(hostname, aggregator, **kwargs)
+        self.port = port
+
+
+class PortSnifferConnection(sniffer.SnifferConnection):
+    def __init__(self, hostname, aggregator, port=None, **kwargs):
+        super().__init__(hostname, aggregator, **kwargs)
+        self.port = port
+
+
+class SerialAggregator(serial.SerialAggregator):
+    connection_class = PortSerialConnection
+
+
+class SnifferAggregator(sniffer.SnifferAggregator):
+    connection_class = PortSnifferConnection
+
+
+class TestPipeWriter(unittest.TestCase):
+    def test_messages(self):
+        conn = Mock()
+        writer = workers.PipeWriter(conn)
+        writer.write(b"header")
+        writer.flush()
+        conn.send_bytes.assert_not_called()
+        writer.end_header()
+        writer.flush()
+        writer.write(b"abc")
+        writer.write(b"def")
+        writer.flush()
+        writer.write(b"g")
+        writer.end({"rx_packets": 3})
+        self.assertEqual(
+            [b"Hheader", b"Dabcdef", b"Dg", b'E{"rx_packets": 3}'],
+            [call.args[0] for call in conn.send_bytes.call_args_list],
+        )
+
+    def test_max_size(self):
+        conn = Mock()
+        writer = workers.PipeWriter(conn)
+        writer.end_header()
+        writer.max_size = 4
+        writer.write(b"ab")
+        conn.send_bytes.assert_called_once_with(b"H")
+        writer.write(b"cd")
+        conn.send_bytes.assert_called_with(b"Dabcd")
+
+
+@patch("iotlabaggregator.workers.os.kill")
+class TestWorkersAggregator(unittest.TestCase):
+    """Run workers processes connected to a local server."""
+
+    def setUp(self):
+        self.server = socket.create_server(("127.0.0.1", 0), backlog=len(NODES))
+        self.server.settimeout(10)
+        self.addCleanup(self.server.close)
+        self.port = self.server.getsockname()[1]
+        self.received = []
+
+    def _serve(self, data, until=b""):
+        """Send ``data`` to all nodes, close them after receiving ``until``."""
+        clients = [self.server.accept()[0] for _ in NODES]
+        for sock in clients:
+            sock.sendall(data)
+        for sock in clients:
+            sock.settimeout(10)
+            received = b""
+            while not received.endswith(until):
+                received += sock.recv(1024)
+            self.received.append(received)
+            sock.close()
+
+    def test_empty_nodes_list(self, _kill):
+        self.assertRaises(
+            ValueError, workers.WorkersAggregator, SerialAggregator, [], 2, None
+        )
+
+    def test_serial(self, kill):
+        outfd = io.BytesIO()
+        agg = workers.WorkersAggregator(
+            SerialAggregator, NODES, 4, outfd, print_lines=True, port=self.port
+        )
+        self.assertEqual(2, len(agg._workers))
+        self.assertIsNot(agg["127.0.0.1"], agg["localhost"])
+        with agg:
+            server = threading.Thread(target=self._serve, args=(b"hello\n", b"ping\n"))
+            server.start()
+            self.assertTrue(wait_for(lambda: outfd.getvalue().count(b"\n") == 2, 10))
+            agg.send_nodes(["localhost", "unknown"], "pong\n")
+            agg.broadcast("ping\n")
+            server.join()
+            agg.thread.join(10)
+            kill.assert_called_once()
+        lines = sorted(line.split(b";", 1)[1] for line in outfd.getvalue().split())
+        self.assertEqual([b"127.0.0.1;hello", b"localhost;hello"], lines)
+        self.assertEqual([b"ping\n", b"pong\nping\n"], sorted(self.received))
+
+    def test_sniffer(self, kill):
+        outfd = io.BytesIO()
+        agg = workers.WorkersAggregator(
+            SnifferAggregator, NODES, 2, outfd, raw=True, port=self.port
+        )
+        with agg:
+            self._serve(ZEP_MESSAGE_VALID_TS)
+            agg.thread.join(10)
+            kill.assert_called_once()
+        self.assertEqual(2, agg.rx_packets)
+        data = outfd.getvalue()
+        # One pcap header, then two raw packets records
+        self.assertEqual(0xA1B2C3D4, struct.unpack_from("=L", data)[0])
+        record_len = 16 + len(ZEP_MESSAGE_VALID_TS) - 32
+        self.assertEqual(24 + 2 * record_len, len(data))
+
+
+@patch("iotlabaggregator.replay.LOGGER", Mock())
+class TestScripts(unittest.TestCase):
+    """Run the repository scripts with workers on replayed nodes."""
+
+    root = os.path.dirname(os.path.dirname(os.path.dirname(__file__)))
+
+    def _run(self, script, events, port, *args):
+        """Return ``script`` output for replayed ``events`` nodes."""
+        try:
+            server = replay.ReplayServer(events, port, speed=0)
+        except OSError as err:
+            self.skipTest(f"Nodes port {port} unavailable: {err}")
+        self.addCleanup(server.close)
+        fd, hosts = tempfile.mkstemp()
+        os.close(fd)
+        self.addCleanup(os.remove, hosts)
+        server.write_hosts_file(hosts)
+        cmd = [sys.executable, os.path.join(self.root, script), "--workers", "2"]
+        with subprocess.Popen(
+            cmd + ["--hosts-file", hosts, *args],
+            stdin=subprocess.PIPE,  # Serial aggregator stops on input end
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+        ) as proc:
+            self.assertEqual(2, server.wait_clients(20))
+            server.run()
+            server.close()
+            # Stops when all workers ended, after writing the nodes output
+            proc.wait(timeout=20)
+            out, err = proc.communicate()
+        self.assertEqual(0, proc.returncode, err)
+        return out
+
+    def test_serial_aggregator(self):
+        events = [(1.0, "m3-1", b"hello\n"), (1.0, "m3-2", b"world\n")]
+        out = self._run("serial_aggregator", events, serial.SerialConnection.port)
+        lines = sorted(line.split(b";", 1)[1] for line in out.split())
+        self.assertEqual([b"m3-1;hello", b"m3-2;world"], lines)
+
+    def test_sniffer_aggregator(self):
+        events = [(1.0, node, ZEP_MESSAGE_VALID_TS) for node in ("m3-1", "m3-2")]
+        port = sniffer.SnifferConnection.port
+        out = self._run("sniffer_aggregator", events, port, "-o", "-", "--raw")
+        record_len = 16 + len(ZEP_MESSAGE_VALID_TS) - 32
+        self.assertEqual(24 + 2 * record_len, len(out))
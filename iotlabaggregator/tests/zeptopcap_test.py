@@ -25,6 +25,7 @@ import binascii
 import io
 import struct
 import unittest
+from unittest.mock import Mock
 
 from iotlabaggregator import zeptopcap
 
@@ -68,6 +69,49 @@ ZEP_MESSAGE_VALID_TS = binascii.a2b_hex(
     )
 )
 
+# Ethernet, IP and UDP headers of a 40 bytes ZEP packet
+NET_HEADERS = binascii.a2b_hex(
+    "".join(
+        (
+            "00 00 00 00 00 00"  # Ethernet destination
+            "00 00 00 00 00 00"  # Ethernet source
+            "08 00"  # Ethernet protocol: IP
+            "45 00 00 44"  # IP version | IHL | TOS | length: 20 + 8 + 40
+            "00 00 40 00"  # IP identification | flags: don't fragment
+            "ff 11 7d a6"  # IP TTL | protocol: UDP | checksum
+            "7f 00 00 01"  # IP source: 127.0.0.1
+            "7f 00 00 01"  # IP destination: 127.0.0.1
+            "45 5a 45 5a"  # UDP source | destination ports: 17754
+            "00 30 00 00"  # UDP length: 8 + 40 | checksum: disabled
+        ).split()
+    )
+)
+
+
+def read_blocks(data):
+    """Return pcapng ``data`` ``(block_type, body)`` blocks."""
+    blocks = []
+    offset = 0
+    while offset < len(data):
+        block_type, length = struct.unpack_from("=LL", data, offset)
+        assert length % 4 == 0
+        assert (length,) == struct.unpack_from("=L", data, offset + length - 4)
+        blocks.append((block_type, data[offset + 8 : offset + length - 4]))
+        offset += length
+    return blocks
+
+
+def read_options(data):
+    """Return pcapng options ``data`` as a dict."""
+    options = {}
+    offset = 0
+    while True:
+        code, length = struct.unpack_from("=HH", data, offset)
+        if code == 0:
+            return options
+        options[code] = data[offset + 4 : offset + 4 + length]
+        offset += 4 + length + (-length % 4)
+
 
 class TestZepPcapHeaders(unittest.TestCase):
     """Tests for ZepPcap header generation."""
@@ -99,45 +143,13 @@ class TestZepPcapHeaders(unittest.TestCase):
         link_type = struct.unpack_from("=L", data, 20)[0]
         self.assertEqual(1, link_type)
 
-    def test_udp_header(self):
-        hdr = self.zep._udp_header(10)
-        self.assertEqual(8 + 10, struct.unpack("!H", hdr[4:6])[0])
-
-    def test_ip_header_length(self):
-        hdr = self.zep._ip_header(0)
-        self.assertEqual(20, len(hdr))
-
-    def test_ip_header_protocol_udp(self):
-        hdr = self.zep._ip_header(0)
-        # Protocol byte is at offset 9
-        self.assertEqual(0x11, hdr[9])
-
-    def test_eth_header_length(self):
-        hdr = self.zep._eth_header(100)
-        self.assertEqual(14, len(hdr))
-
-    def test_pcap_header(self):
-        hdr = zeptopcap.ZepPcap._pcap_header(40, 1000, 500)
-        ts_s, ts_us, pkt_len, orig_len = struct.unpack("=LLLL", hdr)
-        self.assertEqual(1000, ts_s)
-        self.assertEqual(500, ts_us)
-        self.assertEqual(40, pkt_len)
-        self.assertEqual(40, orig_len)
-
-    def test_ip_checksum_all_zeros(self):
-        hdr = b"\x00" * 20
-        csum = zeptopcap.ZepPcap._ip_checksum(hdr)
-        self.assertEqual(0xFFFF, csum)
-
-    def test_ip_checksum_nonzero(self):
-        # A known valid IP header should produce checksum 0 when re-checked
-        # (XOR with 0xFFFF of sum gives 0 when checksum field is correct)
-        hdr_struct = struct.Struct("!BBHHHBBHLL")
-        ip_hdr = hdr_struct.pack(
-            0x45, 0, 20, 0, 0x4000, 0xFF, 0x11, 0, 0x7F000001, 0x7F000001
-        )
-        csum = zeptopcap.ZepPcap._ip_checksum(ip_hdr)
-        self.assertNotEqual(0, csum)
+    def test_net_headers(self):
+        buff = bytearray(len(NET_HEADERS))
+        self.zep._net_header_into(buff, 0, 40)
+        self.assertEqual(NET_HEADERS, buff)
+        # IP header words sum, with its checksum, is 0xFFFF
+        words = sum(struct.unpack_from("!10H", buff, 14))
+        self.assertEqual(0xFFFF, (words + (words >> 16)) & 0xFFFF)
 
 
 class TestZepPcapTimestamp(unittest.TestCase):
@@ -176,14 +188,14 @@ class TestZepPcapWrite(unittest.TestCase):
         out = io.BytesIO()
         zep = zeptopcap.ZepPcap(out)
         initial_len = len(out.getvalue())
-        zep.write(ZEP_MESSAGE_VALID_TS.decode("latin-1"))
+        zep.write(ZEP_MESSAGE_VALID_TS)
         self.assertGreater(len(out.getvalue()), initial_len)
 
     def test_write_raw_produces_output(self):
         out = io.BytesIO()
         zep = zeptopcap.ZepPcap(out, raw=True)
         initial_len = len(out.getvalue())
-        zep.write(ZEP_MESSAGE_VALID_TS.decode("latin-1"))
+        zep.write(ZEP_MESSAGE_VALID_TS)
         self.assertGreater(len(out.getvalue()), initial_len)
 
     def test_write_zep_pcap_record_length(self):
@@ -191,7 +203,7 @@ class TestZepPcapWrite(unittest.TestCase):
         out = io.BytesIO()
         zep = zeptopcap.ZepPcap(out)
         header_size = len(out.getvalue())
-        zep.write(ZEP_MESSAGE_VALID_TS.decode("latin-1"))
+        zep.write(ZEP_MESSAGE_VALID_TS)
         record = out.getvalue()[header_size:]
         # pcap record header: 8 bytes timestamps + 4 bytes captured len + 4 bytes orig len
         pkt_len = struct.unpack_from("=L", record, 8)[0]
@@ -203,8 +215,117 @@ class TestZepPcapWrite(unittest.TestCase):
         out = io.BytesIO()
         zep = zeptopcap.ZepPcap(out, raw=True)
         header_size = len(out.getvalue())
-        zep.write(ZEP_MESSAGE_VALID_TS.decode("latin-1"))
+        zep.write(ZEP_MESSAGE_VALID_TS)
         record = out.getvalue()[header_size:]
         pkt_len = struct.unpack_from("=L", record, 8)[0]
         expected = len(ZEP_MESSAGE_VALID_TS) - zeptopcap.ZepPcap.ZEP_HDR_LEN
         self.assertEqual(expected, pkt_len)
+
+    def test_write_zep_record_matches_headers(self):
+        """Encoded record is the pcap header, network headers and packet."""
+        out = io.BytesIO()
+        zep = zeptopcap.ZepPcap(out)
+        header_size = len(out.getvalue())
+        zep.write(ZEP_MESSAGE_VALID_TS)
+
+        # 0xE949B200 NTP timestamp as unix time, record length
+        pcap_hdr = struct.pack("=LLLL", 1704932224, 0, 82, 82)
+        expected = pcap_hdr + NET_HEADERS + ZEP_MESSAGE_VALID_TS
+        self.assertEqual(expected, out.getvalue()[header_size:])
+
+    def test_write_packets_single_write(self):
+        for raw in (False, True):
+            out = io.BytesIO()
+            zep = zeptopcap.ZepPcap(out, raw=raw)
+            zep.write(ZEP_MESSAGE_VALID_TS)
+            zep.write(ZEP_MESSAGE_VALID_TS + b"more")
+            expected = out.getvalue()
+
+            out = io.BytesIO()
+            zep = zeptopcap.ZepPcap(out, raw=raw)
+            out.write = Mock(side_effect=out.write)
+            zep.write_packets(
+                "m3-1", [ZEP_MESSAGE_VALID_TS, ZEP_MESSAGE_VALID_TS + b"more"]
+            )
+            out.write.assert_called_once()
+            self.assertEqual(expected, out.getvalue())
+
+    def test_write_packets_reuses_buffer(self):
+        out = io.BytesIO()
+        zep = zeptopcap.ZepPcap(out)
+        zep.write_packets("m3-1", [ZEP_MESSAGE_VALID_TS] * 3)
+        buff = zep._buff
+        zep.write(ZEP_MESSAGE_VALID_TS)
+        self.assertIs(buff, zep._buff)
+        records = out.getvalue()[24:]
+        self.assertEqual(records[: len(records) // 4] * 4, records)
+
+
+class TestZepPcapng(unittest.TestCase):
+    """Tests for ZepPcapng."""
+
+    def test_section_header(self):
+        out = io.BytesIO()
+        zeptopcap.ZepPcapng(out)
+        ((block_type, body),) = read_blocks(out.getvalue())
+        self.assertEqual(0x0A0D0D0A, block_type)
+        self.assertEqual((0x1A2B3C4D, 1, 0, -1), struct.unpack("=LHHq", body))
+        # Same header for all link types, given by the interfaces blocks
+        header = zeptopcap.ZepPcapng._main_pcap_header(195)
+        self.assertEqual(out.getvalue(), header)
+
+    def test_interface_block(self):
+        block = zeptopcap.ZepPcapng._interface_block("m3-1", 1)
+        ((block_type, body),) = read_blocks(block)
+        self.assertEqual(1, block_type)
+        self.assertEqual((1, 0, 0), struct.unpack_from("=HHL", body))
+
+    def test_interfaces(self):
+        out = io.BytesIO()
+        zep = zeptopcap.ZepPcapng(out, raw=True)
+        self.assertEqual(195, zep.link)
+        zep.write_packets("m3-1", [ZEP_MESSAGE_VALID_TS])
+        zep.write_packets("m3-2", [ZEP_MESSAGE_VALID_TS])
+        zep.write_packets("m3-1", [ZEP_MESSAGE_VALID_TS])
+        self.assertEqual({"m3-1": 0, "m3-2": 1}, zep.interfaces)
+
+        blocks = read_blocks(out.getvalue())[1:]
+        self.assertEqual([1, 6, 1, 6, 6], [block_type for block_type, _ in blocks])
+        link, _, snaplen = struct.unpack_from("=HHL", blocks[0][1])
+        self.assertEqual((195, 0), (link, snaplen))
+        options = read_options(blocks[0][1][8:])
+        self.assertEqual({2: b"m3-1", 9: b"\x09"}, options)
+        self.assertEqual(b"m3-2", read_options(blocks[2][1][8:])[2])
+        if_ids = [struct.unpack_from("=L", blocks[i][1])[0] for i in (1, 3, 4)]
+        self.assertEqual([0, 1, 0], if_ids)
+
+    def test_packet(self):
+        out = io.BytesIO()
+        zep = zeptopcap.ZepPcapng(out)
+        ntp_time = zeptopcap.ZepPcap.NTP_TIME.pack(0xE949B200, 1 << 30)
+        packet = bytearray(ZEP_MESSAGE_VALID_TS)
+        packet[9:17] = ntp_time
+        zep.write_packets("m3-1", [bytes(packet)])
+
+        pcap_out = io.BytesIO()
+        zeptopcap.ZepPcap(pcap_out).write(bytes(packet))
+        expected = pcap_out.getvalue()[24 + 16 :]  # Network headers + packet
+
+        body = read_blocks(out.getvalue())[2][1]
+        _, t_high, t_low, cap_len, length = struct.unpack_from("=LLLLL", body)
+        t_ns = (t_high << 32) | t_low
+        self.assertEqual((0xE949B200 - 2208988800) * 10**9 + 250000000, t_ns)
+        self.assertEqual((len(expected), len(expected)), (cap_len, length))
+        self.assertEqual(expected, body[20 : 20 + cap_len])
+        # No options
+        self.assertEqual(20 + cap_len + (-cap_len % 4), len(body))
+
+    def test_comments(self):
+        out = io.BytesIO()
+        zep = zeptopcap.ZepPcapng(out, raw=True, comments=True)
+        zep.write_packets("m3-1", [ZEP_MESSAGE_VALID_TS])
+        body = read_blocks(out.getvalue())[2][1]
+        cap_len = struct.unpack_from("=L", body, 12)[0]
+        self.assertEqual(ZEP_MESSAGE_VALID_TS[32:], body[20 : 20 + cap_len])
+        options = read_options(body[20 + cap_len + (-cap_len % 4) :])
+        self.assertEqual({1: b"m3-1 channel=11 lqi=255 seqno=1"}, options)
@@ -0,0 +1,318 @@
+#! /usr/bin/env python
+
+# This file is a part of IoT-LAB aggregation-tools
+# Copyright (C) 2015 INRIA (Contact: admin@iot-lab.info)
+# Contributor(s) : see AUTHORS file
+#
+# This software is governed by the CeCILL license under French law
+# and abiding by the rules of distribution of free software.  You can  use,
+# modify and/ or redistribute the software under the terms of the CeCILL
+# license as circulated by CEA, CNRS and INRIA at the following URL
+# http://www.cecill.info.
+#
+# As a counterpart to the access to the source code and  rights to copy,
+# modify and redistribute granted by the license, users are provided only
+# with a limited warranty  and the software's author,  the holder of the
+# economic rights,  and the successive licensors  have only  limited
+# liability.
+#
+# The fact that you are presently reading this means that you have had
+# knowledge of the CeCILL license and that you accept its terms.
+
+"""Run aggregators on nodes shards in worker processes
+
+Each worker process runs an aggregator, with its own selector loop, on a part
+of the nodes list. Workers output is sent to the parent process through a pipe
+as chunks of whole records, and merged in one output in arrival order.
+
+Messages from a worker start with a tag byte:
+
+* ``H``: output header, the first message, only the first one is written
+* ``D``: output data
+* ``E``: end of worker, followed by its json encoded counters
+"""
+
+import argparse
+import io
+import json
+import os
+import signal
+import threading
+
+from iotlabaggregator import LOGGER, metrics, output, reorder
+
+# multiprocessing is only imported when workers are used, for a fast startup
+# pylint:disable=import-outside-toplevel
+
+HEADER = b"H"
+DATA = b"D"
+END = b"E"
+
+
+def workers_count(value):
+    """Parse workers number.
+
+    >>> workers_count('4')
+    4
+    >>> workers_count('0')
+    Traceback (most recent call last):
+    ...
+    argparse.ArgumentTypeError: Invalid workers number: '0'
+    """
+    try:
+        count = int(value)
+    except ValueError:
+        count = 0
+    if count < 1:
+        raise argparse.ArgumentTypeError(f"Invalid workers number: {value!r}")
+    return count
+
+
+def add_workers_parser(parser):
+    """Add worker processes option to ``parser``."""
+    parser.add_argument(
+        "--workers",
+        type=workers_count,
+        default=1,
+        metavar="N",
+        help="Split nodes between N worker processes. Default: 1",
+    )
+
+
+class PipeWriter(io.RawIOBase):
+    """Binary file object sending flushed data through ``conn``.
+
+    Data is only sent on ``flush`` or when ``max_size`` bytes are pending,
+    so messages only contain whole records written by outputs.
+    """
+
+    max_size = 1 << 16
+
+    def __init__(self, conn):
+        super().__init__()
+        self.conn = conn
+        self._buff = bytearray(HEADER)
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        """Buffer ``data``."""
+        self._buff += data
+        if len(self._buff) >= self.max_size and self._buff[:1] == DATA:
+            self.flush()
+        return len(data)
+
+    def flush(self):
+        """Send pending data, header is only sent by ``end_header``."""
+        if len(self._buff) > 1 and self._buff[:1] == DATA:
+            self._send(DATA)
+
+    def end_header(self):
+        """Send the output header, possibly empty."""
+        self._send(DATA)
+
+    def end(self, counters):
+        """Send pending data and the worker ``counters``."""
+        self.flush()
+        self.conn.send_bytes(END + json.dumps(counters).encode())
+
+    def _send(self, next_tag):
+        self.conn.send_bytes(self._buff)
+        self._buff = bytearray(next_tag)
+
+
+def run_worker(conn, aggregator_class, nodes_list, kwargs, log_level):
+    """Run ``aggregator_class`` on ``nodes_list`` and send output on ``conn``.
+
+    ``conn`` is a pipe connection, or a relay connection with the same
+    ``send_bytes``, ``recv`` and ``close`` methods.
+    Parent commands ``(nodes_list, message)`` are sent to nodes,
+    ``None`` stops the worker.
+    """
+    LOGGER.setLevel(log_level)
+    writer = PipeWriter(conn)
+    aggregator = None
+    try:
+        aggregator = aggregator_class(nodes_list, outfd=writer, **kwargs)
+        writer.end_header()
+        with aggregator:
+            while (command := conn.recv()) is not None:
+                aggregator.send_nodes(*command)
+    except (KeyboardInterrupt, EOFError, BrokenPipeError):
+        pass
+    except (ValueError, RuntimeError) as err:
+        LOGGER.error("Worker failed: %s", err)
+    try:
+        counters = {"rx_packets": getattr(aggregator, "rx_packets", 0)}
+        writer.end(counters)
+    except OSError:
+        pass  # Parent is gone
+    finally:
+        conn.close()
+
+
+class WorkersAggregator(dict):
+    """Run ``aggregator_class`` aggregators in ``workers`` processes.
+
+    Nodes are split between workers, each node entry is its worker pipe.
+    Workers output is merged in binary ``outfd``. Workers use
+    ``flush_policy`` to send their output, it is written to ``outfd`` on each
+    received chunk, or as configured for 'time' and 'idle' policies.
+
+    With ``reorder_window``, merged records are ordered by timestamp, they
+    are split with ``aggregator_class.output_records``.
+
+    ``aggregator_class`` must accept an ``outfd`` binary output argument.
+    Other ``kwargs`` are given to the workers aggregators, with ``metrics``
+    files and sockets paths suffixed by the worker index.
+    """
+
+    def __init__(  # pylint:disable=too-many-arguments
+        self,
+        aggregator_class,
+        nodes_list,
+        workers,
+        outfd,
+        flush_policy=None,
+        reorder_window=None,
+        **kwargs,
+    ):
+        if not nodes_list:
+            raise ValueError(
+                f"{self.__class__.__name__}: Empty nodes list {nodes_list!r}"
+            )
+        super().__init__()
+        policy = flush_policy or output.FlushPolicy()
+        kwargs["flush_policy"] = policy
+        if policy.mode in (policy.COUNT, policy.RECORD):
+            policy = output.FlushPolicy()  # Workers already grouped records
+        self.out = output.Output(outfd, policy)
+        # Records output stage, header is directly written to ``out``
+        self.reorder = None
+        self._records_out = self.out
+        if reorder_window:
+            self.reorder = reorder.ReorderOutput(
+                self.out, reorder_window, aggregator_class.output_records
+            )
+            self._records_out = self.reorder
+        self.rx_packets = 0
+        self.thread = threading.Thread(target=self._merge, daemon=True)
+        self._running = False
+        self._header = None
+
+        import multiprocessing
+
+        ctx = multiprocessing.get_context("spawn")
+        self._workers = {}
+        metrics_options = kwargs.pop("metrics", None)
+        workers = min(workers, len(nodes_list))
+        for index in range(workers):
+            shard = nodes_list[index::workers]
+            worker_kwargs = dict(kwargs)
+            if metrics_options is not None:
+                worker_kwargs["metrics"] = metrics.worker_options(
+                    metrics_options, index
+                )
+            conn, child_conn = ctx.Pipe()
+            process = ctx.Process(
+                target=run_worker,
+                args=(child_conn, aggregator_class, shard, worker_kwargs, LOGGER.level),
+                name=f"aggregator-worker-{index}",
+                daemon=True,
+            )
+            self._workers[conn] = (process, child_conn)
+            self.update(dict.fromkeys(shard, conn))
+
+    def start(self):
+        """Start workers processes and output merging thread."""
+        self._running = True
+        for process, child_conn in self._workers.values():
+            process.start()
+            child_conn.close()
+        self.thread.start()
+        LOGGER.info("Aggregator started with %u workers", len(self._workers))
+
+    def _merge(self):
+        """Write workers output; send SIGINT when all workers ended."""
+        import multiprocessing.connection
+
+        conns = list(self._workers)
+        timeout = min(filter(None, [1.0, self._records_out.timeout]))
+        while conns:
+            for conn in multiprocessing.connection.wait(conns, timeout):
+                try:
+                    self._handle_message(conn.recv_bytes())
+                except (EOFError, OSError):
+                    conns.remove(conn)
+            self._records_out.idle()
+        if self._running:
+            LOGGER.info("All workers ended")
+            os.kill(os.getpid(), signal.SIGINT)
+
+    def _handle_message(self, message):
+        """Handle one worker ``message``."""
+        tag = message[:1]
+        with memoryview(message) as view:
+            if tag == DATA:
+                self._records_out.write(view[1:])
+            elif tag == HEADER and self._header is None:
+                self._header = bytes(view[1:])
+                self.out.write(self._header)
+                self.out.flush()
+            elif tag == END:
+                self.rx_packets += json.loads(bytes(view[1:]))["rx_packets"]
+
+    def stop(self):
+        """Stop workers, wait for their remaining output and flush it."""
+        LOGGER.info("Stopping")
+        self._running = False
+        for conn in self._workers:
+            self._command(conn, None)
+        self.thread.join()
+        for process, _ in self._workers.values():
+            process.join()
+        for conn in self._workers:
+            conn.close()
+        self._records_out.flush()
+
+    def run(self):
+        """Main function to run."""
+        try:
+            signal.pause()
+        except KeyboardInterrupt:
+            pass
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, _type, _value, _traceback):
+        self.stop()
+
+    def send_nodes(self, nodes_list, message):
+        """Send ``message`` to ``nodes_list`` nodes; broadcast if None."""
+        if nodes_list is None:
+            self.broadcast(message)
+            return
+        shards = {}
+        for node in nodes_list:
+            try:
+                shards.setdefault(self[node], []).append(node)
+            except KeyError:
+                LOGGER.warning("Node not managed: %s", node)
+        for conn, nodes in shards.items():
+            self._command(conn, (nodes, message))
+
+    def broadcast(self, message):
+        """Send a message to all nodes."""
+        for conn in self._workers:
+            self._command(conn, (None, message))
+
+    @staticmethod
+    def _command(conn, command):
+        """Send ``command`` to worker, ignore ended workers."""
+        try:
+            conn.send(command)
+        except OSError:
+            pass
@@ -29,11 +29,16 @@ import binascii
 import struct
 import sys
 
+from iotlabaggregator import output
+
 
 # pylint:disable=bad-option-value,too-few-public-methods,old-style-class
 class ZepPcap:
     """Zep to Pcap converter
     On `write` encapsulate the message as a zep packet in `outfile` pcap format
+
+    Output is buffered in ``out`` and flushed according to ``flush_policy``,
+    by default after each write.
     """
 
     ZEP_PORT = 17754
@@ -47,25 +52,32 @@ class ZepPcap:
     NTP_JAN_1970 = 2208988800
     NTP_SECONDS_FRAC = 1 << 32
 
-    # Network headers as network endian
-    eth_hdr = struct.pack(
-        "!3H3HH",
-        0,
-        0,
-        0,  # dst mac addr
-        0,
-        0,
-        0,  # src mac addr
-        0x0800,
-    )  # Protocol: (0x0800 == IP)
-
-    def __init__(self, outfile, raw=False):
-        self.out = outfile
+    # pcap file header, written once before the records
+    MAIN_PCAP_HDR = struct.Struct("=LHHLLLL")
+    PCAP_HDR = struct.Struct("=LLLL")
+    IP_HDR = struct.Struct("!BBHHHBBHLL")
+    UDP_HDR = struct.Struct("!HHHH")
+    NTP_TIME = struct.Struct("!LL")
+    # Ethernet (zero mac addresses) + IP + UDP headers packed at once
+    NET_HDR = struct.Struct("!12xH" + IP_HDR.format[1:] + UDP_HDR.format[1:])
+    LOCALHOST = 0x7F000001
+
+    def __init__(self, outfile, raw=False, flush_policy=None):
+        self.out = output.Output(outfile, flush_policy)
+        # Reusable records buffer, only grows to the biggest batch size
+        self._buff = bytearray()
 
         # configure "raw" mode
         # On raw, use linktype 802.15_4 else ethernet encapsulation
-        self.write = self._write_raw if raw else self._write_zep
-        link = self.LINKTYPE_IEEE802_15_4 if raw else self.LINKTYPE_ETHERNET
+        self._encode = self._encode_raw if raw else self._encode_zep
+        link = self.link_type(raw)
+
+        # IP header 16 bits words sum without length and checksum.
+        # Length is the only field that changes between packets.
+        ip_hdr = self.IP_HDR.pack(
+            0x45, 0, 0, 0, 0x4000, 0xFF, 0x11, 0, self.LOCALHOST, self.LOCALHOST
+        )
+        self._ip_sum = sum(struct.unpack("!10H", ip_hdr))
 
         # Write global header
         hdr = self._main_pcap_header(link)
@@ -73,51 +85,95 @@ class ZepPcap:
         self.out.write(hdr)
         self.out.flush()
 
-    def _write_zep(self, packet):
-        """Encapsulate ZEP data in pcap outfile"""
-        packet = packet.encode("latin-1")
-        timestamp = self._timestamp(packet)
-
-        # Calculate all headers
-        length = len(packet)
-
-        udp_hdr = self._udp_header(length)
-        length += len(udp_hdr)
+    @classmethod
+    def link_type(cls, raw=False):
+        """Return the pcap link type for ``raw`` mode.
 
-        ip_hdr = self._ip_header(length)
-        length += len(ip_hdr)
-
-        eth_hdr = self._eth_header(length)
-        length += len(eth_hdr)
-
-        pcap_hdr = self._pcap_header(length, timestamp[0], timestamp[1])
-        length += len(pcap_hdr)
-
-        # Actually write the data
-        self.out.write(pcap_hdr)
-        self.out.write(eth_hdr)
-        self.out.write(ip_hdr)
-        self.out.write(udp_hdr)
-        self.out.write(packet)
-        self.out.flush()
+        >>> ZepPcap.link_type(), ZepPcap.link_type(raw=True)
+        (1, 195)
+        """
+        return cls.LINKTYPE_IEEE802_15_4 if raw else cls.LINKTYPE_ETHERNET
 
-    def _write_raw(self, packet):
-        """Only write the ZEP payload as pcap"""
-        packet = packet.encode("latin-1")
-        timestamp = self._timestamp(packet)
+    def write(self, packet):
+        """Write one ZEP ``packet`` bytes"""
+        self.write_packets(None, (packet,))
 
-        # extract payload from zep encapsulated data
-        payload = packet[self.ZEP_HDR_LEN :]
+    def write_packets(self, identifier, packets):
+        """Write ZEP ``packets`` as pcap records with one single write
 
-        # Only add pcap header
-        length = len(payload)
-        pcap_hdr = self._pcap_header(length, timestamp[0], timestamp[1])
-        length += len(pcap_hdr)
+        :param identifier: packets source node, not stored in pcap format
+        """
+        size = self._encode(packets)
+        with memoryview(self._buff) as view:
+            self.out.write(view[:size], len(packets), identifier)
+
+    def _reserve(self, size):
+        """Return the records buffer grown to at least ``size``"""
+        missing = size - len(self._buff)
+        if missing > 0:
+            self._buff.extend(bytes(missing))
+        return self._buff
+
+    def _encode_zep(self, packets):
+        """Encapsulate ZEP ``packets`` in records buffer, return its length"""
+        pcap_hdr, net_hdr = self.PCAP_HDR, self.NET_HDR
+        hdr_len = pcap_hdr.size + net_hdr.size
+        buff = self._reserve(sum(map(len, packets)) + hdr_len * len(packets))
+
+        offset = 0
+        for packet in packets:
+            t_s, t_us = self._timestamp(packet)
+            length = len(packet)
+            rec_len = net_hdr.size + length
+            pcap_hdr.pack_into(buff, offset, t_s, t_us, rec_len, rec_len)
+            self._net_header_into(buff, offset + pcap_hdr.size, length)
+            offset += hdr_len
+            buff[offset : offset + length] = packet
+            offset += length
+        return offset
+
+    def _net_header_into(self, buff, offset, length):
+        """Pack network headers for a ``length`` bytes ZEP packet in ``buff``"""
+        udp_len = self.UDP_HDR.size + length
+        ip_len = self.IP_HDR.size + udp_len
+        checksum = self._ip_sum + ip_len
+        checksum = (checksum + (checksum >> 16)) & 0xFFFF ^ 0xFFFF
+        self.NET_HDR.pack_into(
+            buff,
+            offset,
+            0x0800,  # Ethernet protocol: IP, zero mac addresses
+            0x45,  # IP version 4 | header length 5 words
+            0,  # Type of service
+            ip_len,
+            0,  # Identification
+            0x4000,  # Flags: don't fragment | fragment offset
+            0xFF,  # TTL
+            0x11,  # Protocol: UDP
+            checksum,
+            self.LOCALHOST,
+            self.LOCALHOST,
+            self.ZEP_PORT,  # UDP source and destination ports
+            self.ZEP_PORT,
+            udp_len,
+            0,  # UDP checksum: disabled
+        )
 
-        # Actually write the data
-        self.out.write(pcap_hdr)
-        self.out.write(payload)
-        self.out.flush()
+    def _encode_raw(self, packets):
+        """Only store ZEP ``packets`` payload in records buffer"""
+        pcap_hdr, zep_len = self.PCAP_HDR, self.ZEP_HDR_LEN
+        size = sum(map(len, packets)) + (pcap_hdr.size - zep_len) * len(packets)
+        buff = self._reserve(size)
+
+        offset = 0
+        for packet in packets:
+            t_s, t_us = self._timestamp(packet)
+            length = len(packet) - zep_len
+            pcap_hdr.pack_into(buff, offset, t_s, t_us, length, length)
+            offset += pcap_hdr.size
+            # extract payload from zep encapsulated data
+            buff[offset : offset + length] = memoryview(packet)[zep_len:]
+            offset += length
+        return offset
 
     def _timestamp(self, packet):
         """Extract packet timestamp as an unix time tuple (s, us)
@@ -126,111 +182,163 @@ class ZepPcap:
         MSB are seconds stored since 1 january 1900
         LSB are fraction of seconds where 2**32 == 1 second
         """
-        ntp_t = struct.unpack_from("!LL", packet, self.ZEP_TIME_IDX)
+        ntp_t = self.NTP_TIME.unpack_from(packet, self.ZEP_TIME_IDX)
 
         t_s = ntp_t[0] - self.NTP_JAN_1970
         t_us = (1000000 * ntp_t[1]) / self.NTP_SECONDS_FRAC
 
         return t_s, round(t_us)
 
-    def _udp_header(self, pkt_len):
-        """Get UDP Header
-
-        2B - src_port: ZEP_PORT also but not required
-        2B - dst_port: ZEP_PORT == 17754
-        2B - length:   header + packet length
-        2B - checksum: Disable == 0
-
-        """
-        hdr_struct = struct.Struct("!HHHH")
-        udp_len = hdr_struct.size + pkt_len
-        udp_hdr = hdr_struct.pack(self.ZEP_PORT, self.ZEP_PORT, udp_len, 0)
-        return udp_hdr
-
-    def _ip_header(self, pkt_len):
-        """Get the IP Header
-
-        1B - Version | IHL:           0x45: [4 | 5] : [4b | 4b]
-        1B - Type of Service:         0
-        2B - Length:                  pkt_len + Header length
-        2B - Identification:          0
-        2B - Flags | Fragment offset: 0x4000: [2 | 0] : [3b | 13b]
-        1B - TTL:                     0xff
-        1B - Protocol:                0x11 UDP
-        2B - Checksum:                calculated
-        4B - Source Address:          0x7F000001 (127.0.0.1)
-        4B - Destination Address:     0x7F000001 (127.0.0.1)
+    @classmethod
+    def _main_pcap_header(cls, link_type):
+        """Return the main pcap file header for `link_type`
 
+        PCAP headers as native endian
         """
-        hdr_struct = struct.Struct("!BBHHHBBHLL")
-        ip_len = hdr_struct.size + pkt_len
-
-        # generate header with checksum == 0 to calculate checksum
-        checksum = 0
-        ip_hdr_csum = hdr_struct.pack(
-            0x45, 0, ip_len, 0, 0x4000, 0xFF, 0x11, checksum, 0x7F000001, 0x7F000001
-        )
-        checksum = self._ip_checksum(ip_hdr_csum)
-
-        # Generate header with correct checksum
-        ip_hdr = hdr_struct.pack(
-            0x45, 0, ip_len, 0, 0x4000, 0xFF, 0x11, checksum, 0x7F000001, 0x7F000001
+        return cls.MAIN_PCAP_HDR.pack(
+            0xA1B2C3D4,  # Pcap header Little Endian
+            2,  # File format major revision (i.e. pcap <2>.4)
+            4,  # File format minor revision (i.e. pcap 2.<4>)
+            0,  # GMT to local correction: 0 if timestamps are UTC
+            0,  # accuracy of timestamps -> set it to 0
+            0xFFFF,  # packet capture limit -> typically 65535
+            link_type,  # Link (Ethernet/802.15.4 FCS/...)
         )
-        return ip_hdr
 
-    def _eth_header(self, pkt_len):  # pylint:disable=unused-argument
-        """Return a static empty ethernet header
 
-        6B - dst mac addr: 0
-        6B - src mac addr: 0
-        2B - protocol:     0x0800 (IP)
-        """
-        return self.eth_hdr
+class ZepPcapng(ZepPcap):
+    """Zep to pcapng converter, with one interface per node
 
-    @staticmethod
-    def _pcap_header(pkt_len, t_s, t_us):
-        """Get the PCAP Header
+    An Interface Description Block, named as the node, is written before its
+    first packet. Packets timestamps have a nanosecond resolution.
+    With ``comments``, each packet has a comment with its node, channel,
+    LQI and sequence number.
+    """
 
-        4B - Timestamp seconds:      current time
-        4B - Timestamp microseconds: current time
-        4B - Number of octet saved:  pkt_len
-        4B - Actual lengt of packet: pkt_len
+    SHB_TYPE = 0x0A0D0D0A
+    IDB_TYPE = 1
+    EPB_TYPE = 6
+    BYTE_ORDER_MAGIC = 0x1A2B3C4D
+    OPT_END = 0
+    OPT_COMMENT = 1
+    IF_NAME = 2
+    IF_TSRESOL = 9
+    TSRESOL_NS = 9  # 10^-9 seconds
+
+    BLOCK_LEN = struct.Struct("=L")
+    # type, length, interface, timestamp high and low, captured/packet length
+    EPB_HDR = struct.Struct("=LLLLLLL")
+    OPTION = struct.Struct("=HH")
+    ZEP_INFO = struct.Struct("!B2xxB8xL")  # channel, LQI, seqno
+
+    def __init__(self, outfile, raw=False, flush_policy=None, comments=False):
+        self.raw = raw
+        self.comments = comments
+        self.interfaces = {}
+        self.link = self.link_type(raw)
+        super().__init__(outfile, raw, flush_policy)
+
+    def write_packets(self, identifier, packets):
+        """Write ZEP ``packets`` as Enhanced Packet Blocks with one write
+
+        :param identifier: packets source node, its interface name
         """
+        blocks = bytearray()
+        if_id = self.interfaces.get(identifier)
+        if if_id is None:
+            if_id = self.interfaces[identifier] = len(self.interfaces)
+            blocks += self._interface_block(identifier, self.link)
+        epb_hdr, net_len = self.EPB_HDR, self.NET_HDR.size
+        for packet in packets:
+            if self.raw:
+                data = memoryview(packet)[self.ZEP_HDR_LEN :]
+            else:
+                data = bytearray(net_len)
+                self._net_header_into(data, 0, len(packet))
+                data += packet
+            options = self._comment(identifier, packet) if self.comments else b""
+            padding = -len(data) % 4
+            length = epb_hdr.size + len(data) + padding + len(options) + 4
+            t_ns = self._timestamp_ns(packet)
+            blocks += epb_hdr.pack(
+                self.EPB_TYPE,
+                length,
+                if_id,
+                t_ns >> 32,
+                t_ns & 0xFFFFFFFF,
+                len(data),
+                len(data),
+            )
+            blocks += data
+            blocks += bytes(padding)
+            blocks += options
+            blocks += self.BLOCK_LEN.pack(length)
+        self.out.write(blocks, len(packets), identifier)
+
+    @classmethod
+    def _timestamp_ns(cls, packet):
+        """Extract packet NTP timestamp as unix time in nanoseconds
+
+        >>> ntp_time = ZepPcap.NTP_TIME.pack(ZepPcap.NTP_JAN_1970 + 1, 1 << 31)
+        >>> ZepPcapng._timestamp_ns(bytes(9) + ntp_time)
+        1500000000
+        """
+        ntp_s, ntp_frac = cls.NTP_TIME.unpack_from(packet, cls.ZEP_TIME_IDX)
+        t_s = ntp_s - cls.NTP_JAN_1970
+        return t_s * 1000000000 + ((ntp_frac * 1000000000) >> 32)
+
+    def _comment(self, identifier, packet):
+        """Return packet comment option, with end of options"""
+        channel, lqi, seqno = self.ZEP_INFO.unpack_from(packet, 4)
+        comment = f"{identifier} channel={channel} lqi={lqi} seqno={seqno}"
+        return self._options((self.OPT_COMMENT, comment.encode()))
+
+    @classmethod
+    def _interface_block(cls, identifier, link_type):
+        """Return the Interface Description Block for node ``identifier``"""
+        options = cls._options(
+            (cls.IF_NAME, str(identifier).encode()),
+            (cls.IF_TSRESOL, bytes([cls.TSRESOL_NS])),
+        )
+        length = 20 + len(options)
+        return (
+            struct.pack("=LLHHL", cls.IDB_TYPE, length, link_type, 0, 0)
+            + options
+            + cls.BLOCK_LEN.pack(length)
+        )
 
-        hdr_struct = struct.Struct("=LLLL")
-        pcap_len = pkt_len
-        pcap_hdr = hdr_struct.pack(t_s, t_us, pcap_len, pcap_len)
-        return pcap_hdr
-
-    @staticmethod
-    def _ip_checksum(hdr):
-        """Calculate the ip checksum for given header"""
-        assert (len(hdr) % 2) == 0  # hdr has even length
-        word_pack = struct.Struct("!H")
-
-        # Sum all 16bits
-        hdr_split = (hdr[i : i + 2] for i in range(0, len(hdr), 2))
-        csum = sum(word_pack.unpack(word)[0] for word in hdr_split)
-
-        # Reduce to 16b and save the one complement
-        checksum = (csum + (csum >> 16)) & 0xFFFF ^ 0xFFFF
-        return checksum
-
-    @staticmethod
-    def _main_pcap_header(link_type):
-        """Return the main pcap file header for `link_type`
+    @classmethod
+    def _options(cls, *options):
+        """Return ``(code, value)`` options, padded, with end of options
 
-        PCAP headers as native endian
+        >>> ZepPcapng._options((2, b'm3-1x')) == (
+        ...     b'\\x02\\x00\\x05\\x00m3-1x\\x00\\x00\\x00' + bytes(4))
+        True
+        """
+        data = bytearray()
+        for code, value in options:
+            data += cls.OPTION.pack(code, len(value))
+            data += value
+            data += bytes(-len(value) % 4)
+        data += cls.OPTION.pack(cls.OPT_END, 0)
+        return bytes(data)
+
+    @classmethod
+    def _main_pcap_header(cls, link_type):  # pylint:disable=unused-argument
+        """Return the Section Header Block
+
+        Link type is given by each interface block.
         """
+        length = 28
         return struct.pack(
-            "=LHHLLLL",
-            0xA1B2C3D4,  # Pcap header Little Endian
-            2,  # File format major revision (i.e. pcap <2>.4)
-            4,  # File format minor revision (i.e. pcap 2.<4>)
-            0,  # GMT to local correction: 0 if timestamps are UTC
-            0,  # accuracy of timestamps -> set it to 0
-            0xFFFF,  # packet capture limit -> typically 65535
-            link_type,  # Link (Ethernet/802.15.4 FCS/...)
+            "=LLLHHqL",
+            cls.SHB_TYPE,
+            length,
+            cls.BYTE_ORDER_MAGIC,
+            1,  # Major version
+            0,  # Minor version
+            -1,  # Section length not specified
+            length,
         )
 
 
@@ -254,7 +362,7 @@ def main():
     zep_message = binascii.a2b_hex("".join(zep_message_str.split()))
 
     out_file = sys.argv[1]
-    with open(out_file, "w") as pcap_file:
+    with open(out_file, "wb") as pcap_file:
         zep_pcap = ZepPcap(pcap_file)
 
         zep_pcap.write(zep_message)